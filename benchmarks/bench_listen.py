@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+""" Measure the latency from frame arrival to spa state update.
+
+A local TCP server plays the spa, broadcasting status updates at a fixed
+rate, and a new_data_cb records when each update reaches the spa object.
+The legacy loop is the listen() used before it became event driven, which
+slept 0.1 s after every frame, kept here as a baseline.
+
+Usage: python3 benchmarks/bench_listen.py [frames] [rate_hz]
+"""
+import asyncio
+import statistics
+import sys
+import time
+
+sys.path.insert(0, ".")
+
+import pybalboa  # noqa: E402
+import pybalboa.messages as messages  # noqa: E402
+
+PANEL_CONFIG = bytes.fromhex('7E0B0ABF2E0A0001500000BF7E')
+
+
+def status_frame(i):
+    status = messages.StatusUpdate(current_temperature=i % 200 + 40, minutes=i // 200 % 60,
+                                   set_temperature=100)
+    return bytes(messages.Message(channel=0xFF, type_code=0x13,
+                                  arguments=bytes(status.arguments) + b"\x00"))
+
+
+async def legacy_listen(spa):
+    while True:
+        if not spa.connected:
+            await asyncio.sleep(5)
+            continue
+        data = await spa.read_one_message()
+        if data is None:
+            continue
+        await spa.dispatch_message(data)
+        await asyncio.sleep(0.1)
+
+
+async def run(listen, frames, rate):
+    frame_data = [status_frame(i) for i in range(frames)]
+    sent = [0.0] * frames
+    latencies = []
+    served = asyncio.Event()
+
+    async def serve(reader, writer):
+        for i, frame in enumerate(frame_data):
+            sent[i] = time.perf_counter()
+            writer.write(frame)
+            await asyncio.sleep(1.0 / rate)
+        served.set()
+
+    server = await asyncio.start_server(serve, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    spa = pybalboa.BalboaSpaWifi("127.0.0.1", port)
+    spa.parse_panel_config_resp(PANEL_CONFIG)
+    received = [0]
+
+    async def on_update():
+        latencies.append(time.perf_counter() - sent[received[0]])
+        received[0] += 1
+        if received[0] == frames:
+            done.set()
+
+    spa.new_data_cb = on_update
+    done = asyncio.Event()
+    await spa.connect()
+    task = asyncio.ensure_future(listen(spa))
+    try:
+        # The legacy loop needs 0.1 s per frame to catch up
+        await asyncio.wait_for(done.wait(), frames * max(0.1, 1.0 / rate) + 2.0)
+    except asyncio.TimeoutError:
+        pass
+    await served.wait()
+    task.cancel()
+    await spa.disconnect()
+    server.close()
+    await server.wait_closed()
+    return latencies
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 20.0
+
+    for name, listen in (("legacy", legacy_listen), ("event", pybalboa.BalboaSpaWifi.listen)):
+        latencies = asyncio.run(run(listen, frames, rate))
+        if not latencies:
+            print("{0:>8}: no updates".format(name))
+            continue
+        latencies.sort()
+        print("{0:>8}: {1:4d}/{2} updates  mean {3:9.3f} ms  p50 {4:9.3f} ms  p99 {5:9.3f} ms".format(
+            name, len(latencies), frames, statistics.mean(latencies) * 1e3,
+            latencies[len(latencies) // 2] * 1e3, latencies[int(len(latencies) * 0.99)] * 1e3))
+
+
+if __name__ == "__main__":
+    main()
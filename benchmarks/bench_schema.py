@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+""" Compare the schema-compiled status decoder with the hand-written one.
+
+The hand-written decoder is the field extraction parse_status_update used
+before the layouts moved into messages.StatusUpdate.SCHEMA, kept here as a
+baseline.
+
+Usage: python3 benchmarks/bench_schema.py [iterations]
+"""
+import sys
+import timeit
+
+sys.path.insert(0, ".")
+
+import pybalboa.messages as messages  # noqa: E402
+
+STATUS = bytes.fromhex('7E1DFFAF13000064082D00000100000400000000000000000064000000067E')
+
+
+class Spa:
+    def __init__(self):
+        self.pump_array = [1, 1, 0, 0, 0, 0]
+        self.light_array = [1, 0]
+        self.aux_array = [0, 0]
+        self.circ_pump = 1
+        self.mister = 0
+        self.blower = 0
+        self.pump_status = [0] * 6
+        self.light_status = [0, 0]
+        self.aux_status = [0, 0]
+        self.circ_pump_status = 0
+        self.mister_status = 0
+        self.blower_status = 0
+
+
+def hand_written(self, data):
+    if data[14] & 0x01:
+        self.tempscale = 1
+    else:
+        self.tempscale = 0
+    self.time_hour = data[8]
+    self.time_minute = data[9]
+    if data[14] & 0x02:
+        self.timescale = 0
+    else:
+        self.timescale = 1
+    temp = float(data[7])
+    settemp = float(data[25])
+    if self.tempscale == 1:
+        self.curtemp = temp / 2.0
+        self.settemp = settemp / 2.0
+    else:
+        self.curtemp = temp
+        self.settemp = settemp
+    self.heatmode = data[10] & 0x03
+    self.filter_mode = (data[14] & 0x0c) >> 2
+    self.heatstate = (data[15] & 0x30) >> 4
+    self.temprange = (data[15] & 0x04) >> 2
+    for i in range(0, 6):
+        if not self.pump_array[i]:
+            continue
+        if i < 4:
+            self.pump_status[i] = (data[16] >> i*2) & 0x03
+        else:
+            self.pump_status[i] = (data[17] >> ((i - 4)*2)) & 0x03
+    if self.circ_pump:
+        if data[18] == 0x02:
+            self.circ_pump_status = 1
+        else:
+            self.circ_pump_status = 0
+    for i in range(0, 2):
+        if not self.light_array[i]:
+            continue
+        self.light_status[i] = (data[19] >> i) & 0x03
+    if self.mister:
+        self.mister_status = data[20] & 0x01
+    if self.blower:
+        self.blower_status = (data[18] & 0x0c) >> 2
+    for i in range(0, 2):
+        if not self.aux_array[i]:
+            continue
+        if i == 0:
+            self.aux_status[i] = data[20] & 0x08
+        else:
+            self.aux_status[i] = data[20] & 0x10
+
+
+def main():
+    from pybalboa.balboa import _set_status
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    spa = Spa()
+
+    def compiled(self, data):
+        _set_status(self, data, 5)
+        if self.tempscale == 1:
+            self.curtemp = self.curtemp / 2.0
+            self.settemp = self.settemp / 2.0
+        else:
+            self.curtemp = float(self.curtemp)
+            self.settemp = float(self.settemp)
+
+    for frame, label in ((STATUS, "bytes"), (memoryview(STATUS), "memoryview")):
+        for name, fn in (("hand-written", hand_written), ("compiled", compiled)):
+            t = min(timeit.repeat(lambda: fn(spa, frame), number=n, repeat=5))
+            print("{0:>12} {1:<10} {2:8.3f} us/frame".format(name, label, t / n * 1e6))
+
+    msg = messages.decode(STATUS)
+    t = min(timeit.repeat(lambda: (msg.current_temperature, msg.heating_status), number=n, repeat=5))
+    print("{0:>12} {1:<10} {2:8.3f} us/frame".format("2 lazy props", "view", t / n * 1e6))
+
+
+if __name__ == "__main__":
+    main()
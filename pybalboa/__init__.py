@@ -14,8 +14,18 @@ __license__ = "Apache 2.0"
 __copyright__ = "Copyright (c) 2019 Tim Rightnour"
 
 from .balboa import *
+from . import cache
 from . import clients
+from . import connection
+from . import events
+from . import fleet
 from . import homie
 from . import messages
+from . import protocol
+from . import scheduler
+from . import store
+from . import supervisor
+from . import sync
+from . import watchdog
 
 if __name__ == '__main__': print(__version__)
@@ -85,25 +85,17 @@ async def connect_and_listen(spa_host):
 async def mini_engine(spahost):
     """ Test a miniature engine of talking to the spa."""
     spa = balboa.BalboaSpaWifi(spahost)
-    await spa.connect()
-
-    asyncio.ensure_future(spa.listen())
-
-    await spa.send_panel_req(0, 1)
+    await spa.start()
 
-    for i in range(0, 30):
-        await asyncio.sleep(1)
-        if spa.config_loaded:
-            print("Config is loaded:")
-            print('Pump Array: {0}'.format(str(spa.pump_array)))
-            print('Light Array: {0}'.format(str(spa.light_array)))
-            print('Aux Array: {0}'.format(str(spa.aux_array)))
-            print('Circulation Pump: {0}'.format(spa.circ_pump))
-            print('Blower: {0}'.format(spa.blower))
-            print('Mister: {0}'.format(spa.mister))
-            break
+    if await spa.wait_ready(30):
+        print("Config is loaded:")
+        print('Pump Array: {0}'.format(str(spa.pump_array)))
+        print('Light Array: {0}'.format(str(spa.light_array)))
+        print('Aux Array: {0}'.format(str(spa.aux_array)))
+        print('Circulation Pump: {0}'.format(spa.circ_pump))
+        print('Blower: {0}'.format(spa.blower))
+        print('Mister: {0}'.format(spa.mister))
     print()
-    await asyncio.sleep(5)
 
     lastupd = 0
     for i in range(0, 3):
@@ -203,7 +195,7 @@ async def mini_engine(spahost):
     await asyncio.sleep(2)
     print("Heat Mode: {0}".format(spa.get_heatmode(True)))
 
-    await spa.disconnect()
+    await spa.close()
     return
 
 
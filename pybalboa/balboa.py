@@ -1,11 +1,14 @@
 import asyncio
-import errno
+import inspect
 import logging
-import queue
-from socket import error as SocketError
 import time
 
 import pybalboa.messages as messages
+import pybalboa.watchdog as watchdog
+from pybalboa.connection import CONNECT_TIMEOUT, Backoff, TaskSet, open_connection
+from pybalboa.events import (CommandCompleted, ConnectionDown, ConnectionUp, EventBus,
+                             FrameReceived, StateChanged)
+from pybalboa.protocol import BalboaProtocol
 
 BALBOA_DEFAULT_PORT = 4257
 
@@ -63,6 +66,268 @@ mtypes = [
     [0x0A, 0XBF, 0x25],  # BMTR_PANEL_NOCLUE2
 ]
 
+# Index into mtypes by type code byte.  Where two entries share a type code
+# the first one listed wins, as it did with a linear scan.
+mtype_by_code = [None] * 256
+for mtype in reversed(range(0, NROF_BMT)):
+    mtype_by_code[mtypes[mtype][2]] = mtype
+del mtype
+
+# Outbound frames, encoded once on first use and shared afterwards
+_frames = {}
+
+
+def _encoded_frame(mtype, *arguments):
+    """ Return the encoded frame for mtype with the given argument bytes. """
+    key = (mtype, arguments)
+    frame = _frames.get(key)
+    if frame is None:
+        frame = _frames[key] = bytes(messages.Message(
+            channel=mtypes[mtype][0],
+            type_code=mtypes[mtype][2],
+            arguments=bytes(arguments)))
+    return frame
+
+
+# Where each StatusUpdate field is stored on BalboaSpaWifi
+status_fields = {
+    "priming_mode": "priming",
+    "current_temperature": "curtemp",
+    "hours": "time_hour",
+    "minutes": "time_minute",
+    "heating_mode": "heatmode",
+    "temperature_scale": "tempscale",
+    "time_mode": "timescale",
+    "filter_mode": "filter_mode",
+    "temperature_range": "temprange",
+    "heating_status": "heatstate",
+    "pump_1": "pump_status[0]",
+    "pump_2": "pump_status[1]",
+    "pump_3": "pump_status[2]",
+    "pump_4": "pump_status[3]",
+    "pump_5": "pump_status[4]",
+    "pump_6": "pump_status[5]",
+    "circulation_pump": "circ_pump_status",
+    "blower": "blower_status",
+    "light_1": "light_status[0]",
+    "light_2": "light_status[1]",
+    "mister": "mister_status",
+    "aux_1": "aux_status[0]",
+    "aux_2": "aux_status[1]",
+    "set_temperature": "settemp",
+}
+
+# Where each ConfigurationResponse field is stored on BalboaSpaWifi
+panel_config_fields = {
+    "pump_1": "pump_array[0]",
+    "pump_2": "pump_array[1]",
+    "pump_3": "pump_array[2]",
+    "pump_4": "pump_array[3]",
+    "pump_5": "pump_array[4]",
+    "pump_6": "pump_array[5]",
+    "light_1": "light_array[0]",
+    "light_2": "light_array[1]",
+    "blower": "blower",
+    "circulation_pump": "circ_pump",
+    "aux_1": "aux_array[0]",
+    "aux_2": "aux_array[1]",
+    "mister": "mister",
+}
+
+# Frames handed to the parsers include the 5 byte header
+_set_status = messages.StatusUpdate.SCHEMA.compile().setter(status_fields)
+_set_panel_config = messages.ConfigurationResponse.SCHEMA.compile().setter(panel_config_fields)
+_decode_config_resp = messages.ModuleIdentificationResponse.SCHEMA.compile().decode
+_decode_information = messages.InformationResponse.SCHEMA.compile().decode
+
+# Attribute reported as changed for each StatusUpdate field
+status_attrs = {name: target.split("[")[0] for name, target in status_fields.items()}
+# Status argument bytes holding each attribute, for subscribe()
+status_offsets = {}
+for _field in messages.StatusUpdate.SCHEMA:
+    status_offsets.setdefault(status_attrs[_field.name], set()).update(
+        range(_field.offset, _field.offset + _field.size))
+_status_changes = messages.StatusUpdate.SCHEMA.compile().changed
+_all_status = frozenset(status_fields)
+_temperatures = frozenset(("current_temperature", "set_temperature"))
+_status_span = {f.name: (f.offset, f.offset + f.size) for f in messages.StatusUpdate.SCHEMA}
+
+# Setters for the combinations of status fields seen changing together
+_status_setters = {_all_status: _set_status}
+
+# Status fields only worth decoding when the panel configuration says the
+# equipment is fitted: field -> (config attribute, index or None)
+_equipment = {}
+for _name, _target in panel_config_fields.items():
+    _attr, _, _index = _target.rstrip("]").partition("[")
+    _equipment[_name] = (_attr, int(_index) if _index else None)
+
+# Change detectors for each set of status fields a configuration needs
+_status_detectors = {_all_status: _status_changes}
+
+
+def _status_setter(names):
+    """ Return a setter storing only the named status fields. """
+    setter = _status_setters.get(names)
+    if setter is None:
+        schema = messages.StatusUpdate.SCHEMA
+        setter = _status_setters[names] = schema.compile(
+            [n for n in schema.names if n in names]).setter(status_fields)
+    return setter
+
+
+def _status_detector(names):
+    """ Return a changed(diff) that only sees the named status fields. """
+    detector = _status_detectors.get(names)
+    if detector is None:
+        schema = messages.StatusUpdate.SCHEMA
+        detector = _status_detectors[names] = schema.compile(
+            [n for n in schema.names if n in names]).changed
+    return detector
+
+
+# Controls BalboaSpaWifi.apply() can press:
+# name -> (status attribute, index, config attribute, states, control code)
+# states is the length of the button's cycle, None for pumps where it
+# depends on the pump being one or two speed.
+toggle_controls = {
+    "pump_1": ("pump_status", 0, "pump_array", None, C_PUMP1),
+    "pump_2": ("pump_status", 1, "pump_array", None, C_PUMP2),
+    "pump_3": ("pump_status", 2, "pump_array", None, C_PUMP3),
+    "pump_4": ("pump_status", 3, "pump_array", None, C_PUMP4),
+    "pump_5": ("pump_status", 4, "pump_array", None, C_PUMP5),
+    "pump_6": ("pump_status", 5, "pump_array", None, C_PUMP6),
+    "light_1": ("light_status", 0, "light_array", 2, C_LIGHT1),
+    "light_2": ("light_status", 1, "light_array", 2, C_LIGHT2),
+    "aux_1": ("aux_status", 0, "aux_array", 2, C_AUX1),
+    "aux_2": ("aux_status", 1, "aux_array", 2, C_AUX2),
+    "blower": ("blower_status", None, "blower", 4, C_BLOWER),
+    "mister": ("mister_status", None, "mister", 2, C_MISTER),
+    # You can't put the spa in REST, it can BE in rest, but you cannot
+    # force it into rest.  It's a tri-state, but a binary switch between
+    # READY and not READY.
+    "heatmode": ("heatmode", None, None, 2, C_HEATMODE),
+    "temprange": ("temprange", None, None, 2, C_TEMPRANGE),
+}
+
+
+def _resolved(result):
+    """ Return a future already holding result. """
+    fut = asyncio.get_event_loop().create_future()
+    fut.set_result(result)
+    return fut
+
+
+class _Subscription:
+    __slots__ = ("fields", "callback", "pending", "task")
+
+    def __init__(self, fields, callback):
+        self.fields = fields
+        self.callback = callback
+        # Changes not delivered yet, and the task delivering them
+        self.pending = None
+        self.task = None
+
+
+def _state_getter(field):
+    """ Return a function decoding field from a packed status int. """
+    mask = field.frame_mask
+    shift = 8 * field.offset + field.shift
+    values = field.values
+    if values is None:
+        return lambda status: (status & mask) >> shift
+    return lambda status: values[(status & mask) >> shift]
+
+
+# Status attribute -> getter, or tuple of getters for the indexed ones
+_state_getters = {}
+for _field in messages.StatusUpdate.SCHEMA:
+    _attr, _, _index = status_fields[_field.name].rstrip("]").partition("[")
+    if _index:
+        _getters = list(_state_getters.get(_attr, ()))
+        _getters[int(_index):int(_index) + 1] = [_state_getter(_field)]
+        _state_getters[_attr] = tuple(_getters)
+    else:
+        _state_getters[_attr] = _state_getter(_field)
+
+
+class SpaState:
+    """ Immutable snapshot of the spa's status after one update.
+
+    The core is status, the frame's status bytes packed into an int (see
+    BalboaSpaWifi.prior_status) with the bits of equipment the spa does
+    not have cleared; the attributes BalboaSpaWifi has for each status
+    field (curtemp, heatstate, pump_status, ...) are decoded from it on
+    access, so every value comes from the same frame and matches the
+    spa's own attributes, 0 for missing equipment included.  seq
+    numbers the updates of one spa and received is when the frame came
+    in (time.time()).
+
+    Snapshots compare and hash by status alone.  They cannot be changed,
+    so copies are the snapshot itself and they can be handed to any
+    number of readers or threads without locking.
+    """
+
+    __slots__ = ("status", "seq", "received")
+
+    def __init__(self, status, seq, received):
+        object.__setattr__(self, "status", status)
+        object.__setattr__(self, "seq", seq)
+        object.__setattr__(self, "received", received)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SpaState is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("SpaState is immutable")
+
+    def __eq__(self, other):
+        if not isinstance(other, SpaState):
+            return NotImplemented
+        return self.status == other.status
+
+    def __hash__(self):
+        return hash(self.status)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (SpaState, (self.status, self.seq, self.received))
+
+    def __repr__(self):
+        return "SpaState(seq={0}, curtemp={1}, settemp={2}, heatstate={3})".format(
+            self.seq, self.curtemp, self.settemp, self.heatstate)
+
+    def _temperature(self, attr):
+        return _state_getters[attr](self.status) / (2.0 if self.tempscale == 1 else 1.0)
+
+    @property
+    def curtemp(self):
+        return self._temperature("curtemp")
+
+    @property
+    def settemp(self):
+        return self._temperature("settemp")
+
+    def as_dict(self):
+        return {attr: getattr(self, attr) for attr in _state_getters}
+
+
+def _state_property(getter):
+    if isinstance(getter, tuple):
+        return property(lambda self: tuple(g(self.status) for g in getter))
+    return property(lambda self: getter(self.status))
+
+
+for _attr, _getter in _state_getters.items():
+    if _attr not in ("curtemp", "settemp"):
+        setattr(SpaState, _attr, _state_property(_getter))
+
+
 text_heatmode = ["Ready", "Ready in Rest", "Rest"]
 text_heatstate = ["Idle", "Heating", "Heat Waiting"]
 text_tscale = ["Fahrenheit", "Celsius"]
@@ -74,8 +339,16 @@ text_switch = ["Off", "On"]
 text_filter = ["Off", "Cycle 1", "Cycle 2", "Cycle 1 and 2"]
 
 
+# Everything wait_ready() waits for
+READINESS = ("config_ready", "identity_ready", "first_status")
+
+# Attributes kept in the configuration cache, see BalboaSpaWifi.cache
+cached_attrs = ("pump_array", "light_array", "aux_array", "circ_pump", "blower",
+                "mister", "model_name", "sw_vers", "cfg_sig", "setup", "ssid")
+
+
 class BalboaSpaWifi:
-    def __init__(self, hostname, port=BALBOA_DEFAULT_PORT):
+    def __init__(self, hostname, port=BALBOA_DEFAULT_PORT, cache=None):
         # API Constants
         self.TSCALE_C = 1
         self.TSCALE_F = 0
@@ -114,8 +387,23 @@ class BalboaSpaWifi:
         # Internal states
         self.host = hostname
         self.port = port
-        self.reader = None
-        self.writer = None
+        # Optional pybalboa.cache.ConfigCache, and what the spa itself has
+        # confirmed since connecting: "identity", "panel" and "info"
+        self.cache = cache
+        self._fresh = set()
+        self.transport = None
+        self.protocol = None
+        self.tasks = TaskSet()
+        # Frames, state changes, connection and command events, for any
+        # number of subscribers
+        self.events = EventBus()
+        self._backoff = Backoff()
+        self._watch = None
+        self._connected_event = asyncio.Event()
+        self._disconnected_event = asyncio.Event()
+        # Readiness flags, and futures handed out for them, see wait_ready()
+        self._ready = dict.fromkeys(READINESS, False)
+        self._ready_futures = {}
         self.connected = False
         self.config_loaded = False
         self.pump_array = [0, 0, 0, 0, 0, 0]
@@ -145,7 +433,35 @@ class BalboaSpaWifi:
         self.time_minute = 0
         self.filter_mode = 0
         self.prior_status = None
+        # SpaState of the latest status update, and its sequence number
+        self.state = None
+        self._state_seq = 0
+        # Status fields decoded for this spa's configuration, see
+        # _compile_status()
+        self._status_fields = _all_status
+        self._status_changes = _status_changes
+        # Status bits kept in SpaState, clearing missing equipment
+        self._status_mask = -1
+        self.changed_fields = frozenset()
         self.new_data_cb = None
+        self._new_data_cb_args = (None, False)
+        # Latest-wins delivery to new_data_cb, see int_new_data_cb()
+        self.coalesce_updates = False
+        self.frames_received = 0
+        # pybalboa.store.StateStore row also holding our status, see
+        # StateStore.attach()
+        self.state_store = None
+        self.state_row = None
+        self.updates_delivered = 0
+        self.updates_coalesced = 0
+        self.updates_dropped = 0
+        self._pending_changes = None
+        self._pending_count = 0
+        self._delivery = None
+        # status argument offset -> subscriptions watching that byte
+        self._subscribers = {}
+        # (check, future) pairs resolved by the next status update passing check()
+        self._state_waiters = []
         self.model_name = 'Unknown'
         self.sw_vers = 'Unknown'
         self.cfg_sig = 'Unknown'
@@ -153,51 +469,438 @@ class BalboaSpaWifi:
         self.ssid = 'Unknown'
         self.log = logging.getLogger(__name__)
 
+        # Parsers indexed by mtype
+        self.mtype_handlers = [None] * NROF_BMT
+        self.mtype_handlers[BMTR_STATUS_UPDATE] = self.parse_status_update
+        self.mtype_handlers[BMTR_CONFIG_RESP] = self.handle_config_resp
+        self.mtype_handlers[BMTR_PANEL_RESP] = self.handle_panel_config_resp
+        self.mtype_handlers[BMTR_PANEL_NOCLUE1] = self.handle_noclue1
+
+    # Frames handled back to back before listen() yields to other tasks
+    LISTEN_BATCH = 32
+    # Seconds allowed for connecting, and without any data from the spa
+    # before the connection is dropped (it broadcasts several times a second)
+    CONNECT_TIMEOUT = CONNECT_TIMEOUT
+    READ_TIMEOUT = 30.0
+    # Multiples of the usual interval between frames after which a quiet
+    # spa is sent a panel request, then reconnected (see watchdog)
+    STALL_KICK_AFTER = watchdog.StallWatchdog.KICK_AFTER
+    STALL_RECONNECT_AFTER = watchdog.StallWatchdog.RECONNECT_AFTER
+    # Seconds to wait for a status update confirming a button press, and
+    # how many unconfirmed presses are resent before a command gives up
+    COMMAND_TIMEOUT = 2.0
+    COMMAND_RETRIES = 2
+
+    @property
+    def connected(self):
+        return self._connected_event.is_set()
+
+    @connected.setter
+    def connected(self, value):
+        if value:
+            self._disconnected_event.clear()
+            self._connected_event.set()
+        else:
+            self._connected_event.clear()
+            self._disconnected_event.set()
+
+    @classmethod
+    async def open(cls, hostname, port=BALBOA_DEFAULT_PORT):
+        """ Create a spa, connect and start listening.  See start(). """
+        spa = cls(hostname, port)
+        await spa.start()
+        return spa
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def start(self):
+        """ Connect and start the listen() and check_connection_status()
+        tasks, owned by self.tasks.  Returns whether the first connection
+        attempt worked; if not, the checker keeps retrying.
+        """
+        connected = await self.connect()
+        self.tasks.start(self.listen())
+        self.tasks.start(self.check_connection_status())
+        return connected
+
+    async def close(self):
+        """ Cancel every background task and disconnect. """
+        await self.tasks.close()
+        if self.protocol is not None:
+            await self.disconnect()
+        await self.events.close()
+
     async def connect(self):
         """ Connect to the spa."""
         try:
-            self.reader, self.writer = await asyncio.open_connection(self.host,
-                                                                     self.port)
-        except (asyncio.TimeoutError, ConnectionRefusedError):
-            self.log.error("Cannot connect to spa at {0}:{1}".format(self.host,
-                                                                     self.port))
+            self.transport, self.protocol = await open_connection(
+                lambda: BalboaProtocol(self._connection_lost, idle_timeout=self.READ_TIMEOUT),
+                self.host, self.port, self.CONNECT_TIMEOUT)
+        except (asyncio.TimeoutError, OSError) as e:
+            self.log.error("Cannot connect to spa at {0}:{1}: {2!r}".format(
+                self.host, self.port, e))
             return False
         self.connected = True
+        self.events.publish(ConnectionUp(self))
+        if self.cache is not None:
+            self._fresh = set()
+            if not self.config_loaded:
+                self._load_cached_config()
+            self.tasks.start(self._revalidate_config())
+        self._watch = watchdog.shared().watch(
+            self._stall_kick, self._stall_reconnect,
+            self.STALL_KICK_AFTER, self.STALL_RECONNECT_AFTER)
         return True
 
+    def _stall_kick(self, idle):
+        self.log.error("Spa quiet for {0:.1f} s, requesting panel config.".format(idle))
+        self.tasks.start(self.send_panel_req(0, 1))
+
+    def _stall_reconnect(self, idle):
+        self.log.error("Spa quiet for {0:.1f} s, reconnecting.".format(idle))
+        self._watch = None
+        if self.protocol is not None:
+            self.protocol.close()
+
+    def _stop_watch(self):
+        if self._watch is not None:
+            self._watch.stop()
+            self._watch = None
+
     async def disconnect(self):
         """ Stop talking to the spa."""
         self.log.info("Disconnect requested")
-        self.connected = False
-        self.writer.close()
-        await self.writer.wait_closed()
+        if self.connected:
+            self.connected = False
+            self.events.publish(ConnectionDown(self))
+        self._stop_watch()
+        if self.protocol is None:
+            return
+        self.protocol.close()
+        await self.protocol.wait_closed()
+
+    def _connection_lost(self, exc):
+        """ Called by the protocol when the transport goes away. """
+        if exc is not None:
+            self.log.error('Spa connection lost: {0}'.format(str(exc)))
+        if self.connected:
+            self.connected = False
+            self.events.publish(ConnectionDown(self, exc))
+        self._stop_watch()
 
     async def int_new_data_cb(self):
         """ Internal new data callback.
-        Binds to self.new_data_cb()
+        Binds to self.new_data_cb().  Callbacks that take an argument are
+        passed the set of attributes that changed (see changed_fields).
+
+        With coalesce_updates set, the callback runs in its own task and
+        never holds up the reader: updates arriving while it is busy are
+        folded into a single pending delivery, which sees the newest state
+        and the union of the changed attributes.  updates_dropped counts
+        the superseded updates, updates_coalesced the deliveries that
+        folded more than one update.
         """
 
         if self.new_data_cb is None:
             return
+        if not self.coalesce_updates:
+            await self._call_new_data_cb(self.changed_fields)
+            self.updates_delivered += 1
+            return
+        if self._pending_changes is None:
+            self._pending_changes = self.changed_fields
+            self._pending_count = 1
+        else:
+            self._pending_changes |= self.changed_fields
+            self._pending_count += 1
+            self.updates_dropped += 1
+        if self._delivery is None or self._delivery.done():
+            self._delivery = self.tasks.start(self._deliver_latest())
+
+    async def _deliver_latest(self):
+        while self._pending_changes is not None and self.new_data_cb is not None:
+            changed = self._pending_changes
+            if self._pending_count > 1:
+                self.updates_coalesced += 1
+            self._pending_changes = None
+            self._pending_count = 0
+            try:
+                await self._call_new_data_cb(changed)
+            except Exception:
+                self.log.exception("new_data_cb failed")
+            self.updates_delivered += 1
+        self._pending_changes = None
+
+    async def _call_new_data_cb(self, changed):
+        cb, takes_changes = self._new_data_cb_args
+        if cb is not self.new_data_cb:
+            try:
+                takes_changes = len(inspect.signature(self.new_data_cb).parameters) > 0
+            except (TypeError, ValueError):
+                takes_changes = False
+            self._new_data_cb_args = (self.new_data_cb, takes_changes)
+        if takes_changes:
+            await self.new_data_cb(changed)
         else:
             await self.new_data_cb()
 
+    def subscribe(self, fields, callback):
+        """ Call callback when any of the named status attributes change.
+
+        fields names attributes such as "curtemp", "heatstate" or
+        "pump_status" (see status_attrs).  callback is awaited with the set
+        of subscribed attributes that changed, and is only woken by updates
+        touching the status bytes those attributes live in.  It runs in its
+        own task, so it never holds up the reader: updates arriving while
+        it is busy are folded into its next call, which sees the newest
+        state and all the attributes that changed meanwhile.  Returns a
+        function that cancels the subscription.
+        """
+        fields = frozenset((fields,) if isinstance(fields, str) else fields)
+        unknown = fields - status_offsets.keys()
+        if unknown:
+            raise ValueError("Unknown status fields: {0}".format(", ".join(sorted(unknown))))
+        sub = _Subscription(fields, callback)
+        offsets = set().union(*(status_offsets[f] for f in fields))
+        for offset in offsets:
+            self._subscribers.setdefault(offset, []).append(sub)
+
+        def unsubscribe():
+            for offset in offsets:
+                subs = self._subscribers.get(offset)
+                if subs is not None and sub in subs:
+                    subs.remove(sub)
+                    if not subs:
+                        del self._subscribers[offset]
+            sub.pending = None
+        return unsubscribe
+
+    def _notify_subscribers(self, changed):
+        """ Wake the subscribers of the status fields in changed. """
+        if not self._subscribers:
+            return
+        woken = {}
+        for name in changed:
+            for offset in range(*_status_span[name]):
+                for sub in self._subscribers.get(offset, ()):
+                    woken[id(sub)] = sub
+        for sub in woken.values():
+            hits = sub.fields & self.changed_fields
+            if not hits:
+                continue
+            sub.pending = hits if sub.pending is None else sub.pending | hits
+            if sub.task is None or sub.task.done():
+                sub.task = self.tasks.start(self._deliver_to(sub))
+
+    async def _deliver_to(self, sub):
+        while sub.pending is not None:
+            hits, sub.pending = sub.pending, None
+            try:
+                await sub.callback(hits)
+            except Exception:
+                self.log.exception("Subscriber callback failed")
+
+    def _wait_for_state(self, check):
+        """ Return a future resolved by the first status update where check() is true. """
+        fut = asyncio.get_event_loop().create_future()
+        self._state_waiters.append((check, fut))
+        return fut
+
+    def _check_state_waiters(self):
+        now = time.perf_counter()
+        waiting = []
+        for check, fut in self._state_waiters:
+            if fut.done():
+                continue
+            if check():
+                fut.set_result(now)
+            else:
+                waiting.append((check, fut))
+        self._state_waiters = waiting
+
+    def _control_state(self, name):
+        """ Return the position of toggle control name in its cycle. """
+        attr, index, config, states, code = toggle_controls[name]
+        value = getattr(self, attr)
+        if index is not None:
+            value = value[index]
+        if name == "heatmode":
+            value = 0 if value == self.HEATMODE_READY else 1
+        return value
+
+    def _control_states(self, name):
+        attr, index, config, states, code = toggle_controls[name]
+        if states is None:
+            states = 3 if self.pump_array[index] == 2 else 2
+        return states
+
+    def _target(self, target):
+        """ Check a target state and return it in control positions. """
+        wanted = {}
+        for name, value in target.items():
+            if name == "settemp":
+                if (value < self.tmin[self.temprange][self.tempscale] or
+                        value > self.tmax[self.temprange][self.tempscale]):
+                    raise ValueError("Temperature {0} out of range".format(value))
+                wanted[name] = value
+                continue
+            if name not in toggle_controls:
+                raise ValueError("Unknown control {0}".format(name))
+            attr, index, config, states, code = toggle_controls[name]
+            if config is not None:
+                present = getattr(self, config)
+                if not (present if index is None else present[index]):
+                    raise ValueError("Spa has no {0}".format(name))
+            if name == "heatmode":
+                value = 0 if value == self.HEATMODE_READY else 1
+            if not 0 <= value < self._control_states(name):
+                raise ValueError("Invalid state {0} for {1}".format(value, name))
+            wanted[name] = value
+        if "settemp" in wanted:
+            # Compare in the spa's own resolution
+            if self.tempscale == self.TSCALE_C:
+                wanted["settemp"] = int(round(wanted["settemp"] * 2.0)) / 2.0
+            else:
+                wanted["settemp"] = float(int(round(wanted["settemp"])))
+        return wanted
+
+    def _reached(self, wanted):
+        for name, value in wanted.items():
+            current = self.settemp if name == "settemp" else self._control_state(name)
+            if current != value:
+                return False
+        return True
+
+    def _plan(self, wanted):
+        """ Return (frames, counts) taking the spa from its current state to
+        wanted, counts being the presses planned for each control.
+
+        Every toggle only steps forward through its cycle, so a control
+        needs (wanted - current) % states presses.  Presses are interleaved
+        round robin so no button is sent twice in a row.
+        """
+        presses = []
+        counts = {}
+        for name, value in wanted.items():
+            if name == "settemp":
+                if self.settemp != value:
+                    if self.tempscale == self.TSCALE_C:
+                        value *= 2.0
+                    presses.append([1, _encoded_frame(BMTS_SET_TEMP, int(round(value)))])
+                    counts[name] = 1
+                continue
+            count = (value - self._control_state(name)) % self._control_states(name)
+            if count:
+                code = toggle_controls[name][4]
+                presses.append([count, _encoded_frame(BMTS_CONTROL_REQ, code, 0x00)])
+                counts[name] = count
+        frames = []
+        while presses:
+            for press in presses:
+                frames.append(press[1])
+                press[0] -= 1
+            presses = [press for press in presses if press[0]]
+        return frames, counts
+
+    def _position(self, name):
+        return self.settemp if name == "settemp" else self._control_state(name)
+
+    def _landed(self, wanted, outstanding):
+        """ Return a status check passing once every press in outstanding
+        (control -> presses sent but not yet seen) shows up as a step of
+        its control.  outstanding is counted down in place, and
+        moved[0] holds the time of the last step seen. """
+        last = {name: self._position(name) for name in wanted}
+        moved = [time.perf_counter()]
+
+        def check():
+            for name in wanted:
+                position = self._position(name)
+                if position == last[name]:
+                    continue
+                if name == "settemp":
+                    steps = 1
+                else:
+                    steps = (position - last[name]) % self._control_states(name)
+                last[name] = position
+                moved[0] = time.perf_counter()
+                if name in outstanding:
+                    outstanding[name] = max(0, outstanding[name] - steps)
+            return not any(outstanding.values())
+        return check, moved
+
+    def apply(self, target):
+        """ Bring the spa to target and return a future for the result.
+
+        target maps controls to the state wanted: "pump_1" to "pump_6",
+        "light_1", "light_2", "aux_1", "aux_2", "blower", "mister",
+        "heatmode", "temprange" and "settemp".  The presses needed for all
+        of them are planned together and sent back to back, then every
+        press is waited for to show up as a step in the status updates,
+        however slowly the spa acts on them.  Once they all have, the
+        future resolves if the spa is at target.  If it ended up elsewhere,
+        or the controls did not move at all for COMMAND_TIMEOUT seconds
+        (presses lost), what is left is planned again from the reported
+        state, up to COMMAND_RETRIES times.  Presses are never sent on top
+        of earlier ones still on their way.
+
+        The future resolves to the seconds between the first press and the
+        status update showing target, or fails with asyncio.TimeoutError.
+        Raises ValueError for controls the spa lacks or invalid states;
+        returns None if not connected.
+        """
+        if not self.connected:
+            return None
+        wanted = self._target(target)
+        if self._reached(wanted):
+            future = _resolved(0.0)
+        else:
+            future = self.tasks.start(self._reconcile(wanted), owned=True)
+        if self.events.wants(CommandCompleted):
+            future.add_done_callback(
+                lambda f: self.events.publish(CommandCompleted.from_future(self, target, f)))
+        return future
+
+    async def _reconcile(self, wanted):
+        start = time.perf_counter()
+        retries = 0
+        while True:
+            frames, outstanding = self._plan(wanted)
+            check, moved = self._landed(wanted, outstanding)
+            landed = self._wait_for_state(check)
+            for frame in frames:
+                self.protocol.write(frame)
+            await self.protocol.drain()
+            moved[0] = time.perf_counter()
+            # Wait as long as the controls keep moving
+            while not landed.done():
+                idle = time.perf_counter() - moved[0]
+                if idle >= self.COMMAND_TIMEOUT:
+                    break
+                await asyncio.wait([landed], timeout=self.COMMAND_TIMEOUT - idle)
+            if landed.done():
+                if self._reached(wanted):
+                    return landed.result() - start
+                self.log.debug("Spa settled away from target, re-planning")
+            else:
+                landed.cancel()
+                self.log.debug("Spa ignored {0} presses, re-planning".format(sum(outstanding.values())))
+            retries += 1
+            if retries > self.COMMAND_RETRIES:
+                raise asyncio.TimeoutError("Spa did not reach the requested state")
+
     async def send_config_req(self):
         """ Ask the spa for it's config. """
         if not self.connected:
             return
 
-        data = bytearray(7)
-        data[0] = M_START
-        data[1] = 5  # len of msg
-        data[2] = mtypes[BMTS_CONFIG_REQ][0]
-        data[3] = mtypes[BMTS_CONFIG_REQ][1]
-        data[4] = mtypes[BMTS_CONFIG_REQ][2]
-        data[5] = 0x77  # known value
-        data[6] = M_END
-
-        self.writer.write(data)
-        await self.writer.drain()
+        self.protocol.write(_encoded_frame(BMTS_CONFIG_REQ))
+        await self.protocol.drain()
 
     async def send_panel_req(self, ba, bb):
         """ Send a panel request, 2 bytes of data.
@@ -209,20 +912,17 @@ class BalboaSpaWifi:
         if not self.connected:
             return
 
-        data = bytearray(10)
-        data[0] = M_START
-        data[1] = 8
-        data[2] = mtypes[BMTS_PANEL_REQ][0]
-        data[3] = mtypes[BMTS_PANEL_REQ][1]
-        data[4] = mtypes[BMTS_PANEL_REQ][2]
-        data[5] = ba
-        data[6] = 0
-        data[7] = bb
-        data[8] = messages.Message.crc(data[1:8])
-        data[9] = M_END
-
-        self.writer.write(data)
-        await self.writer.drain()
+        self.protocol.write(_encoded_frame(BMTS_PANEL_REQ, ba, 0, bb))
+        await self.protocol.drain()
+
+    async def _command(self, target):
+        """ apply() target and wait until the spa confirms it.  Returns the
+        seconds that took, or None if not connected; raises
+        asyncio.TimeoutError if the spa does not get there. """
+        future = self.apply(target)
+        if future is None:
+            return None
+        return await future
 
     async def send_temp_change(self, newtemp):
         """ Change the set temp to newtemp. """
@@ -235,22 +935,7 @@ class BalboaSpaWifi:
             self.log.error("Attempt to set temp outside of boundary of heatmode")
             return
 
-        data = bytearray(8)
-        data[0] = M_START
-        data[1] = 6
-        data[2] = mtypes[BMTS_SET_TEMP][0]
-        data[3] = mtypes[BMTS_SET_TEMP][1]
-        data[4] = mtypes[BMTS_SET_TEMP][2]
-
-        if self.tempscale == self.TSCALE_C:
-            newtemp *= 2.0
-        val = int(round(newtemp))
-        data[5] = val
-        data[6] = messages.Message.crc(data[1:6])
-        data[7] = M_END
-
-        self.writer.write(data)
-        await self.writer.drain()
+        return await self._command({"settemp": newtemp})
 
     async def change_light(self, light, newstate):
         """ Change light #light to newstate. """
@@ -265,24 +950,7 @@ class BalboaSpaWifi:
         if not self.light_array[light]:
             return
 
-        # this is a toggle switch, not on/off
-        if self.light_status[light] == newstate:
-            return
-
-        # Setup the basic things we know
-        data = bytearray(9)
-        data[0] = M_START
-        data[1] = 7
-        data[2] = mtypes[BMTS_CONTROL_REQ][0]
-        data[3] = mtypes[BMTS_CONTROL_REQ][1]
-        data[4] = mtypes[BMTS_CONTROL_REQ][2]
-        data[5] = C_LIGHT1 if light == 0 else C_LIGHT2
-        data[6] = 0x00  # who knows?
-        data[7] = messages.Message.crc(data[1:])
-        data[8] = M_END
-
-        self.writer.write(data)
-        await self.writer.drain()
+        return await self._command({"light_{0}".format(light + 1): newstate})
 
     async def change_pump(self, pump, newstate):
         """ Change pump #pump to newstate. """
@@ -290,43 +958,14 @@ class BalboaSpaWifi:
             return
 
         # we don't have 7 pumps!
-        if pump > MAX_PUMPS:
+        if pump >= MAX_PUMPS:
             return
 
         # we don't have THIS pump
         if not self.pump_array[pump]:
             return
 
-        # this is a toggle switch, not on/off
-        if self.pump_status[pump] == newstate:
-            return
-
-        # what we know:
-        data = bytearray(9)
-        data[0] = M_START
-        data[1] = 7
-        data[2] = mtypes[BMTS_CONTROL_REQ][0]
-        data[3] = mtypes[BMTS_CONTROL_REQ][1]
-        data[4] = mtypes[BMTS_CONTROL_REQ][2]
-        data[6] = 0x00  # who knows?
-        data[8] = M_END
-
-        # calculate how many times to push the button
-        if self.pump_array[pump] == 2:
-            for iter in range(1, 2+1):
-                if newstate == ((self.pump_status[pump] + iter) % 3):
-                    break
-        else:
-            iter = 1
-
-        # now push the button until we hit desired state
-        for pushes in range(1, iter+1):
-            # 4 is 0, 5 is 2, presume 6 is 3?
-            data[5] = C_PUMP1 + pump
-            data[7] = messages.Message.crc(data[1:7])
-            self.writer.write(data)
-            await self.writer.drain()
-            await asyncio.sleep(1.0)
+        return await self._command({"pump_{0}".format(pump + 1): newstate})
 
     async def change_heatmode(self, newmode):
         """ Change the spa's heatmode to newmode. """
@@ -337,38 +976,7 @@ class BalboaSpaWifi:
         if newmode > 2:
             return
 
-        # this is a toggle switch, not on/off
-        if self.heatmode == newmode:
-            return
-
-        # what we know:
-        data = bytearray(9)
-        data[0] = M_START
-        data[1] = 7
-        data[2] = mtypes[BMTS_CONTROL_REQ][0]
-        data[3] = mtypes[BMTS_CONTROL_REQ][1]
-        data[4] = mtypes[BMTS_CONTROL_REQ][2]
-        data[5] = C_HEATMODE
-        data[6] = 0x00  # who knows?
-        data[7] = messages.Message.crc(data[1:7])
-        data[8] = M_END
-
-        # You can't put the spa in REST, it can BE in rest, but you cannot
-        # force it into rest.  It's a tri-state, but a binary switch.
-
-        # calculate how many times to push the button
-        if newmode == self.HEATMODE_READY:
-            if (self.heatmode == self.HEATMODE_REST or
-                    self.heatmode == self.HEATMODE_RNR):
-                self.writer.write(data)
-                await self.writer.drain()
-                await asyncio.sleep(0.5)
-
-        if newmode == self.HEATMODE_REST or newmode == self.HEATMODE_RNR:
-            if self.heatmode == self.HEATMODE_READY:
-                self.writer.write(data)
-                await self.writer.drain()
-                await asyncio.sleep(0.5)
+        return await self._command({"heatmode": newmode})
 
     async def change_temprange(self, newmode):
         """ Change the spa's temprange to newmode. """
@@ -379,21 +987,7 @@ class BalboaSpaWifi:
         if newmode > 1:
             return
 
-        # this is a toggle switch, not on/off
-        if self.temprange == newmode:
-            return
-
-        # what we know:
-        data = bytearray(9)
-        data[0] = M_START
-        data[1] = 7
-        data[2] = mtypes[BMTS_CONTROL_REQ][0]
-        data[3] = mtypes[BMTS_CONTROL_REQ][1]
-        data[4] = mtypes[BMTS_CONTROL_REQ][2]
-        data[5] = C_TEMPRANGE
-        data[6] = 0x00  # who knows?
-        data[7] = messages.Message.crc(data[1:7])
-        data[8] = M_END
+        return await self._command({"temprange": newmode})
 
     async def change_aux(self, aux, newstate):
         """ Change aux #aux to newstate. """
@@ -408,24 +1002,7 @@ class BalboaSpaWifi:
         if not self.aux_array[aux]:
             return
 
-        # this is a toggle switch, not on/off
-        if self.aux_status[aux] == newstate:
-            return
-
-        # Setup the basic things we know
-        data = bytearray(9)
-        data[0] = M_START
-        data[1] = 7
-        data[2] = mtypes[BMTS_CONTROL_REQ][0]
-        data[3] = mtypes[BMTS_CONTROL_REQ][1]
-        data[4] = mtypes[BMTS_CONTROL_REQ][2]
-        data[5] = C_AUX1 if aux == 0 else C_AUX2
-        data[6] = 0x00  # who knows?
-        data[7] = messages.Message.crc(data[1:7])
-        data[8] = M_END
-
-        self.writer.write(data)
-        await self.writer.drain()
+        return await self._command({"aux_{0}".format(aux + 1): newstate})
 
     async def change_mister(self, newmode):
         """ Change the spa's mister to newmode. """
@@ -436,21 +1013,11 @@ class BalboaSpaWifi:
         if newmode > 1:
             return
 
-        # this is a toggle switch, not on/off
-        if self.mister == newmode:
+        # we don't have a mister
+        if not self.mister:
             return
 
-        # what we know:
-        data = bytearray(9)
-        data[0] = M_START
-        data[1] = 7
-        data[2] = mtypes[BMTS_CONTROL_REQ][0]
-        data[3] = mtypes[BMTS_CONTROL_REQ][1]
-        data[4] = mtypes[BMTS_CONTROL_REQ][2]
-        data[5] = C_MISTER
-        data[6] = 0x00  # who knows?
-        data[7] = messages.Message.crc(data[1:7])
-        data[8] = M_END
+        return await self._command({"mister": newmode})
 
     async def change_blower(self, newstate):
         """ Change blower to newstate. """
@@ -458,43 +1025,93 @@ class BalboaSpaWifi:
         if not self.connected:
             return
 
-        # this is a toggle switch, not on/off
-        if self.blower_status == newstate:
+        # we don't have a blower
+        if not self.blower:
             return
 
-        # what we know:
-        data = bytearray(9)
-        data[0] = M_START
-        data[1] = 7
-        data[2] = mtypes[BMTS_CONTROL_REQ][0]
-        data[3] = mtypes[BMTS_CONTROL_REQ][1]
-        data[4] = mtypes[BMTS_CONTROL_REQ][2]
-        data[6] = 0x00  # who knows?
-        data[8] = M_END
-
-        # calculate how many times to push the button
-        for iter in range(1, 4+1):
-            if newstate == ((self.blower_status + iter) % 4):
-                break
-
-        # now push the button until we hit desired state
-        for pushes in range(1, iter+1):
-            data[5] = C_BLOWER
-            data[7] = messages.Message.crc(data[1:7])
-            self.writer.write(data)
-            await self.writer.drain()
-            await asyncio.sleep(0.5)
+        return await self._command({"blower": newstate})
 
     def find_balboa_mtype(self, data):
         """ Look at a message and try to figure out what type it was. """
         if len(data) < 5:
             return None
-        for i in range(0, NROF_BMT):
-            if (data[2] == mtypes[i][0] and
-                data[3] == mtypes[i][1] and
-                data[4] == mtypes[i][2]):
-                return i
-        return None
+        mtype = mtype_by_code[data[4]]
+        if (mtype is None or
+                data[2] != mtypes[mtype][0] or
+                data[3] != mtypes[mtype][1]):
+            return None
+        return mtype
+
+    async def dispatch_message(self, data):
+        """ Hand a message to the parser registered for its type. """
+        mtype = self.find_balboa_mtype(data)
+        if mtype is None:
+            self.log.error("Spa sent an unknown message type.")
+            return
+        handler = self.mtype_handlers[mtype]
+        if handler is None:
+            self.log.error("Unhandled mtype {0}".format(mtype))
+            return
+        await handler(data)
+
+    async def handle_config_resp(self, data):
+        (macaddr, junk, morejunk) = self.parse_config_resp(data)
+        if (self.macaddr != 'Unknown' and macaddr != self.macaddr
+                and "panel" not in self._fresh):
+            # A different spa answers at this address: the cached
+            # configuration is not ours
+            self.log.info("Spa at {0} is now {1}, ignoring cached config".format(self.host, macaddr))
+            self.config_loaded = False
+        self.macaddr = macaddr
+        self._set_ready("identity_ready")
+        self._fresh.add("identity")
+        self._update_cache()
+
+    async def handle_panel_config_resp(self, data):
+        self.parse_panel_config_resp(data)
+        self._fresh.add("panel")
+        self._update_cache()
+
+    async def handle_noclue1(self, data):
+        self.parse_noclue1(data)
+        self._fresh.add("info")
+        if self.cache is not None and self.macaddr != 'Unknown':
+            entry = self.cache.get(self.macaddr)
+            if entry is not None and entry["cfg_sig"] != self.cfg_sig:
+                self.log.info("Spa configuration signature changed, dropping cached config")
+                self.cache.invalidate(self.macaddr)
+                if "panel" not in self._fresh:
+                    self.config_loaded = False
+                    await self.send_panel_req(0, 1)
+        self._update_cache()
+
+    def _load_cached_config(self):
+        """ Take the configuration from the cache entry for this address. """
+        mac, entry = self.cache.lookup("{0}:{1}".format(self.host, self.port))
+        if entry is None:
+            return False
+        for attr in cached_attrs:
+            value = entry[attr]
+            setattr(self, attr, list(value) if isinstance(value, list) else value)
+        self.macaddr = mac
+        self._compile_status()
+        self.config_loaded = True
+        self._set_ready("config_ready")
+        self._set_ready("identity_ready")
+        return True
+
+    def _update_cache(self):
+        """ Store the configuration once the spa confirmed all of it. """
+        if self.cache is None or len(self._fresh) < 3:
+            return
+        self.cache.store("{0}:{1}".format(self.host, self.port), self.macaddr,
+                         {attr: getattr(self, attr) for attr in cached_attrs})
+
+    async def _revalidate_config(self):
+        """ Ask the spa for everything the cache holds. """
+        await self.send_config_req()
+        await self.send_panel_req(0, 1)
+        await self.send_panel_req(2, 0)
 
     def parse_noclue1(self, data):
         """ Parse a noclue1 message.
@@ -523,18 +1140,14 @@ class BalboaSpaWifi:
 
         """
 
-        model = [
-            data[9], data[10],
-            data[11], data[12], data[13],
-            data[14], data[15], data[16],
-        ]
-        model_name = "".join(map(chr, model))
-        self.model_name = model_name.strip()
+        (ssid_1, ssid_2, vers_major, vers_minor, model, setup, cfg_sig,
+         volts, heater_type, dip_sw) = _decode_information(data, 5)
 
-        self.cfg_sig = f"{data[18]:x}{data[19]:x}{data[20]:x}{data[21]:x}"
-        self.sw_vers = f"{str(data[7])}.{str(data[8])}"
-        self.setup = data[17]
-        self.ssid = f"M{str(data[5])}_{str(data[6])} V{self.sw_vers}"
+        self.model_name = model.decode("latin-1").strip()
+        self.cfg_sig = "".join("{:x}".format(b) for b in cfg_sig.to_bytes(4, "big"))
+        self.sw_vers = f"{str(vers_major)}.{str(vers_minor)}"
+        self.setup = setup
+        self.ssid = f"M{str(ssid_1)}_{str(ssid_2)} V{self.sw_vers}"
 
     def parse_config_resp(self, data):
         """ Parse a config response.
@@ -553,21 +1166,10 @@ class BalboaSpaWifi:
         I feel that the nrof pumps is untrustworthy here.
         """
 
-        macaddr = f'{data[8]:x}:{data[9]:x}:{data[10]:x}'\
-            f':{data[11]:x}:{data[12]:x}:{data[13]:x}'
-
-        pump_array = [0, 0, 0, 0, 0, 0]
-        pump_array[0] = int((data[5] & 0x03))
-        pump_array[1] = int((data[5] & 0x0c) >> 2)
-        pump_array[2] = int((data[5] & 0x30) >> 4)
-        pump_array[3] = int((data[5] & 0xc0) >> 6)
-        pump_array[4] = int((data[6] & 0x03))
-        pump_array[5] = int((data[6] & 0xc0) >> 6)
-
-        light_array = [0, 0]
-        # not a typo
-        light_array[1] = int((data[7] & 0x03) != 0)
-        light_array[0] = int((data[7] & 0xc0) != 0)
+        config = _decode_config_resp(data, 5)
+        pump_array = list(config[0:6])
+        light_array = list(config[6:8])
+        macaddr = ":".join("{:x}".format(b) for b in config[8])
 
         return (macaddr, pump_array, light_array)
 
@@ -584,26 +1186,34 @@ class BalboaSpaWifi:
 
         """
 
-        # pumps 0-5
-        self.pump_array[0] = int((data[5] & 0x03))
-        self.pump_array[1] = int((data[5] & 0x0c) >> 2)
-        self.pump_array[2] = int((data[5] & 0x30) >> 4)
-        self.pump_array[3] = int((data[5] & 0xc0) >> 6)
-        self.pump_array[4] = int((data[6] & 0x03))
-        self.pump_array[5] = int((data[6] & 0xc0) >> 6)
-
-        # lights 0-1
-        self.light_array[0] = int((data[7] & 0x03) != 0)
-        self.light_array[1] = int((data[7] & 0xc0) != 0)
-
-        self.circ_pump = int((data[8] & 0x80) != 0)
-        self.blower = int((data[8] & 0x03) != 0)
-        self.mister = int((data[9] & 0x30) != 0)
-
-        self.aux_array[0] = int((data[9] & 0x01) != 0)
-        self.aux_array[1] = int((data[9] & 0x02) != 0)
+        _set_panel_config(self, data, 5)
+        self._compile_status()
 
         self.config_loaded = True
+        self._set_ready("config_ready")
+
+    def _compile_status(self):
+        """ Decode only the status fields for equipment this spa has.
+        Called whenever the panel configuration is (re)loaded; status of
+        missing equipment is never looked at again on the per frame path.
+        """
+        fields = set(_all_status)
+        for name, (attr, index) in _equipment.items():
+            value = getattr(self, attr)
+            if not (value if index is None else value[index]):
+                fields.discard(name)
+        fields = frozenset(fields)
+        if fields != self._status_fields:
+            self._status_fields = fields
+            self._status_changes = _status_detector(fields)
+            missing = _all_status - fields
+            self._status_mask = ~sum(messages.StatusUpdate.SCHEMA.by_name[name].frame_mask
+                                     for name in missing)
+            if missing:
+                # Equipment that went away reads 0 from now on
+                _status_setter(missing)(self, bytes(messages.StatusUpdate.SCHEMA.length), 0)
+            # Decode everything this configuration has on the next frame
+            self.prior_status = None
 
     async def parse_status_update(self, data):
         """ Parse a status update from the spa.
@@ -627,202 +1237,157 @@ class BalboaSpaWifi:
             await self.send_panel_req(0, 1)
             return
 
-        # Check if the spa had anything new to say.
-        # This will cause our internal states to update once per minute due
-        # to the hour/minute counter.  This is ok.
-        have_new_data = False
-        if self.prior_status is not None:
-            for i in range(0, 31):
-                if data[i] != self.prior_status[i]:
-                    have_new_data = True
-                    break
+        # Check if the spa had anything new to say by XORing the status
+        # bytes against the previous frame, and work out which fields the
+        # differing bits belong to.  The clock makes this fire once per
+        # minute, but then only the minute (and hour) fields are decoded.
+        status = int.from_bytes(data[5:-2], "little")
+        if self.prior_status is None:
+            changed = self._status_fields
         else:
-            have_new_data = True
-            self.prior_status = bytearray(31)
-
-        if not have_new_data:
+            changed = self._status_changes(status ^ self.prior_status)
+        self.prior_status = status
+        if not changed:
+            if self._state_waiters:
+                self._check_state_waiters()
             return
 
-        if data[14] & 0x01:
-            self.tempscale = self.TSCALE_C
-        else:
-            self.tempscale = self.TSCALE_F
-
-        self.time_hour = data[8]
-        self.time_minute = data[9]
-        if data[14] & 0x02:
-            self.timescale = self.TIMESCALE_12H
-        else:
-            self.timescale = self.TIMESCALE_24H
-
-        temp = float(data[7])
-        settemp = float(data[25])
-        if self.tempscale == self.TSCALE_C:
-            self.curtemp = temp / 2.0
-            self.settemp = settemp / 2.0
-        else:
-            self.curtemp = temp
-            self.settemp = settemp
+        if "temperature_scale" in changed:
+            changed |= _temperatures
+        _status_setter(changed)(self, data, 5)
+        if self.state_store is not None:
+            self.state_store.write(self.state_row, changed, data)
 
-        # flag 2 is heatmode
-        self.heatmode = data[10] & 0x03
-
-        # flag 3 is filter mode
-        self.filter_mode = (data[14] & 0x0c) >> 2
-
-        # flag 4 heating, temp range
-        self.heatstate = (data[15] & 0x30) >> 4
-        self.temprange = (data[15] & 0x04) >> 2
-
-        for i in range(0, 6):
-            if not self.pump_array[i]:
-                continue
-            # 1-4 are in one byte, 5/6 are in another
-            if i < 4:
-                self.pump_status[i] = (data[16] >> i*2) & 0x03
-            else:
-                self.pump_status[i] = (data[17] >> ((i - 4)*2)) & 0x03
-
-        if self.circ_pump:
-            if data[18] == 0x02:
-                self.circ_pump_status = 1
-            else:
-                self.circ_pump_status = 0
-
-        for i in range(0, 2):
-            if not self.light_array[i]:
-                continue
-            self.light_status[i] = (data[19] >> i) & 0x03
-
-        if self.mister:
-            self.mister_status = data[20] & 0x01
-
-        if self.blower:
-            self.blower_status = (data[18] & 0x0c) >> 2
-
-        for i in range(0, 2):
-            if not self.aux_array[i]:
-                continue
-            if i == 0:
-                self.aux_status[i] = data[20] & 0x08
-            else:
-                self.aux_status[i] = data[20] & 0x10
+        scale = 2.0 if self.tempscale == self.TSCALE_C else 1.0
+        if "current_temperature" in changed:
+            self.curtemp = self.curtemp / scale
+        if "set_temperature" in changed:
+            self.settemp = self.settemp / scale
 
         self.lastupd = time.time()
-        # populate prior_status
-        for i in range(0, 31):
-            self.prior_status[i] = data[i]
+        self._state_seq += 1
+        self.state = SpaState(status & self._status_mask, self._state_seq, self.lastupd)
+        self.changed_fields = frozenset(status_attrs[name] for name in changed)
+        if not self._ready["first_status"]:
+            self._set_ready("first_status")
+        if self._state_waiters:
+            self._check_state_waiters()
+        self._notify_subscribers(changed)
+        if self.events.wants(StateChanged):
+            self.events.publish(StateChanged(self, self.changed_fields, self.state))
         await self.int_new_data_cb()
 
     async def read_one_message(self):
-        """ Listen to the spa babble once."""
+        """ Listen to the spa babble once.
+        Returns a memoryview of the next validated frame, or None if the
+        connection is down.
+        """
         if not self.connected:
             return None
-
-        try:
-            header = await self.reader.readexactly(2)
-        except SocketError as err:
-            if err.errno == errno.ECONNRESET:
-                self.log.error('Connection reset by peer')
-                self.connected = False
-            if err.errno == errno.EHOSTUNREACH:
-                self.log.error('Spa unreachable')
-                self.connected = False
-            else:
-                self.log.error('Spa socket error: {0}'.format(str(err)))
-            return None
-        except Exception as e:
-            self.log.error('Spa read failed: {0}'.format(str(e)))
-            return None
-
-        if header[0] == M_START:
-            # header[1] is size, + checksum + M_END (we already read 2 tho!)
-            rlen = header[1]
-        else:
-            return None
-
-        # now get the rest of the data
-        try:
-            data = await self.reader.readexactly(rlen)
-        except Exception as e:
-            self.log.errpr('Spa read failed: {0}'.format(str(e)))
-            return None
-
-        full_data = header + data
-        # don't count M_START, M_END or CHKSUM (remember that rlen is 2 short)
-        crc = messages.Message.crc(full_data[1:rlen - 1])
-        if crc != full_data[-2]:
-            self.log.error('Message had bad CRC, discarding')
-            return None
-
-        # self.log.error('got update: {}'.format(full_data.hex()))
-        return full_data
+        return await self.protocol.read_frame()
 
     async def check_connection_status(self):
-        """ Set this up to periodically check the spa connection and fix. """
+        """ Set this up to reconnect to the spa whenever the link drops.
+        A spa that stops talking is handled by the stall watchdog, which
+        drops the connection if a panel request does not wake it up.
+        """
         while True:
             if not self.connected:
                 self.log.error("Lost connection to spa, attempting reconnect.")
+                # Backs off until a connection actually delivers frames
+                await self._backoff.wait()
                 await self.connect()
-                await asyncio.sleep(10)
                 continue
-            if (self.lastupd + 5 * self.sleep_time) < time.time():
-                self.log.error("Spa stopped responding, requesting panel config.")
-                await self.send_panel_req(0, 1)
-            await asyncio.sleep(self.sleep_time)
+            await self._disconnected_event.wait()
 
     async def listen(self):
-        """ Listen to the spa babble forever. """
+        """ Listen to the spa babble forever.
+        Frames are handled as soon as they arrive.  The loop only gives way
+        to other tasks while waiting for data, or every LISTEN_BATCH frames
+        when a backlog is queued.
+        """
 
+        handled = 0
         while True:
             if not self.connected:
-                # sleep and hope the checker fixes us
-                await asyncio.sleep(5)
+                # wait for the checker to fix us
+                await self._connected_event.wait()
                 continue
             data = await self.read_one_message()
             if data is None:
-                await asyncio.sleep(1)
-                continue
-            mtype = self.find_balboa_mtype(data)
-
-            if mtype is None:
-                self.log.error("Spa sent an unknown message type.")
-                await asyncio.sleep(0.1)
-                continue
-            if mtype == BMTR_CONFIG_RESP:
-                (self.macaddr, junk, morejunk) = self.parse_config_resp(data)
-                await asyncio.sleep(0.1)
-                continue
-            if mtype == BMTR_STATUS_UPDATE:
-                await self.parse_status_update(data)
-                await asyncio.sleep(0.1)
-                continue
-            if mtype == BMTR_PANEL_RESP:
-                self.parse_panel_config_resp(data)
-                await asyncio.sleep(0.1)
                 continue
-            if mtype == BMTR_PANEL_NOCLUE1:
-                self.parse_noclue1(data)
-                await asyncio.sleep(0.1)
-                continue
-            self.log.error("Unhandled mtype {0}".format(mtype))
+            self.frames_received += 1
+            if self._watch is not None:
+                self._watch.feed()
+            if self._backoff.attempts:
+                self._backoff.reset()
+            if self.events.wants(FrameReceived):
+                self.events.publish(FrameReceived(self, bytes(data)))
+            await self.dispatch_message(data)
+            handled += 1
+            if handled >= self.LISTEN_BATCH:
+                handled = 0
+                await asyncio.sleep(0)
+
+    def _readiness(self, name):
+        fut = self._ready_futures.get(name)
+        # A timed out wait_for() cancels the future it waited on
+        if fut is None or fut.cancelled():
+            fut = self._ready_futures[name] = asyncio.get_event_loop().create_future()
+            if self._ready[name]:
+                fut.set_result(True)
+        return fut
+
+    def _set_ready(self, name):
+        self._ready[name] = True
+        fut = self._ready_futures.get(name)
+        if fut is not None and not fut.done():
+            fut.set_result(True)
+
+    @property
+    def config_ready(self):
+        """ Future resolved once the panel configuration is parsed. """
+        return self._readiness("config_ready")
+
+    @property
+    def identity_ready(self):
+        """ Future resolved once the MAC address is known. """
+        return self._readiness("identity_ready")
+
+    @property
+    def first_status(self):
+        """ Future resolved by the first decoded status update. """
+        return self._readiness("first_status")
+
+    @property
+    def ready(self):
+        return all(self._ready.values())
+
+    async def wait_ready(self, timeout=None):
+        """ Ask the spa for whatever is missing and wait until the
+        configuration, identity and first status have all arrived.
+        Needs listen() running.  Returns False on timeout.
+        """
+        if not self._ready["identity_ready"]:
+            await self.send_config_req()
+        if not self._ready["config_ready"]:
+            await self.send_panel_req(0, 1)
+            # get the versions and model data
+            await self.send_panel_req(2, 0)
+        try:
+            await asyncio.wait_for(asyncio.gather(
+                *(self._readiness(name) for name in READINESS)), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
 
     async def spa_configured(self):
         """Check if the spa has been configured.
         Use in conjunction with listen.  First listen, then send some config
         commands to set the spa up.
         """
-        await self.send_config_req()
-        await self.send_panel_req(0, 1)
-        # get the versions and model data
-        await self.send_panel_req(2, 0)
-        while True:
-            if (self.connected
-                    and self.config_loaded
-                    and self.macaddr != 'Unknown'
-                    and self.curtemp != 0.0):
-                return
-            await asyncio.sleep(1)
+        await self.wait_ready()
+        await self._connected_event.wait()
 
     async def listen_until_configured(self, maxiter=20):
         """ Listen to the spa babble until we are configured."""
@@ -830,33 +1395,13 @@ class BalboaSpaWifi:
         if not self.connected:
             return False
         for i in range(0, maxiter):
-            if (self.config_loaded and self.macaddr != 'Unknown'
-                    and self.curtemp != 0.0):
+            if self.ready:
                 return True
             data = await self.read_one_message()
             if data is None:
-                await asyncio.sleep(1)
-                continue
-            mtype = self.find_balboa_mtype(data)
-
-            if mtype is None:
-                self.log.error("Spa sent an unknown message type.")
-                await asyncio.sleep(0.1)
-                continue
-            if mtype == BMTR_CONFIG_RESP:
-                (self.macaddr, junk, morejunk) = self.parse_config_resp(data)
-                await asyncio.sleep(0.1)
-                continue
-            if mtype == BMTR_STATUS_UPDATE:
-                await self.parse_status_update(data)
-                await asyncio.sleep(0.1)
-                continue
-            if mtype == BMTR_PANEL_RESP:
-                self.parse_panel_config_resp(data)
-                await asyncio.sleep(0.1)
-                continue
-            self.log.error("Unhandled mtype {0}".format(mtype))
-        return False
+                return False
+            await self.dispatch_message(data)
+        return self.ready
 
     # Simple accessors
     def get_model_name(self):
@@ -0,0 +1,75 @@
+import json
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+
+def default_path():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "pybalboa", "config.json")
+
+
+class ConfigCache:
+    """ On-disk cache of spa configurations, keyed by MAC address.
+
+    Each entry holds what the spa reports about itself: the panel
+    configuration, model, software version and configuration signature.
+    The MAC address last seen at each host:port is kept too, so a
+    reconnecting client can find its entry before the spa has said
+    anything.  The file is small JSON, only rewritten when an entry
+    changes, and replaced atomically.
+    """
+
+    def __init__(self, path=None):
+        self.path = default_path() if path is None else path
+        self._data = None
+
+    def _load(self):
+        if self._data is None:
+            try:
+                with open(self.path) as f:
+                    self._data = json.load(f)
+            except FileNotFoundError:
+                self._data = {}
+            except (OSError, ValueError) as e:
+                log.warning("Ignoring unreadable config cache {0}: {1}".format(self.path, e))
+                self._data = {}
+            self._data.setdefault("hosts", {})
+            self._data.setdefault("spas", {})
+        return self._data
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump(self._data, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.warning("Cannot write config cache {0}: {1}".format(self.path, e))
+
+    def lookup(self, host):
+        """ Return (mac, entry) last stored for host, or (None, None). """
+        data = self._load()
+        mac = data["hosts"].get(host)
+        entry = data["spas"].get(mac)
+        if entry is None:
+            return None, None
+        return mac, entry
+
+    def get(self, mac):
+        return self._load()["spas"].get(mac)
+
+    def store(self, host, mac, entry):
+        data = self._load()
+        if data["hosts"].get(host) == mac and data["spas"].get(mac) == entry:
+            return
+        data["hosts"][host] = mac
+        data["spas"][mac] = entry
+        self._save()
+
+    def invalidate(self, mac):
+        data = self._load()
+        if data["spas"].pop(mac, None) is not None:
+            self._save()
@@ -1,56 +1,137 @@
 import asyncio
 import datetime
 import logging
-import queue
+import threading
 import time
-from socket import error as SocketError
 
 import pybalboa.messages as messages
+from pybalboa.connection import CONNECT_TIMEOUT, Backoff, TaskSet, open_connection
+from pybalboa.events import CommandCompleted, ConnectionDown, ConnectionUp, EventBus, FrameReceived
+from pybalboa.protocol import BalboaProtocol, LatencyHistogram, SerialTransport
+from pybalboa.scheduler import CommandScheduler
+
+CLEAR_TO_SEND = messages.ClientClearToSend.TYPE_CODE
+EXISTING_CLIENT_REQUEST = messages.ExistingClientRequest.TYPE_CODE
+
 
 class Client:
 
+    # Channel the pre-encoded replies are for, see _set_channel()
+    _reply_channel = None
+
     def __init__(self, channel=None):
         self.channel = channel
         self.log = logging.getLogger(__name__)
-        self.queue = queue.Queue()
+        self.cts_latency = LatencyHistogram()
+        self.scheduler = CommandScheduler()
+        self.tasks = TaskSet()
+        # Subscribe here rather than overriding on_message, so more than
+        # one integration can listen
+        self.events = EventBus()
+        self._loop = asyncio.get_event_loop()
+        self._loop_thread = threading.get_ident()
         self._channel_timeout = None
         if channel is not None:
             self._channel_timeout = time.time() + 10
-        asyncio.ensure_future(self.listen())
+            self._set_channel(channel)
+        self._unassigned_handlers = {
+            messages.NewClientClearToSend: self._on_new_client_clear_to_send,
+            messages.ChannelAssignmentResponse: self._on_channel_assignment_response,
+        }
+        self.tasks.start(self.listen())
+
+    @classmethod
+    async def open(cls, *args, **kwargs):
+        """ Create a client and wait for it to be connected. """
+        client = cls(*args, **kwargs)
+        try:
+            await client.wait_connected()
+        except BaseException:
+            await client.close()
+            raise
+        return client
+
+    async def __aenter__(self):
+        await self.wait_connected()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def wait_connected(self):
+        pass
+
+    async def close(self):
+        """ Cancel every background task and close the connection. """
+        await self.tasks.close()
+        await self.events.close()
 
     async def listen(self):
         while True:
             msg = await self.recv()
+            if msg is None:
+                break
             self._on_message_internal(msg)
             self.on_message(msg)
+            if self.events.wants(FrameReceived):
+                self.events.publish(FrameReceived(self, msg))
 
     def _on_message_internal(self, msg: messages.Message):
         if self.channel is None:
-            if msg.type_code == messages.NewClientClearToSend.TYPE_CODE:
-                self.log.debug("Requesting channel...")
-                self._send_internal(messages.ChannelAssignmentRequest(bytes([0x02, 0xF1, 0x73]))); # TODO: Determine meaning of these bytes (probably unique)
-            elif msg.type_code == messages.ChannelAssignmentResponse.TYPE_CODE:
-                self.channel = msg.arguments[0];
-                self.log.debug("Acknowledging assignment to channel {}".format(self.channel))
-                self._send_internal(messages.ChannelAssignmentAcknowlegement(self.channel))
+            handler = self._unassigned_handlers.get(type(msg))
+            if handler is not None:
+                handler(msg)
         elif msg.channel == self.channel:
-            if msg.type_code == messages.ExistingClientRequest.TYPE_CODE:
-                self._send_internal(messages.ExistingClientResponse(self.channel, bytes([0x04, 0x08, 0x00])))
-            elif msg.type_code == messages.ClientClearToSend.TYPE_CODE:
-                if self.queue.empty():
-                    self._send_internal(messages.NothingToSend(self.channel))
-                else:
-                    msg = self.queue.get()
-                    if msg.channel is None:
-                        msg.channel = self.channel
-                    self._send_internal(msg)
-                    self.log.debug(msg.__class__.__name__ + " sent on channel {}".format(msg.channel))
+            # Polls on our channel were already answered by _on_frame()
             self._channel_timeout = None
         elif self._channel_timeout is not None:
             if time.time() > self._channel_timeout:
                 self.log.error("No Client Clear to Send detected on channel {}, client will only listen.".format(self.channel))
                 self._channel_timeout = None
 
+    def _on_new_client_clear_to_send(self, msg):
+        self.log.debug("Requesting channel...")
+        self._send_internal(messages.ChannelAssignmentRequest(bytes([0x02, 0xF1, 0x73]))); # TODO: Determine meaning of these bytes (probably unique)
+
+    def _on_channel_assignment_response(self, msg):
+        self.channel = msg.arguments[0];
+        self._set_channel(self.channel)
+        self.log.debug("Acknowledging assignment to channel {}".format(self.channel))
+        self._send_internal(messages.ChannelAssignmentAcknowlegement(self.channel))
+
+    def _set_channel(self, channel):
+        """ Encode the replies to the master's polls on channel once. """
+        self._nothing_to_send = bytes(messages.NothingToSend(channel))
+        self._existing_client_response = bytes(
+            messages.ExistingClientResponse(channel, bytes([0x04, 0x08, 0x00])))
+        self._reply_channel = channel
+
+    def _on_frame(self, frame, received):
+        """ Answer Clear To Send and Existing Client polls on our channel.
+
+        Called by the protocol for every frame as it arrives, ahead of
+        decoding, since the reply has to make the bus reply window.  Only
+        the channel and type code bytes are looked at, and unless a queued
+        message is due the reply is a pre-encoded frame.
+        """
+        if frame[2] != self._reply_channel:
+            return
+        type_code = frame[4]
+        if type_code == CLEAR_TO_SEND:
+            msg = self.scheduler.pop()
+            if msg is None:
+                self._write(self._nothing_to_send)
+            else:
+                if msg.channel is None:
+                    msg.channel = self.channel
+                self._write(bytes(msg))
+                self.log.debug(msg.__class__.__name__ + " sent on channel {}".format(msg.channel))
+        elif type_code == EXISTING_CLIENT_REQUEST:
+            self._write(self._existing_client_response)
+        else:
+            return
+        self.cts_latency.record(time.perf_counter() - received)
+
     def on_message(self, msg: messages.Message):
         pass
 
@@ -69,11 +150,27 @@ class Client:
     def request_settings(self, settings_code):
         self.send(messages.SettingsRequest(self.channel, settings_code))
 
-    def send(self, msg: messages.Message):
-        self.queue.put(msg)
+    def send(self, msg: messages.Message, priority=None, deadline=None):
+        """ Queue msg for the next Clear To Send, see CommandScheduler.
+
+        Returns a future resolved once the message is sent.  May be called
+        from other threads (MQTT callbacks), in which case the message is
+        handed to the event loop and None is returned.
+        """
+        if threading.get_ident() != self._loop_thread:
+            self._loop.call_soon_threadsafe(self.send, msg, priority, deadline)
+            return None
+        future = self.scheduler.push(msg, priority, deadline)
         self.log.debug(msg.__class__.__name__ + " queued on channel {}".format(msg.channel))
+        if self.events.wants(CommandCompleted):
+            future.add_done_callback(
+                lambda f: self.events.publish(CommandCompleted.from_future(self, msg, f)))
+        return future
 
     def _send_internal(self, msg: messages.Message):
+        self._write(bytes(msg))
+
+    def _write(self, data):
         raise NotImplementedError()
 
     def set_filter_cycles(self, start1: datetime.time, duration1: datetime.timedelta, *, start2: datetime.time=None, duration2: datetime.timedelta=None):
@@ -118,112 +215,121 @@ class SerialClient(Client):
     def __init__(self, dev, channel=None):
         import serial
         super().__init__(channel)
-        self._s = serial.Serial(dev, baudrate=115200)
+        self._s = serial.Serial(dev, baudrate=115200, timeout=0)
+        self.protocol = BalboaProtocol(on_frame=self._on_frame)
+        self.transport = SerialTransport(asyncio.get_event_loop(), self.protocol, self._s)
+
+    async def close(self):
+        await super().close()
+        self.transport.close()
 
     async def recv(self):
-        import serial
         while True:
+            frame = await self.protocol.read_frame()
+            if frame is None: # Port was closed
+                return None
             try:
-                b = self._s.read_until(bytes([messages.Message.DELIMITER])) # Start of message
-                b += self._s.read(1) # Read in length
-                if b[1] == messages.Message.DELIMITER: # Check if first read was actually end of previous message
-                    b = b[1:2] + self._s.read(1) # Drop first delimiter, read in length
-                b += self._s.read(b[1]) # Read rest of message
-            except serial.serialutil.SerialException as e:
-                self.log.error(e);
-                time.sleep(1) # Errors are usually recoverable after waiting
-                continue
-            try:
-                msg = messages.Message.from_bytes(b)
+                msg = messages.decode(frame)
             except ValueError:
                 continue
             return msg
 
-    def _send_internal(self, msg):
-        self._s.write(bytes(msg))
+    def _write(self, data):
+        self.transport.write(data)
 
 
 class TcpClient(Client):
+    """ Client for the spa's Wi-Fi module.
+
+    Connecting happens in the background: the connection checker task
+    connects straight away and reconnects with jittered exponential backoff
+    whenever the link drops.  Use TcpClient.open() or async with to wait
+    for the first connection.
+    """
 
     DEFAULT_CHANNEL = 0x0A
     DEFAULT_PORT = 4257
+    CONNECT_TIMEOUT = CONNECT_TIMEOUT
+    # Seconds without data from the spa before the connection is dropped
+    READ_TIMEOUT = 30.0
 
     def __init__(self, host, port=DEFAULT_PORT):
         self.host = host
         self.port = port
-        self.connected = False
-        asyncio.get_event_loop().run_until_complete(self.connect())
-        asyncio.get_event_loop().run_until_complete(self.check_connection())
+        self.transport = None
+        self.protocol = None
+        self._connected = asyncio.Event()
+        self._backoff = Backoff()
         super().__init__(self.DEFAULT_CHANNEL)
+        self.tasks.start(self.check_connection())
+
+    @property
+    def connected(self):
+        return self._connected.is_set()
+
+    async def wait_connected(self):
+        await asyncio.wait_for(self._connected.wait(), self.CONNECT_TIMEOUT)
 
     async def connect(self):
         """ Connect to the spa."""
         try:
-            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
-        except (asyncio.TimeoutError, ConnectionRefusedError):
-            self.log.error("Cannot connect to spa at {0}:{1}".format(self.host, self.port))
+            self.transport, self.protocol = await open_connection(
+                lambda: BalboaProtocol(self._connection_lost, self._on_frame, self.READ_TIMEOUT),
+                self.host, self.port, self.CONNECT_TIMEOUT)
+        except (asyncio.TimeoutError, OSError) as e:
+            self.log.error("Cannot connect to spa at {0}:{1}: {2!r}".format(self.host, self.port, e))
             return False
-        self.connected = True
+        self._connected.set()
+        self.events.publish(ConnectionUp(self))
         return True
 
     async def check_connection(self):
-        """ Set this up to periodically check the spa connection and fix. """
+        """ Keep the spa connected, backing off between failed attempts. """
         while True:
-            if not self.connected:
+            if await self.connect():
+                await self.protocol.wait_closed()
                 self.log.error("Lost connection to spa, attempting reconnect.")
-                await self.connect()
-            await asyncio.sleep(10)
+            await self._backoff.wait()
 
     async def disconnect(self):
         """ Stop talking to the spa."""
         self.log.info("Disconnect requested")
-        self.connected = False
-        self.writer.close()
-        await self.writer.wait_closed()
+        if self.connected:
+            self._connected.clear()
+            self.events.publish(ConnectionDown(self))
+        if self.protocol is None:
+            return
+        self.protocol.close()
+        await self.protocol.wait_closed()
+
+    async def close(self):
+        await super().close()
+        await self.disconnect()
+
+    def _connection_lost(self, exc):
+        if exc is not None:
+            self.log.error('Spa connection lost: {0}'.format(str(exc)))
+        if self.connected:
+            self._connected.clear()
+            self.events.publish(ConnectionDown(self, exc))
 
     async def recv(self):
         while True:
             if not self.connected:
-                await asyncio.sleep(1)
+                await self._connected.wait()
                 continue
-            try:
-                header = await self.reader.readexactly(2)
-            except SocketError as err:
-                if err.errno == errno.ECONNRESET:
-                    self.log.error('Connection reset by peer')
-                    self.connected = False
-                if err.errno == errno.EHOSTUNREACH:
-                    self.log.error('Spa unreachable')
-                    self.connected = False
-                else:
-                    self.log.error('Spa socket error: {0}'.format(str(err)))
+            frame = await self.protocol.read_frame()
+            if frame is None:
                 continue
-            except Exception as e:
-                self.log.error('Spa read failed: {0}'.format(str(e)))
-                continue
-
-            if header[0] == messages.Message.DELIMITER:
-                # header[1] is size, + checksum + messages.Message.DELIMITER (we already read 2 tho!)
-                rlen = header[1]
-            else:
-                continue
-
-            # now get the rest of the data
-            try:
-                data = await self.reader.readexactly(rlen)
-            except Exception as e:
-                self.log.error('Spa read failed: {0}'.format(str(e)))
-                continue
-
-            full_data = header + data
+            if self._backoff.attempts:
+                self._backoff.reset()
             try:
-                msg = messages.Message.from_bytes(full_data)
+                msg = messages.decode(frame)
             except ValueError:
                 continue
             return msg
 
-    def _send_internal(self, msg):
+    def _write(self, data):
         if not self.connected:
             return
-        self.writer.write(bytes(msg))
-        asyncio.get_event_loop().run_until_complete(self.writer.drain())
+        self.protocol.write(data)
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import random
+import socket
+
+CONNECT_TIMEOUT = 10.0
+
+# TCP keepalive: probe after KEEPALIVE_IDLE seconds of silence, every
+# KEEPALIVE_INTERVAL seconds, and give up after KEEPALIVE_COUNT probes, so a
+# spa that vanished off the Wi-Fi is noticed even while we are not writing.
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+log = logging.getLogger(__name__)
+
+
+def set_keepalive(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT):
+    """ Enable TCP keepalive on sock, with the timings where supported. """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (("TCP_KEEPIDLE", idle), ("TCP_KEEPINTVL", interval), ("TCP_KEEPCNT", count)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+async def open_connection(protocol_factory, host, port, timeout=CONNECT_TIMEOUT):
+    """ Connect to host:port with a timeout and keepalive enabled.
+
+    Returns (transport, protocol).  Raises asyncio.TimeoutError or OSError.
+    """
+    loop = asyncio.get_event_loop()
+    transport, protocol = await asyncio.wait_for(
+        loop.create_connection(protocol_factory, host, port), timeout)
+    sock = transport.get_extra_info("socket")
+    if sock is not None:
+        try:
+            set_keepalive(sock)
+        except OSError as e:
+            log.warning("Cannot enable keepalive: {0}".format(e))
+    return transport, protocol
+
+
+class Backoff:
+    """ Exponential backoff with full jitter.
+
+    Each delay() is uniform between 0 and BASE * 2**attempts, capped at
+    CAP, so a fleet of clients that lost the network together does not
+    come back in lockstep.  reset() after a success.
+    """
+
+    BASE = 1.0
+    CAP = 300.0
+
+    def __init__(self, base=BASE, cap=CAP):
+        self.base = base
+        self.cap = cap
+        self.attempts = 0
+
+    def delay(self):
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** self.attempts))
+        self.attempts += 1
+        return delay
+
+    def reset(self):
+        self.attempts = 0
+
+    async def wait(self):
+        await asyncio.sleep(self.delay())
+
+
+class TaskSet:
+    """ Background tasks owned by one object.
+
+    Tasks are kept until they finish, failures are logged, and close()
+    cancels whatever is still running and waits for it to unwind.  Tasks
+    started with owned=True are handed to a caller who collects their
+    result, so their failures are left to it.
+    """
+
+    def __init__(self):
+        self._tasks = set()
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def start(self, coro, owned=False):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard if owned else self._done)
+        return task
+
+    def _done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.error("Background task failed: {0!r}".format(task.exception()))
+
+    async def close(self):
+        tasks = [task for task in self._tasks if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,219 @@
+import asyncio
+import concurrent.futures
+import inspect
+import logging
+
+from pybalboa.connection import TaskSet
+
+log = logging.getLogger(__name__)
+
+
+class Event:
+    """ Base of everything published on an EventBus.  source is the spa or
+    client the event is about, source_id the name its bus was given (the
+    spa ID in a SpaFleet). """
+
+    __slots__ = ("source", "source_id")
+
+    def __init__(self, source):
+        self.source = source
+        self.source_id = None
+
+    def __repr__(self):
+        return "{0}({1})".format(self.__class__.__name__, ", ".join(
+            "{0}={1!r}".format(name, getattr(self, name))
+            for cls in type(self).__mro__ for name in getattr(cls, "__slots__", ())))
+
+
+class FrameReceived(Event):
+    """ A frame arrived: the decoded Message for clients, the frame bytes
+    for BalboaSpaWifi. """
+
+    __slots__ = ("message",)
+
+    def __init__(self, source, message):
+        super().__init__(source)
+        self.message = message
+
+
+class StateChanged(Event):
+    """ A status update changed the named attributes (see status_attrs);
+    state is the spa's SpaState after it, when known. """
+
+    __slots__ = ("changed", "state")
+
+    def __init__(self, source, changed, state=None):
+        super().__init__(source)
+        self.changed = changed
+        self.state = state
+
+
+class ConnectionUp(Event):
+    __slots__ = ()
+
+
+class ConnectionDown(Event):
+    """ The connection went away; exc is why, None if we closed it. """
+
+    __slots__ = ("exc",)
+
+    def __init__(self, source, exc=None):
+        super().__init__(source)
+        self.exc = exc
+
+
+class CommandCompleted(Event):
+    """ A command finished.  command is what was asked for (an apply()
+    target, or the Message sent by a client), result the future's result
+    and error its exception, if any. """
+
+    __slots__ = ("command", "result", "error")
+
+    def __init__(self, source, command, result=None, error=None):
+        super().__init__(source)
+        self.command = command
+        self.result = result
+        self.error = error
+
+    @classmethod
+    def from_future(cls, source, command, future):
+        if future.cancelled():
+            return cls(source, command, error=asyncio.CancelledError())
+        if future.exception() is not None:
+            return cls(source, command, error=future.exception())
+        return cls(source, command, result=future.result())
+
+
+class _Subscriber:
+    __slots__ = ("event_type", "handler", "blocking", "match", "queue", "task", "dropped")
+
+    def __init__(self, event_type, handler, blocking, maxsize, match):
+        self.event_type = event_type
+        self.handler = handler
+        self.blocking = blocking
+        self.match = match
+        # Inline handlers have no queue
+        self.queue = None
+        if blocking or inspect.iscoroutinefunction(handler):
+            self.queue = asyncio.Queue(maxsize)
+        self.task = None
+        self.dropped = 0
+
+
+class EventBus:
+    """ Typed publish/subscribe for the events above.
+
+    Handlers subscribe to an event class and receive it and its
+    subclasses.  Plain functions run inline in publish(), so they must be
+    quick.  Coroutine functions, and functions subscribed with
+    blocking=True, get their own queue of up to maxsize events and a
+    worker task that runs them in order: coroutines on the loop, blocking
+    functions on the bus's thread pool.  When a queue is full the oldest
+    event is dropped, so a slow handler falls behind on its own without
+    holding up the protocol or the other subscribers; maxsize=0 never
+    drops, for events too rare to fill it.  A match function narrows the
+    subscription further, events it returns false for are skipped before
+    they are queued.  Handler exceptions are logged.  Runs on the event
+    loop only.
+
+    A bus with a parent also hands every event on to it, stamped with
+    source_id, so many buses can feed one stream.
+    """
+
+    MAXSIZE = 100
+
+    def __init__(self, executor=None, parent=None, source_id=None):
+        self.parent = parent
+        self.source_id = source_id
+        self._subscribers = []
+        # event class -> subscribers receiving it
+        self._routes = {}
+        self._executor = executor
+        self._own_executor = False
+        self.tasks = TaskSet()
+
+    def subscribe(self, event_type, handler, blocking=False, maxsize=MAXSIZE, match=None):
+        """ Call handler(event) for every event_type published, or only
+        those match(event) is true for.  Returns a function that cancels
+        the subscription.
+        """
+        sub = _Subscriber(event_type, handler, blocking, maxsize, match)
+        self._subscribers.append(sub)
+        self._routes.clear()
+
+        def unsubscribe():
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+                self._routes.clear()
+                if sub.task is not None:
+                    sub.task.cancel()
+        return unsubscribe
+
+    def wants(self, event_type):
+        """ Whether publishing an event_type would reach anyone, so
+        publishers can skip building events nobody listens to. """
+        return bool(self._route(event_type)) or (
+            self.parent is not None and self.parent.wants(event_type))
+
+    def _route(self, event_type):
+        subs = self._routes.get(event_type)
+        if subs is None:
+            subs = self._routes[event_type] = tuple(
+                sub for sub in self._subscribers if issubclass(event_type, sub.event_type))
+        return subs
+
+    def publish(self, event):
+        if self.source_id is not None:
+            event.source_id = self.source_id
+        for sub in self._route(type(event)):
+            if sub.match is not None and not sub.match(event):
+                continue
+            if sub.queue is None:
+                try:
+                    sub.handler(event)
+                except Exception:
+                    log.exception("Event handler failed for {0!r}".format(event))
+                continue
+            if sub.queue.full():
+                sub.queue.get_nowait()
+                sub.dropped += 1
+            sub.queue.put_nowait(event)
+            if sub.task is None:
+                sub.task = self.tasks.start(self._worker(sub))
+        if self.parent is not None:
+            self.parent.publish(event)
+
+    def stats(self):
+        return {
+            "subscribers": len(self._subscribers),
+            "queued": sum(sub.queue.qsize() for sub in self._subscribers if sub.queue is not None),
+            "dropped": sum(sub.dropped for sub in self._subscribers),
+        }
+
+    async def _worker(self, sub):
+        loop = asyncio.get_event_loop()
+        while True:
+            event = await sub.queue.get()
+            try:
+                if sub.blocking:
+                    await loop.run_in_executor(self._get_executor(), sub.handler, event)
+                else:
+                    await sub.handler(event)
+            except Exception:
+                log.exception("Event handler failed for {0!r}".format(event))
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix="pybalboa-events")
+            self._own_executor = True
+        return self._executor
+
+    async def close(self):
+        """ Stop the workers, dropping queued events. """
+        await self.tasks.close()
+        for sub in self._subscribers:
+            sub.task = None
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+            self._own_executor = False
@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import time
+
+import pybalboa.watchdog as watchdog
+from pybalboa.balboa import BALBOA_DEFAULT_PORT, BalboaSpaWifi
+from pybalboa.connection import Backoff, TaskSet
+from pybalboa.events import ConnectionDown, ConnectionUp, EventBus
+
+log = logging.getLogger(__name__)
+
+
+class SpaHealth:
+    """ Connection state of one spa in a SpaFleet.
+
+    state is "idle" until started, then "connecting", "up" or "down"
+    (waiting to retry), and "closed" once removed.  since is when it
+    entered that state (time.monotonic()).
+    """
+
+    __slots__ = ("state", "since", "connects", "failures", "disconnects")
+
+    def __init__(self):
+        self.state = "idle"
+        self.since = time.monotonic()
+        self.connects = 0
+        self.failures = 0
+        self.disconnects = 0
+
+    def _set(self, state):
+        self.state = state
+        self.since = time.monotonic()
+
+    def __repr__(self):
+        return "SpaHealth({0}, {1:.0f} s, connects={2}, failures={3}, disconnects={4})".format(
+            self.state, time.monotonic() - self.since, self.connects, self.failures, self.disconnects)
+
+
+class SpaFleet:
+    """ Many spas on one event loop.
+
+    Each spa keeps only its listen() task.  Reconnecting, which a lone
+    BalboaSpaWifi does in its own check_connection_status() task, is a
+    timer on the shared watchdog wheel here, and at most MAX_CONNECTING
+    connection attempts are in flight at once, so a fleet coming back
+    after a network outage does not open hundreds of sockets together.
+
+    Every spa's events are handed on to fleet.events with source_id set
+    to the spa's ID.  health[spa_id] is its SpaHealth, and stats() sums
+    frame counters across the fleet.  Given a pybalboa.store.StateStore,
+    every spa's status is kept in it for vectorized queries.
+
+        async with SpaFleet() as fleet:
+            fleet.add("cabin-3", "10.0.3.20")
+            fleet.events.subscribe(StateChanged, on_change)
+            ...
+    """
+
+    MAX_CONNECTING = 20
+
+    def __init__(self, max_connecting=MAX_CONNECTING, cache=None, store=None):
+        self.cache = cache
+        self.store = store
+        self.spas = {}
+        self.health = {}
+        self.events = EventBus()
+        self.tasks = TaskSet()
+        self._connecting = asyncio.Semaphore(max_connecting)
+        self._retries = {}
+        self._backoff = {}
+        self._running = False
+        self._last_stats = (time.monotonic(), 0)
+        self.events.subscribe(ConnectionUp, self._on_up)
+        self.events.subscribe(ConnectionDown, self._on_down)
+
+    def __len__(self):
+        return len(self.spas)
+
+    def __iter__(self):
+        return iter(self.spas)
+
+    def __getitem__(self, spa_id):
+        return self.spas[spa_id]
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def add(self, spa_id, host, port=BALBOA_DEFAULT_PORT):
+        """ Add a spa, connecting it if the fleet is running. """
+        if spa_id in self.spas:
+            raise ValueError("Spa {0!r} is already in the fleet".format(spa_id))
+        spa = BalboaSpaWifi(host, port, cache=self.cache)
+        spa.events.parent = self.events
+        spa.events.source_id = spa_id
+        self.spas[spa_id] = spa
+        self.health[spa_id] = SpaHealth()
+        self._backoff[spa_id] = Backoff()
+        if self.store is not None:
+            self.store.attach(spa, spa_id)
+        if self._running:
+            self._start_spa(spa_id)
+        return spa
+
+    async def remove(self, spa_id):
+        """ Disconnect a spa and forget it. """
+        spa = self.spas.pop(spa_id)
+        self._cancel_retry(spa_id)
+        del self._backoff[spa_id]
+        self.health.pop(spa_id)._set("closed")
+        if self.store is not None:
+            self.store.detach(spa, spa_id)
+        await spa.close()
+
+    def start(self):
+        """ Start connecting every spa; returns at once. """
+        self._running = True
+        for spa_id in self.spas:
+            if self.health[spa_id].state == "idle":
+                self._start_spa(spa_id)
+
+    async def close(self):
+        self._running = False
+        for spa_id in list(self._retries):
+            self._cancel_retry(spa_id)
+        await self.tasks.close()
+        await asyncio.gather(*(spa.close() for spa in self.spas.values()),
+                             return_exceptions=True)
+        for health in self.health.values():
+            health._set("closed")
+        await self.events.close()
+
+    def _start_spa(self, spa_id):
+        self.spas[spa_id].tasks.start(self.spas[spa_id].listen())
+        self.tasks.start(self._connect(spa_id))
+
+    async def _connect(self, spa_id):
+        spa = self.spas.get(spa_id)
+        if spa is None or spa.connected:
+            return
+        health = self.health[spa_id]
+        health._set("connecting")
+        async with self._connecting:
+            if self.spas.get(spa_id) is not spa:
+                return
+            connected = await spa.connect()
+        if connected:
+            # ConnectionUp already marked it up
+            health.connects += 1
+            return
+        health.failures += 1
+        health._set("down")
+        self._retry(spa_id)
+
+    def _retry(self, spa_id):
+        """ Schedule the next connection attempt, after the spa's backoff,
+        which is reset once it is up again. """
+        if not self._running or spa_id not in self.spas or spa_id in self._retries:
+            return
+        delay = self._backoff[spa_id].delay()
+        self._retries[spa_id] = watchdog.shared().wheel.schedule(
+            delay, lambda: self._retry_due(spa_id))
+
+    def _retry_due(self, spa_id):
+        self._retries.pop(spa_id, None)
+        if self._running:
+            self.tasks.start(self._connect(spa_id))
+
+    def _cancel_retry(self, spa_id):
+        timer = self._retries.pop(spa_id, None)
+        if timer is not None:
+            watchdog.shared().wheel.cancel(timer)
+
+    def _on_up(self, event):
+        health = self.health.get(event.source_id)
+        if health is not None:
+            health._set("up")
+            self._backoff[event.source_id].reset()
+
+    def _on_down(self, event):
+        health = self.health.get(event.source_id)
+        if health is None or health.state == "closed":
+            return
+        health.disconnects += 1
+        health._set("down")
+        self._retry(event.source_id)
+
+    def stats(self):
+        """ Fleet wide counters; frames_per_second is since the last call. """
+        now = time.monotonic()
+        frames = sum(spa.frames_received for spa in self.spas.values())
+        last_time, last_frames = self._last_stats
+        self._last_stats = (now, frames)
+        states = {}
+        for health in self.health.values():
+            states[health.state] = states.get(health.state, 0) + 1
+        return {
+            "spas": len(self.spas),
+            "states": states,
+            "frames": frames,
+            "frames_per_second": (frames - last_frames) / (now - last_time) if now > last_time else 0.0,
+            "events_dropped": self.events.stats()["dropped"],
+        }
@@ -7,8 +7,28 @@ import paho.mqtt.client
 import pyhomie
 
 import pybalboa.clients as clients
+import pybalboa.events as events
 import pybalboa.messages as messages
 
+decode_status = messages.StatusUpdate.SCHEMA.compile().as_dict
+
+pump_text = ["off", "low", "high", "high"]
+
+# Answers to the requests in Node.connect(), sent once each
+responses = frozenset((
+    messages.ConfigurationResponse.TYPE_CODE,
+    messages.InformationResponse.TYPE_CODE,
+    messages.FilterCyclesResponse.TYPE_CODE,
+    messages.PreferencesResponse.TYPE_CODE,
+))
+
+heating_mode_text = {
+    messages.StatusUpdate.HEATING_MODE_READY: "ready",
+    messages.StatusUpdate.HEATING_MODE_REST: "rest",
+    messages.StatusUpdate.HEATING_MODE_READY_IN_REST: "ready-in-rest",
+}
+
+
 class Node(pyhomie.Node):
 
     def __init__(self, balboa_client: clients.Client, id, name, type):
@@ -50,7 +70,21 @@ class Node(pyhomie.Node):
 
         super().__init__(id, name, type, properties)
         self.balboa_client = balboa_client
-        self.balboa_client.on_message = self.on_balboa_message
+        # MQTT publishing can block, keep it off the event loop.  Only the
+        # frames handled below are queued; status updates may be dropped
+        # when MQTT falls behind, as a newer one follows, the one-shot
+        # responses never are.
+        bus = self.balboa_client.events
+        self._unsubscribe = (
+            bus.subscribe(events.FrameReceived, self.on_balboa_event, blocking=True,
+                          match=lambda e: e.message.type_code == messages.StatusUpdate.TYPE_CODE),
+            bus.subscribe(events.FrameReceived, self.on_balboa_event, blocking=True, maxsize=0,
+                          match=lambda e: e.message.type_code in responses),
+        )
+
+    def unsubscribe(self):
+        for unsubscribe in self._unsubscribe:
+            unsubscribe()
 
     def connect(self, device):
         super().connect(device)
@@ -59,54 +93,30 @@ class Node(pyhomie.Node):
         self.balboa_client.request_filter_cycles()
         self.device.publish("$state", "ready")
 
+    def on_balboa_event(self, event: events.FrameReceived):
+        self.on_balboa_message(event.message)
+
     def on_balboa_message(self, msg: messages.Message):
         if self.device is None:
             return
         if msg.type_code == messages.StatusUpdate.TYPE_CODE:
             self.publish("status", "".join(map("{:02X}".format, msg.arguments)))
-            if msg.arguments[11] & 0x03 == 0:
-                self.properties["pump-1"].value = "off"
-            elif msg.arguments[11] & 0x03 == 1:
-                self.properties["pump-1"].value = "low"
-            else:
-                self.properties["pump-1"].value = "high"
-            if msg.arguments[11] & 0x0C == 0:
-                self.properties["pump-2"].value = "off"
-            elif msg.arguments[11] & 0x0C == 0x04:
-                self.properties["pump-2"].value = "low"
-            else:
-                self.properties["pump-2"].value = "high"
-            if msg.arguments[11] & 0x30 == 0:
-                self.properties["pump-3"].value = "off"
-            elif msg.arguments[11] & 0x30 == 0x10:
-                self.properties["pump-3"].value = "low"
-            else:
-                self.properties["pump-3"].value = "high"
-            if msg.arguments[11] & 0xC0 == 0:
-                self.properties["pump-4"].value = "off"
-            elif msg.arguments[11] & 0xC0 == 0x40:
-                self.properties["pump-4"].value = "low"
-            else:
-                self.properties["pump-4"].value = "high"
-            if msg.arguments[2] == 0xFF:
-                self.properties["current-temperature"] = None
+            status = decode_status(msg.arguments)
+            for n in range(1, 7):
+                self.properties["pump-{}".format(n)].value = pump_text[status["pump_{}".format(n)]]
+            if status["current_temperature"] == 0xFF:
+                self.properties["current-temperature"].value = None
+            elif status["temperature_scale"] == 1:
+                self.properties["current-temperature"].value = float(status["current_temperature"]) / 2
             else:
-                if self.properties["temperature-scale"].value == "Celsius":
-                    self.properties["current-temperature"] = float(msg.arguments[2]) / 2
-                else:
-                    self.properties["current-temperature"] = float(msg.arguments[2])
-            self.properties["time"].value = datetime.datetime.combine(datetime.date.today(), datetime.time(msg.arguments[3], msg.arguments[4]))
-            if msg.arguments[5] == 0:
-                self.properties["heating-mode"].value = "ready"
-            if msg.arguments[5] == 1:
-                self.properties["heating-mode"].value = "rest"
-            if msg.arguments[5] == 3:
-                self.properties["heating-mode"].value = "ready-in-rest"
-            self.properties["circulation-pump"].value = msg.arguments[13] & 0x02 == 0x02
-            self.properties["blower"].value = msg.arguments[13] & 0xC0 == 0xC0
-            self.properties["light-1"].value = msg.arguments[14] & 0x03 == 0x03
-            self.properties["light-2"].value = msg.arguments[14] & 0x0C == 0x0C
-            self.properties["set-temperature"].value = msg.arguments[20]
+                self.properties["current-temperature"].value = float(status["current_temperature"])
+            self.properties["time"].value = datetime.datetime.combine(datetime.date.today(), datetime.time(status["hours"], status["minutes"]))
+            self.properties["heating-mode"].value = heating_mode_text[status["heating_mode"]]
+            self.properties["circulation-pump"].value = status["circulation_pump"] == 1
+            self.properties["blower"].value = status["blower"] != 0
+            self.properties["light-1"].value = status["light_1"] == 1
+            self.properties["light-2"].value = status["light_2"] == 1
+            self.properties["set-temperature"].value = status["set_temperature"]
         elif msg.type_code == messages.FilterCyclesResponse.TYPE_CODE:
             self.publish("filter-cycles", "".join(map("{:02X}".format, msg.arguments)))
         elif msg.type_code == messages.InformationResponse.TYPE_CODE:
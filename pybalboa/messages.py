@@ -2,7 +2,43 @@
 import datetime
 from enum import IntEnum, unique
 import re
-import struct
+
+from pybalboa.schema import Field, Schema
+
+
+def field_property(schema, name):
+    """ Read-only property decoding one schema field from the arguments. """
+    get = schema.getter(name)
+    return property(lambda msg: get(msg.arguments))
+
+
+class cached_field:
+    """ Read-only message field decoded once, on first access.
+
+    Use instead of @property for fields that are costly to decode (strings,
+    dates); the value is kept on the message until its arguments change.
+    """
+
+    def __init__(self, fget):
+        self.fget = fget
+        self.name = fget.__name__
+        self.__doc__ = fget.__doc__
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, msg, owner=None):
+        if msg is None:
+            return self
+        cache = msg._cache
+        if cache is None:
+            cache = msg._cache = {}
+        try:
+            return cache[self.name]
+        except KeyError:
+            value = cache[self.name] = self.fget(msg)
+            return value
+
 
 class Message(object):
 
@@ -28,33 +64,95 @@ class Message(object):
 
     DELIMITER = 0x7e
 
+    __slots__ = ("_channel", "_type_code", "_arguments", "_frame", "_cache")
+
+    # Shared instances handed out by interned()
+    _interned = {}
+
+    # Registered subclasses, indexed by type code then channel class
+    _registry = [None] * 256
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if "TYPE_CODE" not in cls.__dict__:
+            return  # Specializations share their parent's registration
+        by_channel = Message._registry[cls.TYPE_CODE]
+        if by_channel is None:
+            by_channel = Message._registry[cls.TYPE_CODE] = {}
+        by_channel.setdefault(getattr(cls, "CHANNEL", None), cls)
+
     def __init__(self, *, channel, type_code, arguments=bytes()):
-        self.channel = channel
-        self.type_code = type_code
-        self.arguments = arguments
+        self._frame = None
+        self._cache = None
+        self._channel = channel
+        self._type_code = type_code
+        self._arguments = arguments
+
+    @classmethod
+    def interned(cls, *args):
+        """ Return a shared, pre-encoded instance built from args.
+
+        Meant for frames that are sent over and over (NothingToSend,
+        ExistingClientResponse, toggles); the returned instance is shared
+        and must not be modified.
+        """
+        key = (cls, args)
+        msg = Message._interned.get(key)
+        if msg is None:
+            msg = Message._interned[key] = cls(*args)
+            bytes(msg)
+        return msg
+
+    @property
+    def channel(self):
+        return self._channel
+
+    @channel.setter
+    def channel(self, channel):
+        self._channel = channel
+        self._frame = None
+
+    @property
+    def type_code(self):
+        return self._type_code
+
+    @type_code.setter
+    def type_code(self, type_code):
+        self._type_code = type_code
+        self._frame = None
+
+    @property
+    def arguments(self):
+        return self._arguments
+
+    @arguments.setter
+    def arguments(self, arguments):
+        self._arguments = arguments
+        self._frame = None
+        self._cache = None
 
     def __bytes__(self):
-        b = bytes([len(self.arguments) + 5])
-        b += bytes([self.channel])
-        b += bytes([0xAF if self.channel == self.BROADCAST_CHANNEL else 0xBF])
-        b += bytes([self.type_code])
-        b += self.arguments
-        return bytes([self.DELIMITER]) + b + bytes([Message.crc(b), self.DELIMITER])
+        frame = self._frame
+        if frame is None:
+            b = bytearray((
+                self.DELIMITER,
+                len(self._arguments) + 5,
+                self._channel,
+                0xAF if self._channel == self.BROADCAST_CHANNEL else 0xBF,
+                self._type_code
+            ))
+            b += self._arguments
+            b.append(Message.crc(memoryview(b)[1:]))
+            b.append(self.DELIMITER)
+            frame = self._frame = bytes(b)
+        return frame
 
     def __iter__(self):
-        self._cursor = 0
-        return self
+        return iter(bytes(self))
 
     def __len__(self):
         return bytes(self)[1]
 
-    def __next__(self):
-        if self._cursor >= len(bytes(self)):
-            raise StopIteration
-        b = bytes(self)[self._cursor]
-        self._cursor += 1
-        return b
-
     @staticmethod
     def crc(data):
         crc = 0x02; # XOR In
@@ -64,11 +162,19 @@ class Message(object):
 
     @classmethod
     def from_bytes(cls, b):
-        b = bytes(b)
+        """ Decode a frame.
+
+        The returned message is a view over b: its arguments are a
+        memoryview into the frame and fields are only decoded when read.
+        """
+        if not isinstance(b, (bytes, memoryview)):
+            b = bytes(b)
+        b = memoryview(b)
         if b[0] != Message.DELIMITER or b[-1] != Message.DELIMITER:
             raise ValueError("Messages must start and end with Message.DELIMITER")
         b = b[1:-1]
-        if len(b) < 5 or b[0] != len(b) or (hasattr(cls, "LENGTH") and b[0] != cls.LENGTH):
+        if (len(b) < 5 or b[0] != len(b) or (hasattr(cls, "LENGTH") and b[0] != cls.LENGTH) or
+                (hasattr(cls, "MIN_LENGTH") and b[0] < cls.MIN_LENGTH)):
             raise ValueError("Invalid length for " + cls.__name__)
         if hasattr(cls, "CHANNEL") and b[1] != cls.CHANNEL:
             raise ValueError("Invalid channel for " + cls.__name__)
@@ -76,26 +182,47 @@ class Message(object):
             raise ValueError("Invalid message type code for " + cls.__name__)
         if b[-1] != cls.crc(b[:-1]):
             raise ValueError("Invalid checksum")
-        return Message(channel=b[1], type_code=b[3], arguments=b[4:-1])
+        msg_cls = Message.lookup(b[1], b[3], b[0]) if cls is Message else cls
+        msg = msg_cls.__new__(msg_cls)
+        Message.__init__(msg, channel=b[1], type_code=b[3], arguments=b[4:-1])
+        return msg
+
+    @staticmethod
+    def lookup(channel, type_code, length=None):
+        """ Return the registered class for a channel and type code.
+
+        Classes with a CHANNEL (0xFE or 0xFF) only match that channel, the
+        others match any client channel.  Falls back to Message when nothing
+        is registered or the length does not match.
+        """
+        by_channel = Message._registry[type_code]
+        if by_channel is None:
+            return Message
+        msg_cls = by_channel.get(channel if channel >= 0xFE else None)
+        if msg_cls is None:
+            msg_cls = by_channel.get(None, Message)
+        if length is not None and (getattr(msg_cls, "LENGTH", length) != length or
+                getattr(msg_cls, "MIN_LENGTH", length) > length):
+            return Message
+        return msg_cls
 
 
 class NewClientClearToSend(Message):
 
+    __slots__ = ()
+
     TYPE_CODE = 0x00
     LENGTH = 5
     CHANNEL = 0xFE
 
     def __init__(self):
-        super().__init__(type_code=self.TYPE, channel=self.CHANNEL)
-
-    @classmethod
-    def from_bytes(cls, b):
-        msg = super().from_bytes(b)
-        return NewClientClearToSend()
+        super().__init__(type_code=self.TYPE_CODE, channel=self.CHANNEL)
 
 
 class ChannelAssignmentRequest(Message):
 
+    __slots__ = ()
+
     TYPE_CODE = 0x01
     CHANNEL = 0xFE
     LENGTH = 8
@@ -106,6 +233,8 @@ class ChannelAssignmentRequest(Message):
 
 class ChannelAssignmentResponse(Message):
 
+    __slots__ = ()
+
     TYPE_CODE = 0x02
     CHANNEL = 0xFE
     LENGTH = 8
@@ -116,6 +245,8 @@ class ChannelAssignmentResponse(Message):
 
 class ChannelAssignmentAcknowlegement(Message):
 
+    __slots__ = ()
+
     TYPE_CODE = 0x03
     LENGTH = 5
 
@@ -125,6 +256,8 @@ class ChannelAssignmentAcknowlegement(Message):
 
 class ExistingClientRequest(Message):
 
+    __slots__ = ()
+
     TYPE_CODE = 0x04
     LENGTH = 5
 
@@ -134,6 +267,8 @@ class ExistingClientRequest(Message):
 
 class ExistingClientResponse(Message):
 
+    __slots__ = ()
+
     TYPE_CODE = 0x05
     LENGTH = 0x08
 
@@ -143,34 +278,30 @@ class ExistingClientResponse(Message):
 
 class ClientClearToSend(Message):
 
+    __slots__ = ()
+
     TYPE_CODE = 0x06
     LENGTH = 5
 
     def __init__(self, channel):
         super().__init__(type_code=self.TYPE_CODE, channel=channel)
 
-    @classmethod
-    def from_bytes(cls, b):
-        msg = super().from_bytes(b)
-        return ClientClearToSend(msg.channel)
-
 
 class NothingToSend(Message):
 
+    __slots__ = ()
+
     TYPE_CODE = 0x07
     LENGTH = 5
 
     def __init__(self, channel):
         super().__init__(type_code=self.TYPE_CODE, channel=channel)
 
-    @classmethod
-    def from_bytes(cls, b):
-        msg = super().from_bytes(b)
-        return NothingToSend(channel=msg.channel)
-
 
 class ToggleItemRequest(Message):
 
+    __slots__ = ()
+
     TYPE_CODE = 0x11
     LENGTH = 7
 
@@ -199,115 +330,115 @@ class ToggleItemRequest(Message):
 
 class StatusUpdate(Message):
 
+    __slots__ = ()
+
     TYPE_CODE = 0x13
-    LENGTH = 28
+    MIN_LENGTH = 28 # Grows with firmware version
     CHANNEL = 0xFF
 
-    def __init__(self, *, priming_mode, current_temperature, hours, minutes, heating_mode, filter_mode, temperature_scale, time_mode, heating_status, temperature_range, pump_status, circ_pump, light_status, set_temperature):
-        super().__init__(type_code=self.TYPE_CODE, channel=self.CHANNEL, arguments=bytes(
-            [
-                0x00,
-                priming_mode & 0x1,
-                current_temperature,
-                hours,
-                minutes,
-                heating_mode & 0x3,
-                0x00,
-                0x00,
-                0x00,
-                ((filter_mode & 0x3) << 2) + ((time_mode & 0x1) << 1) + (temperature_scale & 0x1),
-                ((heating_status & 0x3) << 4) + (temperature_range & 0x1) << 3,
-                pump_status,
-                0x00,
-                (circ_pump & 0x1) << 1,
-                ((light_status & 0x1) << 1) + (light_status & 0x1),
-                0x00,
-                0x00,
-                0x00,
-                0x00,
-                0x00,
-                set_temperature,
-                0x00,
-                0x00
-            ])
-        )
-
-    @property
-    def priming_mode(self):
-        return self.payload[1] & 0x1
-
-    @property
-    def current_temperature(self):
-        return self.payload[2]
-
-    @property
-    def hours(self):
-        return self.payload[3]
-
-    @property
-    def minutes(self):
-        return self.payload[4]
-
-    @property
-    def heating_mode(self):
-        return self.payload[5] & 0x03
-
-    @property
-    def time_mode(self):
-        return (self.payload[9] >> 1) & 0x1
-
-    @property
-    def temperature_scale(self):
-        return self.payload[9] & 0x1
-
-    @property
-    def heating_status(self):
-        return (self.payload[10] >> 4) & 0x3
-
-    @property
-    def temperature_range(self):
-        return (self.payload[10] >> 3) & 0x1
+    HEATING_MODE_READY = 0
+    HEATING_MODE_READY_IN_REST = 1
+    HEATING_MODE_REST = 2
+
+    SCHEMA = Schema(
+        Field("priming_mode", 1, 0x01),
+        Field("current_temperature", 2), # 0xFF until the spa has a reading
+        Field("hours", 3),
+        Field("minutes", 4),
+        # On the wire: 0 = Ready, 1 = Rest, 3 = Ready in Rest
+        Field("heating_mode", 5, 0x03, values=(
+            HEATING_MODE_READY, HEATING_MODE_REST, HEATING_MODE_READY_IN_REST, HEATING_MODE_READY_IN_REST)),
+        Field("temperature_scale", 9, 0x01),
+        Field("time_mode", 9, 0x02),
+        Field("filter_mode", 9, 0x0C),
+        Field("temperature_range", 10, 0x04),
+        Field("heating_status", 10, 0x30),
+        Field("pump_1", 11, 0x03),
+        Field("pump_2", 11, 0x0C),
+        Field("pump_3", 11, 0x30),
+        Field("pump_4", 11, 0xC0),
+        Field("pump_5", 12, 0x03),
+        Field("pump_6", 12, 0x0C),
+        Field("circulation_pump", 13, 0x02),
+        Field("blower", 13, 0x0C),
+        Field("light_1", 14, 0x03, flag=True),
+        Field("light_2", 14, 0x0C, flag=True),
+        Field("mister", 15, 0x01),
+        Field("aux_1", 15, 0x08),
+        Field("aux_2", 15, 0x10),
+        Field("set_temperature", 20)
+    )
+
+    PUMPS = ("pump_1", "pump_2", "pump_3", "pump_4", "pump_5", "pump_6")
+    LIGHTS = ("light_1", "light_2")
+
+    def __init__(self, **fields):
+        """ Build a status update from SCHEMA field values, 0 if left out.
+
+        The names of the old constructor still work: circ_pump for
+        circulation_pump, and pump_status and light_status as sequences
+        of per-item values or, as before, ints (the raw pump 1-4 byte and
+        light 1 on/off).
+        """
+        if "circ_pump" in fields:
+            fields["circulation_pump"] = fields.pop("circ_pump")
+        pumps = fields.pop("pump_status", None)
+        if pumps is not None:
+            if isinstance(pumps, int):
+                pumps = [(pumps >> shift) & 0x03 for shift in (0, 2, 4, 6)]
+            fields.update(zip(self.PUMPS, pumps))
+        lights = fields.pop("light_status", None)
+        if lights is not None:
+            if isinstance(lights, int):
+                lights = [lights & 0x01]
+            fields.update(zip(self.LIGHTS, lights))
+        unknown = [name for name in fields if name not in self.SCHEMA.by_name]
+        if unknown:
+            raise TypeError("StatusUpdate() got unexpected fields: {0}".format(", ".join(unknown)))
+        b = bytearray(self.MIN_LENGTH - 5)
+        self.SCHEMA.compile().encode_into(b, 0, fields)
+        super().__init__(type_code=self.TYPE_CODE, channel=self.CHANNEL, arguments=bytes(b))
+
+    priming_mode = field_property(SCHEMA, "priming_mode")
+    current_temperature = field_property(SCHEMA, "current_temperature")
+    hours = field_property(SCHEMA, "hours")
+    minutes = field_property(SCHEMA, "minutes")
+    heating_mode = field_property(SCHEMA, "heating_mode")
+    temperature_scale = field_property(SCHEMA, "temperature_scale")
+    time_mode = field_property(SCHEMA, "time_mode")
+    filter_mode = field_property(SCHEMA, "filter_mode")
+    temperature_range = field_property(SCHEMA, "temperature_range")
+    heating_status = field_property(SCHEMA, "heating_status")
+    pump_1 = field_property(SCHEMA, "pump_1")
+    pump_2 = field_property(SCHEMA, "pump_2")
+    pump_3 = field_property(SCHEMA, "pump_3")
+    pump_4 = field_property(SCHEMA, "pump_4")
+    pump_5 = field_property(SCHEMA, "pump_5")
+    pump_6 = field_property(SCHEMA, "pump_6")
+    circulation_pump = field_property(SCHEMA, "circulation_pump")
+    # The name it had before the schema
+    circ_pump = circulation_pump
+    blower = field_property(SCHEMA, "blower")
+    light_1 = field_property(SCHEMA, "light_1")
+    light_2 = field_property(SCHEMA, "light_2")
+    mister = field_property(SCHEMA, "mister")
+    aux_1 = field_property(SCHEMA, "aux_1")
+    aux_2 = field_property(SCHEMA, "aux_2")
+    set_temperature = field_property(SCHEMA, "set_temperature")
 
     @property
     def pump_status(self):
-        return self.payload[11]
-
-    @property
-    def circ_pump(self):
-        return (self.payload[13] >> 1) & 0x1
+        return self.SCHEMA.compile(self.PUMPS).decode(self.arguments)
 
     @property
     def light_status(self):
-        return self.payload[14] & 0x3
-
-    @property
-    def set_temperature(self):
-        return self.payload[20]
-
-    @classmethod
-    def from_bytes(cls, b):
-        msg = super().from_bytes(b)
-        b = msg.arguments
-        return StatusUpdate(
-            priming_mode=b[1] & 0x1,
-            current_temperature=b[2],
-            hours=b[3],
-            minutes=b[4],
-            heating_mode=b[5] & 0x3,
-            filter_mode=(b[9] & 0xc) >> 2,
-            time_mode=(b[9] & 0x1) >> 1,
-            temperature_scale=b[9] & 0x1,
-            heating_status=(b[10] & 0x3) >> 4,
-            temperature_range=b[10] & 0x2,
-            pump_status=b[11],
-            circ_pump=b[13],
-            light_status=b[14],
-            set_temperature=b[20]
-        )
+        return self.SCHEMA.compile(self.LIGHTS).decode(self.arguments)
 
 
 class SetTemperatureRequest(Message):
 
+    __slots__ = ()
+
     TYPE_CODE = 0x20
     LENGTH = 6
 
@@ -321,6 +452,8 @@ class SetTemperatureRequest(Message):
 
 class SetTimeRequest(Message):
 
+    __slots__ = ()
+
     TYPE_CODE = 0x21
     LENGTH = 7
 
@@ -354,6 +487,8 @@ class SetTimeRequest(Message):
 
 class SettingsRequest(Message):
 
+    __slots__ = ()
+
     TYPE_CODE = 0x22
     LENGTH = 8
 
@@ -363,59 +498,73 @@ class SettingsRequest(Message):
 
 class FilterCyclesRequest(SettingsRequest):
 
+    __slots__ = ()
+
     def __init__(self, channel):
         super().__init__(channel, bytes([0x01, 0x00, 0x00]))
 
     @classmethod
     def from_bytes(cls, b):
         msg = super().from_bytes(b)
-        if msg.payload != bytes([0x01, 0x00, 0x00]):
+        if msg.arguments != bytes([0x01, 0x00, 0x00]):
             raise ValueError
-        return FilterCyclesRequest(msg.channel)
+        return msg
 
 
 class InformationRequest(SettingsRequest):
 
+    __slots__ = ()
+
     def __init__(self, channel):
         super().__init__(channel, bytes([0x02, 0x00, 0x00]))
 
     @classmethod
     def from_bytes(cls, b):
         msg = super().from_bytes(b)
-        if msg.payload != bytes([0x02, 0x00, 0x00]):
+        if msg.arguments != bytes([0x02, 0x00, 0x00]):
             raise ValueError
-        return InformationRequest(msg.channel)
+        return msg
 
 
 class PreferencesRequest(SettingsRequest):
 
+    __slots__ = ()
+
     def __init__(self, channel):
         super().__init__(channel, bytes([0x08, 0x00, 0x00]))
 
     @classmethod
     def from_bytes(cls, b):
         msg = super().from_bytes(b)
-        if msg.payload != bytes([0x08, 0x00, 0x00]):
+        if msg.arguments != bytes([0x08, 0x00, 0x00]):
             raise ValueError
-        return InformationRequest(msg.channel)
+        return msg
 
 
 class FaultLogRequest(SettingsRequest):
 
+    __slots__ = ()
+
     def __init__(self, channel, entry=0xFF):
         super().__init__(channel, bytes([0x20, entry, 0x00]))
 
     @classmethod
     def from_bytes(cls, b):
         msg = super().from_bytes(b)
-        b = msg.payload
+        b = msg.arguments
         if b[0] != 0x20 or b[2] != 0x00:
             raise ValueError
-        return FaultLogRequest(msg.channel, msg.payload[1])
+        return msg
+
+    @property
+    def entry(self):
+        return self.arguments[1]
 
 
 class FilterCyclesMessage(Message):
 
+    __slots__ = ()
+
     TYPE_CODE = 0x23
     LENGTH = 13
 
@@ -426,7 +575,7 @@ class FilterCyclesMessage(Message):
             start2h = 0x80 + start2.hour
             start2m = start2.minute
             duration2h = duration2.seconds // 3600
-            duration2m = (duration2.seconds - duration1h * 3600) // 60
+            duration2m = (duration2.seconds - duration2h * 3600) // 60
         else:
             start2h = 0
             start2m = 0
@@ -443,96 +592,99 @@ class FilterCyclesMessage(Message):
             duration2m
         ]))
 
-    @property
+    @cached_field
     def start1(self):
         b = self.arguments
         return datetime.time(b[0], b[1])
 
-    @property
+    @cached_field
     def duration1(self):
         b = self.arguments
         return datetime.timedelta(0, b[2] * 3600 + b[3] * 60)
 
-    @property
+    @cached_field
     def start2(self):
         b = self.arguments
         if b[4] & 0x80:
             return datetime.time(b[4] & 0x7F, b[5])
         return None
 
-    @property
+    @cached_field
     def duration2(self):
         b = self.arguments
         if b[4] & 0x80:
             return datetime.timedelta(0, b[6] * 3600 + b[7] * 60)
         return None
 
-    @classmethod
-    def from_bytes(cls, b):
-        msg = super().from_bytes(b)
-        b = msg.payload
-        print("hello" + cls.__name__)
-        if b[4] & 0x80:
-            start2 = datetime.time(b[4] & 0x7F, b[5])
-            duration2 = datetime.timedelta(0, b[6] * 3600 + b[7] * 60)
-        else:
-            start2 = None
-            duration2 = None
-        return cls(msg.channel,
-            datetime.time(b[0], b[1]),
-            datetime.timedelta(0, b[2] * 3600 + b[3] * 60),
-            start2=start2,
-            duration2=duration2
-        )
-
 
 class FilterCyclesResponse(FilterCyclesMessage):
-    pass
+
+    __slots__ = ()
 
 
 class SetFilterCyclesRequest(FilterCyclesMessage):
-    pass
+
+    __slots__ = ()
 
 
 class InformationResponse(Message):
 
+    __slots__ = ()
+
     TYPE_CODE = 0x24
     LENGTH = 26
 
+    SCHEMA = Schema(
+        Field("ssid_1", 0),
+        Field("ssid_2", 1),
+        Field("version_major", 2),
+        Field("version_minor", 3),
+        Field("model", 4, fmt="8s"),
+        Field("setup", 12),
+        Field("cfg_signature", 13, fmt="I"),
+        Field("heater_voltage", 17, 0x01, values=(120, 220)),
+        Field("heater_type", 18),
+        Field("dip_sw", 19, fmt="H")
+    )
+
     def __init__(self, *, channel, ssid, model, setup, cfg_signature, heater_voltage, heater_type, dip_sw):
         b = bytearray(21)
-        p = re.compile("^M(\d+)_(\d+) V(\d+)(\.(\d+))?$")
+        p = re.compile(r"^M(\d+)_(\d+) V(\d+)(\.(\d+))?$")
         m = p.match(ssid)
-        b[0] = int(m.group(1))
-        b[1] = int(m.group(2))
-        b[2] = int(m.group(3))
-        b[3] = 0 if m.group(4) is None else int(m.group(4))
-        b[4:12] = model.encode("ascii").ljust(8)
-        b[12] = setup
-        b[13:17] = struct.pack(">I", cfg_signature)
-        b[17] = 0x01 if heater_voltage == 220 else 0x00
-        b[18] = heater_type
-        b[19:21] = struct.pack(">H", dip_sw)
-        print(",".join(map("{:02X}".format, b)))
+        self.SCHEMA.compile().encode_into(b, 0, {
+            "ssid_1": int(m.group(1)),
+            "ssid_2": int(m.group(2)),
+            "version_major": int(m.group(3)),
+            "version_minor": 0 if m.group(5) is None else int(m.group(5)),
+            "model": model.encode("ascii").ljust(8),
+            "setup": setup,
+            "cfg_signature": cfg_signature,
+            "heater_voltage": heater_voltage,
+            "heater_type": heater_type,
+            "dip_sw": dip_sw
+        })
         super().__init__(type_code=self.TYPE_CODE, channel=channel, arguments=bytes(b))
 
-    @classmethod
-    def from_bytes(cls, b):
-        msg = super().from_bytes(b)
-        b = msg.payload
-        return InformationResponse(
-            ssid="M" + str(b[0]) + "_" + str(b[1]) + " V" + str(b[2]) + ("" if b[3] == 0 else "." + str(b[3])),
-            model=b[4:12].decode("ascii"),
-            setup=b[12],
-            cfg_signature=struct.unpack(">I", b[13:17])[0],
-            heater_voltage=220 if b[17] == 0x01 else 120,
-            heater_type=b[18],
-            dip_sw=struct.unpack(">H", b[19:21])[0]
-        )
+    @cached_field
+    def ssid(self):
+        i1, i2, v1, v2 = self.SCHEMA.compile(("ssid_1", "ssid_2", "version_major", "version_minor")).decode(self.arguments)
+        return "M" + str(i1) + "_" + str(i2) + " V" + str(v1) + ("" if v2 == 0 else "." + str(v2))
+
+    @cached_field
+    def model(self):
+        return self.SCHEMA.getter("model")(self.arguments).decode("ascii")
+
+    setup = field_property(SCHEMA, "setup")
+    cfg_signature = field_property(SCHEMA, "cfg_signature")
+    heater_voltage = field_property(SCHEMA, "heater_voltage")
+    heater_type = field_property(SCHEMA, "heater_type")
+    dip_sw = field_property(SCHEMA, "dip_sw")
 
 
 class PreferencesResponse(Message):
 
+    __slots__ = ()
+
     TYPE_CODE = 0x26
     LENGTH = 23
 
@@ -542,6 +694,8 @@ class PreferencesResponse(Message):
 
 class SetPreferenceRequest(Message):
 
+    __slots__ = ()
+
     TYPE_CODE = 0x27
     LENGTH = 7
 
@@ -560,6 +714,8 @@ class SetPreferenceRequest(Message):
 
 class SetTemperatureScaleRequest(SetPreferenceRequest):
 
+    __slots__ = ()
+
     FAHRENHEIT = 0x00
     CELSIUS    = 0x01
 
@@ -576,6 +732,8 @@ class SetTemperatureScaleRequest(SetPreferenceRequest):
 
 class SetClockModeRequest(SetPreferenceRequest):
 
+    __slots__ = ()
+
     MODE_12_HOUR = 0x00
     MODE_24_HOUR = 0x01
 
@@ -588,6 +746,8 @@ class SetClockModeRequest(SetPreferenceRequest):
 
 class FaultLogResponse(Message):
 
+    __slots__ = ()
+
     TYPE_CODE = 0x28
     LENGTH = 15
 
@@ -627,37 +787,114 @@ class FaultLogResponse(Message):
         b[9] = sensor_b_temperature
         super().__init__(type_code=self.TYPE_CODE, channel=channel, arguments=bytes(b))
 
+    @property
+    def count(self):
+        return self.arguments[0]
+
     @property
     def entry(self):
-        return self.payload[1] + 1
+        return self.arguments[1] + 1
 
-    @classmethod
-    def from_bytes(cls, b):
-        msg = super().from_bytes(b)
-        b = msg.payload
-        return FaultLogResponse(
-            count=b[0],
-            entry=b[1],
-            message_code=b[2],
-            days_ago=b[3],
-            hours=b[4],
-            minutes=b[5],
-            flags=b[6],
-            set_temperature=b[7],
-            sensor_a_temperature=b[8],
-            sensor_b_temperature=b[9]
-        )
+    @property
+    def message_code(self):
+        return self.arguments[2]
+
+    @property
+    def message(self):
+        return self.MESSAGES.get(self.arguments[2])
+
+    @property
+    def days_ago(self):
+        return self.arguments[3]
+
+    @property
+    def hours(self):
+        return self.arguments[4]
+
+    @property
+    def minutes(self):
+        return self.arguments[5]
+
+    @property
+    def flags(self):
+        return self.arguments[6]
+
+    @property
+    def set_temperature(self):
+        return self.arguments[7]
+
+    @property
+    def sensor_a_temperature(self):
+        return self.arguments[8]
+
+    @property
+    def sensor_b_temperature(self):
+        return self.arguments[9]
 
 
 class ConfigurationResponse(Message):
 
+    __slots__ = ()
+
     TYPE_CODE = 0x2E
     LENGTH = 11
 
+    SCHEMA = Schema(
+        Field("pump_1", 0, 0x03), # Number of speeds, 0 if not installed
+        Field("pump_2", 0, 0x0C),
+        Field("pump_3", 0, 0x30),
+        Field("pump_4", 0, 0xC0),
+        Field("pump_5", 1, 0x03),
+        Field("pump_6", 1, 0xC0),
+        Field("light_1", 2, 0x03, flag=True),
+        Field("light_2", 2, 0xC0, flag=True),
+        Field("blower", 3, 0x03, flag=True),
+        Field("circulation_pump", 3, 0x80, flag=True),
+        Field("aux_1", 4, 0x01, flag=True),
+        Field("aux_2", 4, 0x02, flag=True),
+        Field("mister", 4, 0x30, flag=True)
+    )
+
     def __init__(self, channel, cfg):
         super().__init__(type_code=self.TYPE_CODE, channel=channel, arguments=cfg)
 
-    @classmethod
-    def from_bytes(cls, b):
-        msg = super().from_bytes(b)
-        return ConfigurationResponse(msg.channel, msg.arguments)
+    pumps = cached_field(lambda msg: msg.SCHEMA.compile(
+        ("pump_1", "pump_2", "pump_3", "pump_4", "pump_5", "pump_6")).decode(msg.arguments))
+    lights = cached_field(lambda msg: msg.SCHEMA.compile(("light_1", "light_2")).decode(msg.arguments))
+    circulation_pump = field_property(SCHEMA, "circulation_pump")
+    blower = field_property(SCHEMA, "blower")
+    mister = field_property(SCHEMA, "mister")
+    aux = cached_field(lambda msg: msg.SCHEMA.compile(("aux_1", "aux_2")).decode(msg.arguments))
+
+
+class ModuleIdentificationResponse(Message):
+    """ Sent by the Wi-Fi module in answer to ExistingClientRequest. """
+
+    __slots__ = ()
+
+    TYPE_CODE = 0x94
+    LENGTH = 0x1E
+
+    SCHEMA = Schema(
+        Field("pump_1", 0, 0x03),
+        Field("pump_2", 0, 0x0C),
+        Field("pump_3", 0, 0x30),
+        Field("pump_4", 0, 0xC0),
+        Field("pump_5", 1, 0x03),
+        Field("pump_6", 1, 0xC0),
+        Field("light_1", 2, 0xC0, flag=True), # Reversed from ConfigurationResponse
+        Field("light_2", 2, 0x03, flag=True),
+        Field("mac_address", 3, fmt="6s")
+    )
+
+    def __init__(self, channel, arguments):
+        super().__init__(type_code=self.TYPE_CODE, channel=channel, arguments=arguments)
+
+    @cached_field
+    def mac_address(self):
+        return ":".join("{:02x}".format(b) for b in self.SCHEMA.getter("mac_address")(self.arguments))
+
+
+def decode(frame):
+    """ Decode a complete frame into an instance of its registered class. """
+    return Message.from_bytes(frame)
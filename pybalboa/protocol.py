@@ -0,0 +1,352 @@
+import asyncio
+import bisect
+import collections
+import logging
+import time
+
+import pybalboa.messages as messages
+
+
+class FrameDecoder:
+    """ Incremental decoder splitting a byte stream into Balboa frames.
+
+    Incoming data is appended to a single buffer that is scanned in place.
+    Complete frames (delimiters included) are yielded as memoryviews once
+    their length, end delimiter and CRC check out.  Anything that does not
+    parse is dropped one byte at a time, so a corrupted frame never costs
+    more than its own bytes.
+
+    The buffer is never resized while frames are exported: consumed data is
+    released by rebinding to a fresh buffer holding only the unparsed tail,
+    so a yielded frame stays valid for as long as the caller keeps it.
+    """
+
+    MIN_LENGTH = 5
+
+    def __init__(self):
+        self._buf = bytearray()
+        self.frames = 0
+        self.discarded = 0
+
+    def feed(self, data):
+        """ Append received bytes to the buffer. """
+        self._buf += data
+
+    def __len__(self):
+        return len(self._buf)
+
+    def __iter__(self):
+        buf = self._buf
+        view = memoryview(buf)
+        end = len(buf)
+        pos = 0
+        try:
+            while pos < end:
+                start = buf.find(messages.Message.DELIMITER, pos)
+                if start < 0:
+                    self.discarded += end - pos
+                    pos = end
+                    break
+                self.discarded += start - pos
+                pos = start
+                if end - pos < 2:
+                    break
+                length = buf[pos + 1]
+                if length < self.MIN_LENGTH or length == messages.Message.DELIMITER:
+                    # Usually the closing delimiter of a frame we joined
+                    # half way through.
+                    self.discarded += 1
+                    pos += 1
+                    continue
+                stop = pos + length + 2
+                if stop > end:
+                    break
+                if (buf[stop - 1] != messages.Message.DELIMITER or
+                        messages.Message.crc(view[pos + 1:stop - 2]) != buf[stop - 2]):
+                    self.discarded += 1
+                    pos += 1
+                    continue
+                frame = view[pos:stop]
+                pos = stop
+                self.frames += 1
+                yield frame
+        finally:
+            view.release()
+            if pos:
+                self._buf = buf[pos:]
+
+
+class LatencyHistogram:
+    """ Counts of latency samples in power of two buckets.
+
+    Bucket i counts samples up to BASE * 2**i seconds, the last bucket
+    everything slower.  Recording is a bisect and an increment, cheap
+    enough for the reply path.
+    """
+
+    BASE = 0.000025
+    BUCKETS = 16
+
+    def __init__(self):
+        self.bounds = [self.BASE * 2 ** i for i in range(self.BUCKETS - 1)]
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """ Return the upper bound of the bucket holding percentile p. """
+        wanted = self.count * p / 100.0
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if n and seen >= wanted:
+                return bound
+        return self.max
+
+    def __str__(self):
+        lines = []
+        for i, n in enumerate(self.counts):
+            if n:
+                label = "<= {0:.0f} us".format(self.bounds[i] * 1e6) if i < len(self.bounds) else "slower"
+                lines.append("{0:>14} {1}".format(label, n))
+        return "\n".join(lines)
+
+
+class BalboaProtocol(asyncio.Protocol):
+    """ asyncio protocol delivering validated frames from a spa connection.
+
+    Frames are queued as they are decoded and handed out by read_frame().
+    Reading from the transport is paused while MAX_QUEUED frames are
+    waiting, so a slow consumer pushes back on the spa instead of growing
+    the queue.
+
+    on_frame(frame, received), if given, sees every frame straight from
+    data_received() before it is queued, received being the
+    time.perf_counter() at which its bytes arrived.  Replies that must go
+    out inside the bus reply window are written from there.
+
+    With idle_timeout set, the transport is closed when no data arrives
+    for that many seconds.
+    """
+
+    MAX_QUEUED = 64
+
+    def __init__(self, on_connection_lost=None, on_frame=None, idle_timeout=None):
+        self.log = logging.getLogger(__name__)
+        self.decoder = FrameDecoder()
+        self.transport = None
+        self._on_connection_lost = on_connection_lost
+        self._on_frame = on_frame
+        self._idle_timeout = idle_timeout
+        self._idle_timer = None
+        self._last_data = time.perf_counter()
+        self._frames = collections.deque()
+        self._waiter = None
+        self._reading_paused = False
+        self._writing_paused = False
+        self._drain_waiter = None
+        self._closed = asyncio.get_event_loop().create_future()
+
+    @property
+    def closed(self):
+        return self._closed.done()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self._idle_timeout is not None:
+            self._last_data = time.perf_counter()
+            self._idle_timer = asyncio.get_event_loop().call_later(
+                self._idle_timeout, self._check_idle)
+
+    def _check_idle(self):
+        idle = time.perf_counter() - self._last_data
+        if idle < self._idle_timeout:
+            # Checked lazily: data_received() only records the time
+            self._idle_timer = asyncio.get_event_loop().call_later(
+                self._idle_timeout - idle, self._check_idle)
+            return
+        self._idle_timer = None
+        self.log.error("No data for {0:.0f} s, closing connection".format(idle))
+        self.transport.close()
+
+    def data_received(self, data):
+        received = self._last_data = time.perf_counter()
+        self.decoder.feed(data)
+        if self._on_frame is None:
+            self._frames.extend(self.decoder)
+        else:
+            for frame in self.decoder:
+                self._on_frame(frame, received)
+                self._frames.append(frame)
+        if not self._frames:
+            return
+        self._wakeup()
+        if len(self._frames) >= self.MAX_QUEUED and not self._reading_paused:
+            self._reading_paused = True
+            self.transport.pause_reading()
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+        if not self._closed.done():
+            self._closed.set_result(None)
+        self._wakeup()
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+        if self._on_connection_lost is not None:
+            self._on_connection_lost(exc)
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    def _wakeup(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def read_frame(self):
+        """ Return the next frame, or None once the connection is gone. """
+        while not self._frames:
+            if self.closed:
+                return None
+            self._waiter = asyncio.get_event_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        frame = self._frames.popleft()
+        if self._reading_paused and len(self._frames) < self.MAX_QUEUED // 2:
+            self._reading_paused = False
+            self.transport.resume_reading()
+        return frame
+
+    def write(self, data):
+        if self.transport is None or self.closed:
+            return
+        self.transport.write(data)
+
+    async def drain(self):
+        if not self._writing_paused or self.closed:
+            return
+        self._drain_waiter = asyncio.get_event_loop().create_future()
+        try:
+            await self._drain_waiter
+        finally:
+            self._drain_waiter = None
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    async def wait_closed(self):
+        await asyncio.shield(self._closed)
+
+
+class SerialTransport(asyncio.Transport):
+    """ Non-blocking asyncio transport over a pyserial port.
+
+    The port's file descriptor is watched with loop.add_reader(), and every
+    wakeup drains whatever the driver has buffered (in_waiting) in one read
+    and hands it to the protocol.  Serial errors are usually recoverable
+    after a short wait, so on error reading is suspended and retried later
+    rather than tearing the transport down.  Requires a port with a real
+    file descriptor (POSIX).
+    """
+
+    RETRY_DELAY = 1.0
+
+    def __init__(self, loop, protocol, serial_instance):
+        import serial
+        super().__init__()
+        self.log = logging.getLogger(__name__)
+        self._loop = loop
+        self._protocol = protocol
+        self._serial = serial_instance
+        self._serial_error = serial.SerialException
+        self._fileno = serial_instance.fileno()
+        self._reading = False
+        self._paused = False
+        self._closing = False
+        self._retry = None
+        loop.call_soon(protocol.connection_made, self)
+        loop.call_soon(self._start_reading)
+
+    def _start_reading(self):
+        self._retry = None
+        if self._reading or self._paused or self._closing:
+            return
+        self._loop.add_reader(self._fileno, self._read_ready)
+        self._reading = True
+
+    def _stop_reading(self):
+        if self._reading:
+            self._loop.remove_reader(self._fileno)
+            self._reading = False
+
+    def _read_ready(self):
+        try:
+            data = self._serial.read(self._serial.in_waiting or 1)
+        except self._serial_error as e:
+            self.log.error(e)
+            self._stop_reading()
+            self._retry = self._loop.call_later(self.RETRY_DELAY, self._start_reading)
+            return
+        if data:
+            self._protocol.data_received(data)
+
+    def pause_reading(self):
+        self._paused = True
+        self._stop_reading()
+
+    def resume_reading(self):
+        self._paused = False
+        self._start_reading()
+
+    def is_reading(self):
+        return self._reading
+
+    def is_closing(self):
+        return self._closing
+
+    def get_extra_info(self, name, default=None):
+        if name == "serial":
+            return self._serial
+        return default
+
+    def write(self, data):
+        if self._closing:
+            return
+        try:
+            self._serial.write(data)
+        except self._serial_error as e:
+            self.log.error(e)
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self._stop_reading()
+        if self._retry is not None:
+            self._retry.cancel()
+        self._serial.close()
+        self._loop.call_soon(self._protocol.connection_lost, None)
@@ -0,0 +1,159 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+import pybalboa.messages as messages
+
+PRIORITY_COMMAND = 0
+PRIORITY_SETTINGS = 10
+
+# Items whose button only flips between two states, so two queued presses
+# cancel out
+BINARY_ITEMS = frozenset((
+    messages.ToggleItemRequest.ItemCode.MISTER,
+    messages.ToggleItemRequest.ItemCode.LIGHT_1,
+    messages.ToggleItemRequest.ItemCode.LIGHT_2,
+    messages.ToggleItemRequest.ItemCode.AUX_1,
+    messages.ToggleItemRequest.ItemCode.AUX_2,
+    messages.ToggleItemRequest.ItemCode.HOLD_MODE,
+    messages.ToggleItemRequest.ItemCode.TEMPERATURE_RANGE,
+    messages.ToggleItemRequest.ItemCode.HEAT_MODE,
+))
+
+
+class _Entry:
+    __slots__ = ("msg", "priority", "seq", "queued", "deadline", "future", "active")
+
+    def __init__(self, msg, priority, seq, queued, deadline, future):
+        self.msg = msg
+        self.priority = priority
+        self.seq = seq
+        self.queued = queued
+        self.deadline = deadline
+        self.future = future
+        self.active = True
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class CommandScheduler:
+    """ Outbound message queue for a bus client, drained one message per
+    Clear To Send.
+
+    Messages go out by priority (lower first), then in the order they were
+    queued.  Settings requests default to PRIORITY_SETTINGS and everything
+    else to PRIORITY_COMMAND, so a user's button press never waits behind a
+    burst of polls.  While a message is queued:
+
+    - a newer SetTemperatureRequest replaces it, keeping its place;
+    - a second press of the same two-state item cancels both presses;
+    - if its deadline passes, it is dropped instead of being sent late.
+
+    push() returns a future resolved with the seconds spent queued once the
+    message is handed out by pop(), and cancelled if the message is
+    dropped, replaced or cancelled.  Runs on the event loop only.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._temperature = None
+        self._toggles = {}
+        self._depth = 0
+        self.max_depth = 0
+        self.sent = 0
+        self.expired = 0
+        self.replaced = 0
+        self.cancelled = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def __len__(self):
+        return self._depth
+
+    def push(self, msg, priority=None, deadline=None):
+        """ Queue msg; deadline is in seconds from now. """
+        if priority is None:
+            priority = PRIORITY_SETTINGS if isinstance(msg, messages.SettingsRequest) else PRIORITY_COMMAND
+        now = time.monotonic()
+        future = asyncio.get_event_loop().create_future()
+        entry = _Entry(msg, priority, next(self._seq), now,
+                       None if deadline is None else now + deadline, future)
+
+        if isinstance(msg, messages.SetTemperatureRequest):
+            old = self._temperature
+            if old is not None and old.active:
+                # Latest wins, but keep the older place in the queue
+                entry.priority = min(entry.priority, old.priority)
+                entry.seq = old.seq
+                entry.queued = old.queued
+                self._drop(old)
+                self.replaced += 1
+            self._temperature = entry
+        elif isinstance(msg, messages.ToggleItemRequest):
+            item = msg.arguments[0]
+            if item in BINARY_ITEMS:
+                pending = self._toggles.pop(item, None)
+                if pending is not None and pending.active:
+                    self._drop(pending)
+                    self.cancelled += 2
+                    future.cancel()
+                    return future
+                self._toggles[item] = entry
+
+        heapq.heappush(self._heap, entry)
+        self._depth += 1
+        if self._depth > self.max_depth:
+            self.max_depth = self._depth
+        return future
+
+    def pop(self):
+        """ Return the next message to send, or None. """
+        now = time.monotonic()
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            if not entry.active:
+                continue
+            entry.active = False
+            self._depth -= 1
+            if entry.deadline is not None and now > entry.deadline:
+                self.expired += 1
+                entry.future.cancel()
+                continue
+            wait = now - entry.queued
+            self.sent += 1
+            self.wait_total += wait
+            if wait > self.wait_max:
+                self.wait_max = wait
+            if not entry.future.done():
+                entry.future.set_result(wait)
+            return entry.msg
+        return None
+
+    def cancel(self, future):
+        """ Remove the message queued with future. """
+        for entry in self._heap:
+            if entry.future is future and entry.active:
+                self._drop(entry)
+                self.cancelled += 1
+                return True
+        return False
+
+    def _drop(self, entry):
+        entry.active = False
+        self._depth -= 1
+        entry.future.cancel()
+
+    def stats(self):
+        return {
+            "depth": self._depth,
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "expired": self.expired,
+            "replaced": self.replaced,
+            "cancelled": self.cancelled,
+            "wait_mean": self.wait_total / self.sent if self.sent else 0.0,
+            "wait_max": self.wait_max,
+        }
@@ -0,0 +1,236 @@
+""" Declarative message layouts.
+
+A Schema lists where each logical field of a message lives in the message
+arguments: byte offset, struct format, bit mask, shift and an optional
+value table or scale.  Schema.compile() turns that description into plain
+Python functions, generated once, that unpack every byte they need with a
+single struct call and apply the masks and shifts inline.  The same schema
+drives the spa parsers, the message classes and the Homie node, so the
+layouts are written down exactly once.
+"""
+import struct
+
+
+class Field:
+    """ One field of a message layout.
+
+    name:   field name, used as the key in decoded results.
+    offset: byte offset into the message arguments.
+    mask:   bits of the unpacked value that belong to the field, before
+            shifting.  Defaults to the whole value.
+    shift:  right shift applied after masking.  Defaults to the position of
+            the lowest bit in mask.
+    fmt:    struct format of the raw value (big endian), "B" by default.
+    values: table mapping the raw value to the decoded one.
+    flag:   decode to 1 if any bit in mask is set, 0 otherwise.
+    scale:  multiplier applied to the decoded value.
+    """
+
+    __slots__ = ("name", "offset", "mask", "shift", "fmt", "size", "values", "scale")
+
+    def __init__(self, name, offset, mask=None, shift=None, *, fmt="B", values=None, flag=False, scale=None):
+        self.name = name
+        self.offset = offset
+        self.fmt = fmt
+        self.size = struct.calcsize(">" + fmt)
+        if mask is None or fmt.endswith("s"):
+            mask = None
+        elif mask == (1 << (8 * self.size)) - 1:
+            mask = None
+        elif self.size != 1:
+            raise ValueError("Masks are only supported on single byte fields")
+        self.mask = mask
+        if shift is None:
+            shift = 0 if mask is None else (mask & -mask).bit_length() - 1
+        self.shift = shift
+        if flag:
+            values = (0,) + (1,) * ((0xFF if mask is None else mask) >> shift)
+        self.values = None if values is None else tuple(values)
+        self.scale = scale
+
+    @property
+    def frame_mask(self):
+        """ Bits covered by this field in int.from_bytes(arguments, "little"). """
+        if self.size == 1:
+            return (0xFF if self.mask is None else self.mask) << (8 * self.offset)
+        return ((1 << (8 * self.size)) - 1) << (8 * self.offset)
+
+    def __repr__(self):
+        return "Field({0!r}, {1})".format(self.name, self.offset)
+
+
+class Schema:
+    """ An ordered collection of Fields describing one message type. """
+
+    def __init__(self, *fields):
+        self.fields = tuple(fields)
+        self.by_name = {f.name: f for f in self.fields}
+        self._compiled = {}
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __getitem__(self, name):
+        return self.by_name[name]
+
+    @property
+    def names(self):
+        return tuple(f.name for f in self.fields)
+
+    @property
+    def length(self):
+        """ Minimum argument length covering every field. """
+        return max(f.offset + f.size for f in self.fields)
+
+    def compile(self, names=None):
+        """ Return a CompiledSchema for names (all fields by default).
+
+        Compiled schemas are cached, so asking again for the same set of
+        fields is cheap.
+        """
+        key = self.names if names is None else tuple(names)
+        compiled = self._compiled.get(key)
+        if compiled is None:
+            compiled = self._compiled[key] = CompiledSchema(tuple(self.by_name[n] for n in key))
+        return compiled
+
+    def getter(self, name):
+        """ Return a function(buf, base=0) decoding a single field. """
+        return self.compile((name,)).get
+
+
+class CompiledSchema:
+    """ Decoders and encoders generated for a fixed set of fields.
+
+    decode(buf, base=0)          -> tuple of values, in field order
+    get(buf, base=0)             -> value of the first field
+    setter(targets)              -> function(obj, buf, base=0) assigning
+                                    each field to the expression in targets,
+                                    e.g. {"pump1": "pump_status[0]"}
+    row_setter()                 -> function(columns, row, buf, base=0)
+                                    storing each field in
+                                    columns[name][row]
+    encode_into(buf, base, values) ORs a mapping of values into buf
+    changed(diff)                -> names of the fields touched by diff
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.names = tuple(f.name for f in fields)
+        self._namespace = {"unpack_from": struct.unpack_from, "pack_into": struct.pack_into}
+        for i, f in enumerate(fields):
+            if f.values is not None:
+                self._namespace["values{0}".format(i)] = f.values
+                self._namespace["inverse{0}".format(i)] = {v: raw for raw, v in enumerate(f.values)}
+            if f.scale is not None:
+                self._namespace["scale{0}".format(i)] = f.scale
+        self._unpack, self._raw = self._layout()
+        # (mask, name) of the fields found in each argument byte
+        self._byte_fields = {}
+        for f in fields:
+            for k in range(f.size):
+                self._byte_fields.setdefault(f.offset + k, []).append(
+                    (0xFF if f.mask is None else f.mask, f.name))
+        self.decode = self._build("decode", "return ({0},)".format(
+            ", ".join(self._expr(i, f) for i, f in enumerate(fields))))
+        self.get = self._build("get", "return " + self._expr(0, fields[0])) if fields else None
+        self.encode_into = self._build_encoder()
+
+    def _layout(self):
+        """ Build one struct unpacking every byte range the fields need. """
+        ranges = sorted({(f.offset, f.fmt, f.size) for f in self.fields})
+        fmt = ">"
+        pos = 0
+        raw = {}
+        for offset, f, size in ranges:
+            if offset < pos:
+                raise ValueError("Overlapping fields at offset {0}".format(offset))
+            if offset > pos:
+                fmt += "{0}x".format(offset - pos)
+            fmt += f
+            raw[(offset, f)] = "r{0}_{1}".format(offset, len(raw))
+            pos = offset + size
+        return struct.Struct(fmt), raw
+
+    def _expr(self, i, f):
+        expr = self._raw[(f.offset, f.fmt)]
+        if f.mask is not None:
+            expr = "({0} & {1:#x})".format(expr, f.mask)
+        if f.shift:
+            expr = "({0} >> {1})".format(expr, f.shift)
+        if f.values is not None:
+            expr = "values{0}[{1}]".format(i, expr)
+        if f.scale is not None:
+            expr = "{0} * scale{1}".format(expr, i)
+        return expr
+
+    def _source(self, name, body, args="buf, base=0"):
+        lines = ["def {0}({1}):".format(name, args)]
+        if not self._raw:
+            pass
+        elif len(self._raw) == 1 and self.fields[0].fmt == "B":
+            # A single byte is cheaper to index than to unpack
+            lines.append("    {0} = buf[base + {1}]".format(
+                next(iter(self._raw.values())), self.fields[0].offset))
+        else:
+            lines.append("    {0}, = unpack(buf, base)".format(", ".join(self._raw.values())))
+        lines.extend("    " + line for line in body.split("\n"))
+        return "\n".join(lines)
+
+    def _build(self, name, body, args="buf, base=0"):
+        namespace = dict(self._namespace, unpack=self._unpack.unpack_from)
+        exec(self._source(name, body, args), namespace)
+        return namespace[name]
+
+    def setter(self, targets=None):
+        """ Return a function(obj, buf, base=0) storing fields on obj. """
+        targets = targets or {}
+        body = "\n".join("obj.{0} = {1}".format(targets.get(f.name, f.name), self._expr(i, f))
+                         for i, f in enumerate(self.fields))
+        return self._build("set_fields", body, "obj, buf, base=0")
+
+    def row_setter(self):
+        """ Return a function(columns, row, buf, base=0) storing fields in
+        a column store, a mapping of field name to array. """
+        body = "\n".join("columns[{0!r}][row] = {1}".format(f.name, self._expr(i, f))
+                         for i, f in enumerate(self.fields))
+        return self._build("set_row", body, "columns, row, buf, base=0")
+
+    def _build_encoder(self):
+        lines = ["def encode_into(buf, base, values):"]
+        for i, f in enumerate(self.fields):
+            value = "values[{0!r}]".format(f.name)
+            lines.append("    if {0!r} in values:".format(f.name))
+            if f.scale is not None:
+                value = "int(round({0} / scale{1}))".format(value, i)
+            if f.values is not None:
+                value = "inverse{0}[{1}]".format(i, value)
+            if f.mask is not None:
+                lines.append("        buf[base + {0}] |= ({1} << {2}) & {3:#x}".format(f.offset, value, f.shift, f.mask))
+            elif f.fmt == "B":
+                lines.append("        buf[base + {0}] = {1}".format(f.offset, value))
+            else:
+                lines.append("        pack_into({0!r}, buf, base + {1}, {2})".format(">" + f.fmt, f.offset, value))
+        namespace = dict(self._namespace)
+        exec("\n".join(lines), namespace)
+        return namespace["encode_into"]
+
+    def changed(self, diff):
+        """ Return the set of field names with bits set in diff.
+
+        diff is the XOR of two argument buffers read as little-endian
+        integers, so only the bytes that actually differ are visited.
+        """
+        names = set()
+        byte_fields = self._byte_fields
+        while diff:
+            shift = ((diff & -diff).bit_length() - 1) & ~7
+            bits = (diff >> shift) & 0xFF
+            diff ^= bits << shift
+            for mask, name in byte_fields.get(shift >> 3, ()):
+                if bits & mask:
+                    names.add(name)
+        return frozenset(names)
+
+    def as_dict(self, buf, base=0):
+        return dict(zip(self.names, self.decode(buf, base)))
@@ -0,0 +1,166 @@
+""" Fleet wide spa state as NumPy columns.
+
+NumPy is only imported when a StateStore is created, so the rest of the
+package works without it.
+"""
+import time
+
+import pybalboa.messages as messages
+
+_np = None
+
+
+def _numpy():
+    global _np
+    if _np is None:
+        import numpy
+        _np = numpy
+    return _np
+
+
+_schema = messages.StatusUpdate.SCHEMA
+
+# Row setters for the combinations of status fields seen changing together
+_row_setters = {}
+
+
+def _row_setter(names):
+    setter = _row_setters.get(names)
+    if setter is None:
+        setter = _row_setters[names] = _schema.compile(
+            [n for n in _schema.names if n in names]).row_setter()
+    return setter
+
+
+PUMPS = ("pump_1", "pump_2", "pump_3", "pump_4", "pump_5", "pump_6")
+
+
+class StateStore:
+    """ Status of many spas, one row per spa and one column per field.
+
+    columns maps every StatusUpdate field to a uint8 array of values as
+    decoded by messages.StatusUpdate.SCHEMA (so Celsius temperatures are
+    still doubled), plus "lastupd" (time.time() of the last change,
+    float64, 0 until the first status) and "active" (rows in use).  A
+    BalboaSpaWifi attached with attach() has its status decoder write the
+    fields that changed straight into its row, so queries are whole-array
+    operations:
+
+        store.ids((store["heating_status"] > 0) & (store.curtemp < store.settemp - 5))
+        store.pumps_running()
+
+    Arrays cover every allocated row; ids() and the counting helpers only
+    look at active ones.  Columns are reallocated as the store grows, so
+    do not hold on to them across attach() calls.
+    """
+
+    def __init__(self, capacity=64):
+        np = _numpy()
+        self.capacity = capacity
+        self.columns = {name: np.zeros(capacity, np.uint8) for name in _schema.names}
+        self.columns["current_temperature"][:] = 0xFF
+        self.columns["lastupd"] = np.zeros(capacity, np.float64)
+        self.columns["active"] = np.zeros(capacity, bool)
+        self.rows = {}
+        self._ids = [None] * capacity
+        self._free = list(range(capacity - 1, -1, -1))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, spa_id):
+        return spa_id in self.rows
+
+    def add(self, spa_id):
+        """ Allocate a row for spa_id and return it. """
+        if spa_id in self.rows:
+            raise ValueError("Spa {0!r} is already in the store".format(spa_id))
+        if not self._free:
+            self._grow()
+        row = self._free.pop()
+        self.rows[spa_id] = row
+        self._ids[row] = spa_id
+        self.columns["active"][row] = True
+        return row
+
+    def attach(self, spa, spa_id):
+        """ Give spa a row and have its status updates written to it. """
+        row = self.add(spa_id)
+        if spa.prior_status is not None:
+            # The spa already has a status: store all of it
+            data = spa.prior_status.to_bytes(
+                max(_schema.length, (spa.prior_status.bit_length() + 7) // 8), "little")
+            _row_setter(frozenset(_schema.names))(self.columns, row, data, 0)
+            self.columns["lastupd"][row] = spa.lastupd
+        spa.state_store = self
+        spa.state_row = row
+        return row
+
+    def remove(self, spa_id):
+        """ Free spa_id's row. """
+        row = self.rows.pop(spa_id)
+        self._ids[row] = None
+        for name, column in self.columns.items():
+            column[row] = 0xFF if name == "current_temperature" else 0
+        self._free.append(row)
+
+    def detach(self, spa, spa_id):
+        spa.state_store = None
+        spa.state_row = None
+        self.remove(spa_id)
+
+    def _grow(self):
+        np = _numpy()
+        old = self.capacity
+        self.capacity *= 2
+        for name, column in self.columns.items():
+            grown = np.zeros(self.capacity, column.dtype)
+            if name == "current_temperature":
+                grown[:] = 0xFF
+            grown[:old] = column
+            self.columns[name] = grown
+        self._ids.extend([None] * old)
+        self._free.extend(range(self.capacity - 1, old - 1, -1))
+
+    def write(self, row, names, data, base=5):
+        """ Store the named status fields of frame data in row; called by
+        BalboaSpaWifi.parse_status_update(). """
+        _row_setter(names)(self.columns, row, data, base)
+        self.columns["lastupd"][row] = time.time()
+
+    def _degrees(self, name):
+        np = _numpy()
+        raw = self.columns[name]
+        degrees = raw / np.where(self.columns["temperature_scale"] == 1, 2.0, 1.0)
+        # Inactive rows and spas that have not sent a status yet
+        degrees[~self.columns["active"] | (self.columns["lastupd"] == 0)] = np.nan
+        return degrees
+
+    @property
+    def curtemp(self):
+        """ Current temperatures in the spa's own scale, NaN without a reading. """
+        degrees = self._degrees("current_temperature")
+        degrees[self.columns["current_temperature"] == 0xFF] = _numpy().nan
+        return degrees
+
+    @property
+    def settemp(self):
+        """ Set temperatures in the spa's own scale, NaN without a reading. """
+        return self._degrees("set_temperature")
+
+    def ids(self, mask):
+        """ IDs of the active spas where mask is true. """
+        rows = _numpy().flatnonzero(mask & self.columns["active"])
+        return [self._ids[row] for row in rows]
+
+    def count(self, mask):
+        return int(_numpy().count_nonzero(mask & self.columns["active"]))
+
+    def pumps_running(self):
+        """ Number of pumps running at any speed across the fleet. """
+        np = _numpy()
+        running = sum((self.columns[pump] != 0).astype(np.int64) for pump in PUMPS)
+        return int(running[self.columns["active"]].sum())
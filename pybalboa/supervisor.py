@@ -0,0 +1,353 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+
+from pybalboa.balboa import BALBOA_DEFAULT_PORT
+from pybalboa.connection import Backoff
+from pybalboa.events import CommandCompleted, ConnectionDown, ConnectionUp, EventBus, StateChanged
+from pybalboa.fleet import SpaFleet
+
+log = logging.getLogger(__name__)
+
+# Seconds a worker gathers state changes before sending them as one batch
+FLUSH_INTERVAL = 0.05
+
+
+def _value(value):
+    return tuple(value) if isinstance(value, list) else value
+
+
+def _worker_main(conn, spas, max_connecting, flush_interval):
+    """ Entry point of a worker process: run a SpaFleet for spas, a list
+    of (spa_id, host, port), until the parent says stop. """
+    logging.basicConfig(level=logging.WARNING)
+    try:
+        asyncio.run(_Worker(conn, spas, max_connecting, flush_interval).run())
+    except KeyboardInterrupt:
+        pass
+
+
+class _Worker:
+    """ The worker side of the pipe.
+
+    Sends the parent lists of (kind, spa_id, payload):
+
+    - ("state", spa_id, {attribute: value}): latest values of everything
+      that changed since the previous batch;
+    - ("up", spa_id, None) and ("down", spa_id, reason);
+    - ("result", request_id, (result, error)) for apply();
+    - ("stats", None, fleet.stats()) once a second.
+
+    and takes ("apply", request_id, (spa_id, target)) and ("stop", None,
+    None) from it.
+    """
+
+    def __init__(self, conn, spas, max_connecting, flush_interval):
+        self.conn = conn
+        self.spas = spas
+        self.flush_interval = flush_interval
+        self.fleet = SpaFleet(max_connecting)
+        self.changes = {}
+        self.batch = []
+        self.stopped = asyncio.Event()
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        for spa_id, host, port in self.spas:
+            self.fleet.add(spa_id, host, port)
+        self.fleet.events.subscribe(StateChanged, self._on_state)
+        self.fleet.events.subscribe(ConnectionUp, lambda e: self.batch.append(("up", e.source_id, None)))
+        self.fleet.events.subscribe(ConnectionDown, lambda e: self.batch.append(
+            ("down", e.source_id, None if e.exc is None else repr(e.exc))))
+        loop.add_reader(self.conn.fileno(), self._on_readable)
+        self.fleet.start()
+        flusher = asyncio.ensure_future(self._flush_forever())
+        try:
+            await self.stopped.wait()
+        finally:
+            loop.remove_reader(self.conn.fileno())
+            flusher.cancel()
+            await self.fleet.close()
+            self._flush()
+
+    def _on_state(self, event):
+        spa = event.source
+        values = self.changes.setdefault(event.source_id, {})
+        for attr in event.changed:
+            values[attr] = _value(getattr(spa, attr))
+
+    def _on_readable(self):
+        try:
+            while self.conn.poll():
+                kind, request_id, payload = self.conn.recv()
+                if kind == "apply":
+                    self._apply(request_id, *payload)
+                elif kind == "stop":
+                    self.stopped.set()
+        except (EOFError, OSError):
+            # The parent went away
+            self.stopped.set()
+
+    def _apply(self, request_id, spa_id, target):
+        try:
+            future = self.fleet[spa_id].apply(target)
+        except (KeyError, ValueError) as e:
+            self.batch.append(("result", request_id, (None, repr(e))))
+            return
+        if future is None:
+            self.batch.append(("result", request_id, (None, "not connected")))
+            return
+
+        def done(f):
+            if f.cancelled():
+                self.batch.append(("result", request_id, (None, "cancelled")))
+            elif f.exception() is not None:
+                self.batch.append(("result", request_id, (None, repr(f.exception()))))
+            else:
+                self.batch.append(("result", request_id, (f.result(), None)))
+        future.add_done_callback(done)
+
+    async def _flush_forever(self):
+        next_stats = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if time.monotonic() >= next_stats:
+                next_stats += 1.0
+                self.batch.append(("stats", None, self.fleet.stats()))
+            self._flush()
+
+    def _flush(self):
+        if self.changes:
+            self.batch.extend(("state", spa_id, values) for spa_id, values in self.changes.items())
+            self.changes = {}
+        if self.batch:
+            batch, self.batch = self.batch, []
+            try:
+                self.conn.send(batch)
+            except (BrokenPipeError, OSError):
+                self.stopped.set()
+
+
+class FleetSupervisor:
+    """ Spreads a fleet of spas over worker processes.
+
+    Spas are dealt out to `workers` processes (one per core by default),
+    each running a SpaFleet for its shard, so frame parsing scales with
+    cores.  Workers send back batches every FLUSH_INTERVAL seconds holding
+    only the latest value of each changed attribute, and the parent merges
+    them into state[spa_id] and publishes StateChanged, ConnectionUp,
+    ConnectionDown and CommandCompleted on events with source_id set to
+    the spa ID (source is None, the spa lives in another process, and
+    errors arrive as RuntimeError holding the worker's description).  A
+    worker that dies is restarted with the same shard after a backoff.
+
+    Workers are started with the "spawn" method, so the program using the
+    supervisor needs the usual `if __name__ == "__main__":` guard.
+    """
+
+    RESTART_BASE = 1.0
+    RESTART_CAP = 60.0
+
+    def __init__(self, workers=None, max_connecting=SpaFleet.MAX_CONNECTING,
+                 flush_interval=FLUSH_INTERVAL):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_connecting = max_connecting
+        self.flush_interval = flush_interval
+        self.shards = [[] for i in range(self.workers)]
+        self.shard_of = {}
+        self.state = {}
+        self.health = {}
+        self.restarts = 0
+        self.events = EventBus()
+        self._ctx = multiprocessing.get_context("spawn")
+        self._procs = [None] * self.workers
+        self._conns = [None] * self.workers
+        self._backoff = [Backoff(self.RESTART_BASE, self.RESTART_CAP) for i in range(self.workers)]
+        self._stats = [None] * self.workers
+        # Per shard, request ID -> future of apply() calls awaiting a result
+        self._requests = [{} for i in range(self.workers)]
+        self._request_ids = itertools.count()
+        self._running = False
+
+    def add(self, spa_id, host, port=BALBOA_DEFAULT_PORT):
+        """ Add a spa to the shard with the fewest spas; before start() only. """
+        if self._running:
+            raise RuntimeError("Spas can only be added before start()")
+        if spa_id in self.shard_of:
+            raise ValueError("Spa {0!r} is already in the fleet".format(spa_id))
+        shard = min(range(self.workers), key=lambda i: len(self.shards[i]))
+        self.shards[shard].append((spa_id, host, port))
+        self.shard_of[spa_id] = shard
+        self.state[spa_id] = {}
+        self.health[spa_id] = "idle"
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def start(self):
+        self._running = True
+        for shard in range(self.workers):
+            if self.shards[shard]:
+                self._spawn(shard)
+
+    async def close(self, timeout=5.0):
+        """ Ask every worker to stop and wait for it, killing stragglers. """
+        self._running = False
+        loop = asyncio.get_event_loop()
+        for shard, conn in enumerate(self._conns):
+            if conn is not None:
+                try:
+                    conn.send(("stop", None, None))
+                except OSError:
+                    pass
+        deadline = time.monotonic() + timeout
+        for shard, proc in enumerate(self._procs):
+            if proc is None:
+                continue
+            await loop.run_in_executor(None, proc.join, max(0.0, deadline - time.monotonic()))
+            if proc.is_alive():
+                proc.kill()
+                proc.join()
+            self._drain(shard)
+            self._forget(shard, "supervisor closed")
+
+    def _spawn(self, shard):
+        loop = asyncio.get_event_loop()
+        parent, child = self._ctx.Pipe()
+        proc = self._ctx.Process(
+            target=_worker_main, name="pybalboa-worker-{0}".format(shard),
+            args=(child, self.shards[shard], self.max_connecting, self.flush_interval),
+            daemon=True)
+        proc.start()
+        child.close()
+        self._procs[shard] = proc
+        self._conns[shard] = parent
+        for spa_id, host, port in self.shards[shard]:
+            self.health[spa_id] = "connecting"
+        loop.add_reader(parent.fileno(), self._on_readable, shard)
+        loop.add_reader(proc.sentinel, self._on_exit, shard)
+
+    def _forget(self, shard, reason="worker exited"):
+        """ Stop watching shard's pipe and process, then drop them.  apply()
+        calls still waiting on the shard fail with RuntimeError(reason). """
+        loop = asyncio.get_event_loop()
+        conn, proc = self._conns[shard], self._procs[shard]
+        if conn is not None:
+            loop.remove_reader(conn.fileno())
+            conn.close()
+        if proc is not None:
+            loop.remove_reader(proc.sentinel)
+        self._conns[shard] = self._procs[shard] = None
+        requests, self._requests[shard] = self._requests[shard], {}
+        for future in requests.values():
+            if not future.done():
+                future.set_exception(RuntimeError(reason))
+
+    def _on_exit(self, shard):
+        proc = self._procs[shard]
+        # The sentinel is ready, so this only reaps the process
+        proc.join()
+        self._drain(shard)
+        self._forget(shard)
+        if not self._running:
+            return
+        self.restarts += 1
+        delay = self._backoff[shard].delay()
+        log.error("Worker {0} exited with {1}, restarting in {2:.1f} s".format(
+            shard, proc.exitcode, delay))
+        for spa_id, host, port in self.shards[shard]:
+            if self.health[spa_id] == "up":
+                self.events.publish(self._event(ConnectionDown(None, RuntimeError("worker exited")), spa_id))
+            self.health[spa_id] = "down"
+        asyncio.get_event_loop().call_later(delay, self._restart, shard)
+
+    def _restart(self, shard):
+        if self._running and self._procs[shard] is None:
+            self._spawn(shard)
+
+    def _on_readable(self, shard):
+        conn = self._conns[shard]
+        if conn is not None and not self._drain(shard):
+            # EOF: the worker is gone, _on_exit() restarts it
+            asyncio.get_event_loop().remove_reader(conn.fileno())
+
+    def _drain(self, shard):
+        """ Handle every batch waiting from shard; False at EOF. """
+        conn = self._conns[shard]
+        if conn is None:
+            return False
+        try:
+            while conn.poll():
+                self._handle(shard, conn.recv())
+        except (EOFError, OSError):
+            return False
+        return True
+
+    @staticmethod
+    def _event(event, spa_id):
+        event.source_id = spa_id
+        return event
+
+    def _handle(self, shard, batch):
+        publish = self.events.publish
+        for kind, key, payload in batch:
+            if kind == "state":
+                self.state[key].update(payload)
+                publish(self._event(StateChanged(None, frozenset(payload)), key))
+            elif kind == "up":
+                self.health[key] = "up"
+                self._backoff[shard].reset()
+                publish(self._event(ConnectionUp(None), key))
+            elif kind == "down":
+                self.health[key] = "down"
+                exc = None if payload is None else RuntimeError(payload)
+                publish(self._event(ConnectionDown(None, exc), key))
+            elif kind == "result":
+                future = self._requests[shard].pop(key, None)
+                if future is not None and not future.done():
+                    result, error = payload
+                    if error is None:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(RuntimeError(error))
+            elif kind == "stats":
+                self._stats[shard] = payload
+
+    def apply(self, spa_id, target):
+        """ BalboaSpaWifi.apply() on the worker holding spa_id.  Returns a
+        future for the seconds until confirmed; failures raise
+        RuntimeError with the worker's description of the error, or
+        "worker exited" if the worker died before answering. """
+        shard = self.shard_of[spa_id]
+        conn = self._conns[shard]
+        future = asyncio.get_event_loop().create_future()
+        if conn is None:
+            future.set_exception(RuntimeError("worker not running"))
+            return future
+        request_id = next(self._request_ids)
+        self._requests[shard][request_id] = future
+        conn.send(("apply", request_id, (spa_id, target)))
+        if self.events.wants(CommandCompleted):
+            future.add_done_callback(lambda f: self.events.publish(
+                self._event(CommandCompleted.from_future(None, target, f), spa_id)))
+        return future
+
+    def stats(self):
+        """ Fleet stats summed over the workers' latest reports. """
+        total = {"spas": len(self.shard_of), "workers": sum(p is not None for p in self._procs),
+                 "restarts": self.restarts, "frames": 0, "frames_per_second": 0.0, "states": {}}
+        for stats in self._stats:
+            if stats is None:
+                continue
+            total["frames"] += stats["frames"]
+            total["frames_per_second"] += stats["frames_per_second"]
+            for state, count in stats["states"].items():
+                total["states"][state] = total["states"].get(state, 0) + count
+        return total
@@ -0,0 +1,170 @@
+import asyncio
+import threading
+import types
+
+from pybalboa.balboa import BALBOA_DEFAULT_PORT, BalboaSpaWifi, status_offsets
+from pybalboa.events import ConnectionDown, ConnectionUp
+
+# What SyncSpa.state holds: every status attribute plus the configuration
+SNAPSHOT_ATTRS = tuple(sorted(status_offsets)) + (
+    "pump_array", "light_array", "aux_array", "circ_pump", "blower", "mister",
+    "config_loaded", "connected", "lastupd", "macaddr", "model_name")
+
+
+class LoopThread:
+    """ An event loop running forever in a daemon thread.
+
+    submit() hands it a coroutine from any thread and returns a
+    concurrent.futures.Future for the result.
+    """
+
+    def __init__(self, name="pybalboa"):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call(self, coro, timeout=None):
+        """ Run coro on the loop and wait for its result. """
+        return self.submit(coro).result(timeout)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_loop():
+    """ Return the LoopThread every SyncSpa uses unless given another. """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = LoopThread()
+        return _shared
+
+
+def _spa_command(name):
+    def command(self, *args):
+        return self._thread.submit(self._command(name, args))
+    command.__name__ = name
+    command.__doc__ = """ Run BalboaSpaWifi.{0}() on the loop thread.
+        Returns a concurrent.futures.Future for when the spa confirms it.
+        """.format(name)
+    return command
+
+
+class SyncSpa:
+    """ Blocking front end to a BalboaSpaWifi, for code without a loop.
+
+    The spa lives on a LoopThread shared by every SyncSpa, so many spas
+    cost one thread.  Commands return concurrent.futures.Future objects
+    and state is a read-only snapshot replaced whole after every status
+    change, connection change and configuration load, so reading it takes
+    no lock and never sees half an update.
+
+        with SyncSpa("10.0.0.5") as spa:
+            spa.wait_ready(30)
+            spa.change_pump(0, 2).result(5)
+            print(spa.state["curtemp"])
+    """
+
+    def __init__(self, hostname, port=BALBOA_DEFAULT_PORT, cache=None, thread=None):
+        self._thread = shared_loop() if thread is None else thread
+        self.spa = self._thread.call(self._create(hostname, port, cache))
+        self.state = self._snapshot()
+
+    async def _create(self, hostname, port, cache):
+        spa = self.spa = BalboaSpaWifi(hostname, port, cache=cache)
+        spa.subscribe(status_offsets.keys(), self._update)
+        spa.events.subscribe(ConnectionUp, self._connection_changed)
+        spa.events.subscribe(ConnectionDown, self._connection_changed)
+        spa.tasks.start(self._refresh_on(spa.identity_ready))
+        spa.tasks.start(self._refresh_on(spa.config_ready))
+        return spa
+
+    def __enter__(self):
+        self.start().result()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _snapshot(self):
+        spa = self.spa
+        values = {}
+        for attr in SNAPSHOT_ATTRS:
+            value = getattr(spa, attr)
+            values[attr] = tuple(value) if isinstance(value, list) else value
+        return types.MappingProxyType(values)
+
+    async def _update(self, changed):
+        self.state = self._snapshot()
+
+    def _connection_changed(self, event):
+        # Not right away: connect() loads the cached configuration after
+        # publishing ConnectionUp
+        asyncio.get_event_loop().call_soon(self._refresh)
+
+    def _refresh(self):
+        self.state = self._snapshot()
+
+    async def _refresh_on(self, ready):
+        await ready
+        self.state = self._snapshot()
+
+    def start(self):
+        """ Connect and start listening; returns a future for whether the
+        first connection attempt worked. """
+        return self._thread.submit(self._start())
+
+    async def _start(self):
+        connected = await self.spa.start()
+        self.state = self._snapshot()
+        return connected
+
+    def wait_ready(self, timeout=None):
+        """ Block until the spa is configured and reporting, see
+        BalboaSpaWifi.wait_ready(). """
+        return self._thread.call(self._wait_ready(timeout))
+
+    async def _wait_ready(self, timeout):
+        ready = await self.spa.wait_ready(timeout)
+        self.state = self._snapshot()
+        return ready
+
+    def close(self, timeout=None):
+        """ Stop the spa's tasks and disconnect, waiting for it. """
+        self._thread.call(self._close(), timeout)
+
+    async def _close(self):
+        await self.spa.close()
+        self.state = self._snapshot()
+
+    def apply(self, target):
+        """ BalboaSpaWifi.apply() from any thread, as a concurrent future. """
+        return self._thread.submit(self._command("apply", (target,)))
+
+    async def _command(self, name, args):
+        result = getattr(self.spa, name)(*args)
+        # apply() returns a future, the change_* coroutines its result
+        while result is not None and hasattr(result, "__await__"):
+            result = await result
+        return result
+
+    send_temp_change = _spa_command("send_temp_change")
+    change_light = _spa_command("change_light")
+    change_pump = _spa_command("change_pump")
+    change_heatmode = _spa_command("change_heatmode")
+    change_temprange = _spa_command("change_temprange")
+    change_aux = _spa_command("change_aux")
+    change_mister = _spa_command("change_mister")
+    change_blower = _spa_command("change_blower")
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import math
+import time
+import weakref
+
+log = logging.getLogger(__name__)
+
+
+class TimerWheel:
+    """ Hashed timer wheel: any number of timers, one loop callback per tick.
+
+    Timers are rounded up to whole ticks and dropped in the slot they fall
+    due in, with a count of full turns still to wait for delays longer than
+    the wheel.  The wheel only ticks while timers are pending.
+    """
+
+    def __init__(self, tick=0.25, slots=256):
+        self.tick = tick
+        self._slots = [[] for i in range(slots)]
+        self._pos = 0
+        self._pending = 0
+        self._handle = None
+
+    def __len__(self):
+        return self._pending
+
+    def schedule(self, delay, callback):
+        """ Call callback after delay seconds; returns a cancellable timer. """
+        ticks = max(1, math.ceil(delay / self.tick))
+        rounds, offset = divmod(ticks - 1, len(self._slots))
+        timer = [rounds, callback]
+        self._slots[(self._pos + 1 + offset) % len(self._slots)].append(timer)
+        self._pending += 1
+        if self._handle is None:
+            self._handle = asyncio.get_event_loop().call_later(self.tick, self._tick)
+        return timer
+
+    def cancel(self, timer):
+        if timer[1] is not None:
+            timer[1] = None
+            self._pending -= 1
+
+    def _tick(self):
+        self._pos = (self._pos + 1) % len(self._slots)
+        waiting = []
+        due = []
+        for timer in self._slots[self._pos]:
+            if timer[1] is None:
+                continue
+            elif timer[0]:
+                timer[0] -= 1
+                waiting.append(timer)
+            else:
+                self._pending -= 1
+                due.append(timer[1])
+        self._slots[self._pos] = waiting
+        for callback in due:
+            try:
+                callback()
+            except Exception:
+                log.exception("Timer callback failed")
+        if self._pending:
+            self._handle = asyncio.get_event_loop().call_later(self.tick, self._tick)
+        else:
+            self._handle = None
+
+
+class Watch:
+    """ Stall detection for one frame stream, see StallWatchdog.watch(). """
+
+    __slots__ = ("interval", "last", "kicked", "kick_after", "reconnect_after",
+                 "on_kick", "on_reconnect", "_wheel", "_timer")
+
+    def __init__(self, wheel, on_kick, on_reconnect, kick_after, reconnect_after, interval):
+        self.interval = interval
+        self.last = time.monotonic()
+        self.kicked = False
+        self.kick_after = kick_after
+        self.reconnect_after = reconnect_after
+        self.on_kick = on_kick
+        self.on_reconnect = on_reconnect
+        self._wheel = wheel
+        self._timer = None
+        self._schedule(self._kick_timeout())
+
+    def feed(self):
+        """ Record a frame.  Cheap: the wheel re-reads last when it fires. """
+        now = time.monotonic()
+        # Clamp so one long gap does not stretch the timeouts for ages
+        sample = min(now - self.last, self._reconnect_timeout())
+        self.interval += StallWatchdog.ALPHA * (sample - self.interval)
+        self.last = now
+        self.kicked = False
+
+    def stop(self):
+        if self._timer is not None:
+            self._wheel.cancel(self._timer)
+            self._timer = None
+
+    def _kick_timeout(self):
+        return max(StallWatchdog.MIN_TIMEOUT, self.kick_after * self.interval)
+
+    def _reconnect_timeout(self):
+        return max(2 * StallWatchdog.MIN_TIMEOUT, self.reconnect_after * self.interval)
+
+    def _schedule(self, delay):
+        # The interval may shrink before the timer fires, so look again at
+        # least every MIN_TIMEOUT
+        self._timer = self._wheel.schedule(min(delay, StallWatchdog.MIN_TIMEOUT), self._check)
+
+    def _check(self):
+        idle = time.monotonic() - self.last
+        if idle >= self._reconnect_timeout():
+            self._timer = None
+            self.on_reconnect(idle)
+            return
+        if not self.kicked and idle >= self._kick_timeout():
+            self.kicked = True
+            self.on_kick(idle)
+        if self.kicked:
+            self._schedule(self._reconnect_timeout() - idle)
+        else:
+            self._schedule(self._kick_timeout() - idle)
+
+
+class StallWatchdog:
+    """ Notices frame streams that went quiet.
+
+    Each watched connection keeps an EWMA of the interval between its
+    frames.  After kick_after intervals without a frame on_kick(idle) is
+    called, after reconnect_after intervals on_reconnect(idle), once,
+    after which the watch is done.  Every watch shares one TimerWheel, so
+    a frame only updates two numbers and the cost of the timers stays flat
+    however many spas are watched.
+    """
+
+    ALPHA = 0.1
+    KICK_AFTER = 10.0
+    RECONNECT_AFTER = 30.0
+    MIN_TIMEOUT = 2.0
+    INITIAL_INTERVAL = 1.0
+
+    def __init__(self, wheel=None):
+        self.wheel = TimerWheel() if wheel is None else wheel
+
+    def watch(self, on_kick, on_reconnect, kick_after=None, reconnect_after=None):
+        return Watch(self.wheel, on_kick, on_reconnect,
+                     self.KICK_AFTER if kick_after is None else kick_after,
+                     self.RECONNECT_AFTER if reconnect_after is None else reconnect_after,
+                     self.INITIAL_INTERVAL)
+
+
+_shared = weakref.WeakKeyDictionary()
+
+
+def shared():
+    """ Return the StallWatchdog shared by everything on this event loop. """
+    loop = asyncio.get_event_loop()
+    watchdog = _shared.get(loop)
+    if watchdog is None:
+        watchdog = _shared[loop] = StallWatchdog()
+    return watchdog
@@ -0,0 +1,100 @@
+""" A simulated spa on a local socket, for the tests. """
+import asyncio
+
+import pybalboa
+import pybalboa.messages as messages
+
+# Panel configuration: two 2-speed pumps, one light
+PANEL = bytes.fromhex("7E0B0ABF2E0A0001500000BF7E")
+
+
+def config(mac="00152737EFED"):
+    """ Module identification frame for a spa with MAC address mac. """
+    return bytes(messages.Message(channel=0x0A, type_code=0x94, arguments=bytes.fromhex(
+        "021480" + mac + "000000000000001527FFFF37EFED")))
+
+
+CONFIG = config()
+INFO = bytes.fromhex("7E1A0ABF2464DC140042503230303047310451800C6B010A0200F97E")
+
+
+class FakeSpa:
+    """ Broadcasts a status update every 1 / rate seconds and applies each
+    press it is sent lag seconds later.  The first drop presses are
+    ignored.  Configuration and panel requests are answered at once. """
+
+    def __init__(self, rate=20.0, lag=0.05, drop=0, config=CONFIG):
+        self.rate = rate
+        self.config = config
+        self.lag = lag
+        self.drop = drop
+        self.state = dict(current_temperature=100, set_temperature=100, pump_1=0,
+                          light_1=0, heating_mode=0, temperature_range=1)
+        self.presses = []
+        self.server = None
+
+    def status(self):
+        update = messages.StatusUpdate(**self.state)
+        return bytes(messages.Message(channel=0xFF, type_code=0x13,
+                                      arguments=bytes(update.arguments) + b"\x00"))
+
+    def press(self, message):
+        self.presses.append((message.type_code, bytes(message.arguments)))
+        if self.drop:
+            self.drop -= 1
+            return
+        if message.type_code == 0x20:
+            self.state["set_temperature"] = message.arguments[0]
+        elif message.type_code == 0x11:
+            code = message.arguments[0]
+            if code == 0x04:
+                self.state["pump_1"] = (self.state["pump_1"] + 1) % 3
+            elif code == 0x11:
+                self.state["light_1"] ^= 1
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_event_loop()
+
+        async def broadcast():
+            while True:
+                writer.write(self.status())
+                await asyncio.sleep(1 / self.rate)
+        task = asyncio.ensure_future(broadcast())
+        decoder = pybalboa.protocol.FrameDecoder()
+        try:
+            while True:
+                data = await reader.read(1024)
+                if not data:
+                    break
+                decoder.feed(data)
+                for frame in list(decoder):
+                    message = messages.decode(bytes(frame))
+                    if message.type_code in (0x11, 0x20):
+                        loop.call_later(self.lag, self.press, message)
+                    elif message.type_code == 0x04:
+                        writer.write(self.config)
+                    elif message.type_code == 0x22:
+                        writer.write(PANEL if message.arguments[0] == 0 else INFO)
+        except ConnectionError:
+            pass
+        finally:
+            task.cancel()
+
+    async def start(self):
+        """ Start serving and return the port. """
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def connect(self, timeout=0.5):
+        """ Start serving and return a BalboaSpaWifi listening to it. """
+        spa = pybalboa.BalboaSpaWifi("127.0.0.1", await self.start())
+        spa.COMMAND_TIMEOUT = timeout
+        spa.parse_panel_config_resp(PANEL)
+        await spa.connect()
+        spa.tasks.start(spa.listen())
+        while not spa.lastupd:
+            await asyncio.sleep(0.01)
+        return spa
+
+    def count(self, type_code=0x11):
+        return sum(1 for pressed, args in self.presses if pressed == type_code)
@@ -0,0 +1,95 @@
+""" BalboaSpaWifi.apply() against a simulated spa that acts on presses
+only after a delay, like the real ones do over wifi. """
+import asyncio
+import time
+
+import pytest
+
+pybalboa = pytest.importorskip("pybalboa")
+
+from fakespa import FakeSpa  # noqa: E402
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 20))
+
+
+async def _settle(fake, spa):
+    # Long enough for any stray press to show up
+    await asyncio.sleep(fake.lag + 0.3)
+    await spa.close()
+    fake.server.close()
+    # Let the fake see the connection close
+    await asyncio.sleep(0.05)
+
+
+@pytest.mark.parametrize("lag", [0.05, 0.5, 1.0])
+def test_pump_cycle_waits_for_slow_spa(lag):
+    async def main():
+        fake = FakeSpa(lag=lag)
+        spa = await fake.connect(timeout=2.0)
+        took = await spa.change_pump(0, 2)
+        assert took >= lag
+        assert spa.pump_status[0] == 2
+        await _settle(fake, spa)
+        return fake, spa
+    fake, spa = run(main())
+    assert fake.count() == 2
+    assert fake.state["pump_1"] == 2
+
+
+def test_several_controls_at_once():
+    async def main():
+        fake = FakeSpa(lag=0.4)
+        spa = await fake.connect()
+        await spa.apply({"pump_1": 1, "light_1": 1, "settemp": 102})
+        assert (spa.pump_status[0], spa.light_status[0], spa.settemp) == (1, 1, 102)
+        await _settle(fake, spa)
+        return fake
+    fake = run(main())
+    assert fake.count(0x11) == 2
+    assert fake.count(0x20) == 1
+
+
+def test_dropped_press_is_sent_again():
+    async def main():
+        fake = FakeSpa(lag=0.2, drop=1)
+        spa = await fake.connect(timeout=0.5)
+        await spa.change_pump(0, 2)
+        await _settle(fake, spa)
+        return fake
+    fake = run(main())
+    # One press was lost, so the pump stopped at 1 and needed one more
+    assert fake.count() == 3
+    assert fake.state["pump_1"] == 2
+
+
+def test_already_there_sends_nothing():
+    async def main():
+        fake = FakeSpa()
+        spa = await fake.connect()
+        took = await spa.change_pump(0, 0)
+        await _settle(fake, spa)
+        return fake, took
+    fake, took = run(main())
+    assert took == 0.0
+    assert fake.presses == []
+
+
+def test_unresponsive_spa_times_out(caplog):
+    async def main():
+        fake = FakeSpa(drop=100)
+        spa = await fake.connect(timeout=0.3)
+        spa.COMMAND_RETRIES = 1
+        start = time.perf_counter()
+        with pytest.raises(asyncio.TimeoutError):
+            await spa.change_pump(0, 1)
+        took = time.perf_counter() - start
+        await _settle(fake, spa)
+        return fake, took
+    fake, took = run(main())
+    # First try and one retry, each waiting COMMAND_TIMEOUT
+    assert fake.count() == 2
+    assert took >= 0.6
+    # The caller got the error, it is not logged as well
+    assert "Background task failed" not in caplog.text
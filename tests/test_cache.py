@@ -0,0 +1,146 @@
+""" ConfigCache, and BalboaSpaWifi using it. """
+import asyncio
+import json
+
+import pytest
+
+pybalboa = pytest.importorskip("pybalboa")
+
+from pybalboa.cache import ConfigCache  # noqa: E402
+
+from fakespa import FakeSpa, config  # noqa: E402
+
+MAC = "00:15:27:37:ef:ed"
+
+
+def test_entries_are_keyed_by_mac_and_found_by_host(tmp_path):
+    cache = ConfigCache(str(tmp_path / "config.json"))
+    assert cache.lookup("10.0.0.5:4257") == (None, None)
+    cache.store("10.0.0.5:4257", MAC, {"cfg_sig": "a"})
+    # The same spa seen at a second address shares the entry
+    cache.store("10.0.0.6:4257", MAC, {"cfg_sig": "b"})
+    assert cache.lookup("10.0.0.5:4257") == (MAC, {"cfg_sig": "b"})
+    assert cache.get(MAC) == {"cfg_sig": "b"}
+    # Another spa answering at the first address takes it over
+    cache.store("10.0.0.5:4257", "other", {"cfg_sig": "c"})
+    assert cache.lookup("10.0.0.5:4257") == ("other", {"cfg_sig": "c"})
+    assert cache.lookup("10.0.0.6:4257") == (MAC, {"cfg_sig": "b"})
+    # Persisted, and read back by a new instance
+    again = ConfigCache(cache.path)
+    assert again.lookup("10.0.0.6:4257") == (MAC, {"cfg_sig": "b"})
+
+
+def test_invalidate_drops_the_entry(tmp_path):
+    cache = ConfigCache(str(tmp_path / "config.json"))
+    cache.store("host:1", MAC, {"cfg_sig": "a"})
+    cache.invalidate(MAC)
+    assert cache.get(MAC) is None
+    assert cache.lookup("host:1") == (None, None)
+    assert ConfigCache(cache.path).get(MAC) is None
+
+
+def test_unchanged_entry_is_not_rewritten(tmp_path, monkeypatch):
+    cache = ConfigCache(str(tmp_path / "config.json"))
+    saves = []
+    monkeypatch.setattr(cache, "_save", lambda: saves.append(1))
+    cache.store("host:1", MAC, {"cfg_sig": "a"})
+    cache.store("host:1", MAC, {"cfg_sig": "a"})
+    assert len(saves) == 1
+
+
+def test_unreadable_file_is_ignored(tmp_path):
+    path = tmp_path / "config.json"
+    path.write_text("{not json")
+    cache = ConfigCache(str(path))
+    assert cache.lookup("host:1") == (None, None)
+    cache.store("host:1", MAC, {"cfg_sig": "a"})
+    assert json.loads(path.read_text())["spas"][MAC] == {"cfg_sig": "a"}
+
+
+async def _until(check, timeout=5):
+    async def wait():
+        while not check():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(wait(), timeout)
+
+
+async def _connect(cache, port):
+    spa = pybalboa.BalboaSpaWifi("127.0.0.1", port, cache=cache)
+    await spa.connect()
+    return spa
+
+
+def _host(port):
+    return "127.0.0.1:{0}".format(port)
+
+
+def test_spa_fills_the_cache_and_starts_from_it(tmp_path):
+    async def main():
+        cache = ConfigCache(str(tmp_path / "config.json"))
+        fake = FakeSpa()
+        port = await fake.start()
+        spa = await _connect(cache, port)
+        spa.tasks.start(spa.listen())
+        await _until(lambda: cache.lookup(_host(port))[1] is not None)
+        mac, entry = cache.lookup(_host(port))
+        assert mac == spa.macaddr != "Unknown"
+        assert entry["pump_array"] == [2, 2, 0, 0, 0, 0]
+        assert entry["cfg_sig"] == spa.cfg_sig
+        await spa.close()
+
+        # A new connection is configured before the spa says anything
+        spa = await _connect(cache, port)
+        assert spa.config_loaded
+        assert spa.macaddr == mac and spa.pump_array == [2, 2, 0, 0, 0, 0]
+        await spa.close()
+        fake.server.close()
+    asyncio.run(main())
+
+
+def test_changed_signature_invalidates_the_entry(tmp_path):
+    async def main():
+        cache = ConfigCache(str(tmp_path / "config.json"))
+        fake = FakeSpa()
+        port = await fake.start()
+        spa = await _connect(cache, port)
+        spa.tasks.start(spa.listen())
+        await _until(lambda: cache.lookup(_host(port))[1] is not None)
+        mac, real = cache.lookup(_host(port))
+        await spa.close()
+
+        # The spa was reconfigured since: the cached signature is stale
+        cache.store(_host(port), mac, dict(real, cfg_sig="stale", pump_array=[1, 0, 0, 0, 0, 0]))
+        spa = await _connect(cache, port)
+        assert spa.pump_array == [1, 0, 0, 0, 0, 0]
+        spa.tasks.start(spa.listen())
+        await _until(lambda: spa.cfg_sig == real["cfg_sig"] and cache.get(mac) == real)
+        # The panel configuration was asked for again and replaced
+        await _until(lambda: spa.pump_array == [2, 2, 0, 0, 0, 0])
+        await spa.close()
+        fake.server.close()
+    asyncio.run(main())
+
+
+def test_other_spa_at_the_address_ignores_the_entry(tmp_path):
+    async def main():
+        cache = ConfigCache(str(tmp_path / "config.json"))
+        fake = FakeSpa()
+        port = await fake.start()
+        spa = await _connect(cache, port)
+        spa.tasks.start(spa.listen())
+        await _until(lambda: cache.lookup(_host(port))[1] is not None)
+        first = spa.macaddr
+        await spa.close()
+
+        fake.config = config("00152737AAAA")
+        spa = await _connect(cache, port)
+        assert spa.macaddr == first
+        spa.tasks.start(spa.listen())
+        await _until(lambda: cache.lookup(_host(port))[0] not in (None, first))
+        assert spa.macaddr == cache.lookup(_host(port))[0]
+        assert spa.config_loaded
+        # The first spa's entry is still there under its own MAC
+        assert cache.get(first) is not None
+        await spa.close()
+        fake.server.close()
+    asyncio.run(main())
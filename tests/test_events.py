@@ -0,0 +1,56 @@
+""" EventBus routing, filtering and dropping. """
+import asyncio
+
+import pytest
+
+pytest.importorskip("pybalboa")
+
+from pybalboa.events import ConnectionUp, EventBus, FrameReceived  # noqa: E402
+
+
+def test_match_skips_events_before_queueing():
+    async def main():
+        bus = EventBus()
+        seen = []
+
+        async def handler(event):
+            seen.append(event.message)
+        bus.subscribe(FrameReceived, handler, maxsize=2, match=lambda e: e.message % 10 == 0)
+        for n in range(30):
+            bus.publish(FrameReceived(None, n))
+        await asyncio.sleep(0.01)
+        await bus.close()
+        return bus, seen
+    bus, seen = asyncio.run(main())
+    # Only 0, 10 and 20 were queued, so the queue of 2 dropped just one
+    assert seen == [10, 20]
+    assert bus.stats()["dropped"] == 1
+
+
+def test_unbounded_queue_never_drops():
+    async def main():
+        bus = EventBus()
+        seen = []
+
+        async def handler(event):
+            seen.append(event.message)
+        bus.subscribe(FrameReceived, handler, maxsize=0)
+        for n in range(500):
+            bus.publish(FrameReceived(None, n))
+        await asyncio.sleep(0.01)
+        await bus.close()
+        return bus, seen
+    bus, seen = asyncio.run(main())
+    assert seen == list(range(500))
+    assert bus.stats()["dropped"] == 0
+
+
+def test_inline_handler_and_parent():
+    parent = EventBus()
+    child = EventBus(parent=parent, source_id="spa")
+    seen = []
+    parent.subscribe(ConnectionUp, seen.append)
+    assert child.wants(ConnectionUp)
+    assert not child.wants(FrameReceived)
+    child.publish(ConnectionUp(None))
+    assert [event.source_id for event in seen] == ["spa"]
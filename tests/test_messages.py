@@ -0,0 +1,101 @@
+""" Message encoding and decoding. """
+import pytest
+
+pytest.importorskip("pybalboa")
+
+import pybalboa.messages as messages  # noqa: E402
+
+
+def test_status_update_rejects_unknown_fields():
+    with pytest.raises(TypeError, match="pumps"):
+        messages.StatusUpdate(pumps=1)
+
+
+def test_status_update_accepts_old_names():
+    # pump_status as the raw byte, circ_pump and light_status as before
+    old = messages.StatusUpdate(pump_status=0b100110, circ_pump=1, light_status=1)
+    assert old.pump_status == (2, 1, 2, 0, 0, 0)
+    assert old.circ_pump == old.circulation_pump == 1
+    assert old.light_status == (1, 0)
+    new = messages.StatusUpdate(pump_1=2, pump_2=1, pump_3=2, circulation_pump=1, light_1=1)
+    assert bytes(new) == bytes(old)
+    assert bytes(messages.StatusUpdate(pump_status=(2, 1, 2), light_status=[1])) == bytes(
+        messages.StatusUpdate(pump_1=2, pump_2=1, pump_3=2, light_1=1))
+
+
+def _registered():
+    for type_code, by_channel in enumerate(messages.Message._registry):
+        for cls in (by_channel or {}).values():
+            yield cls
+
+
+@pytest.mark.parametrize("cls", list(_registered()), ids=lambda cls: cls.__name__)
+def test_every_registered_type_decodes_to_its_class(cls):
+    length = getattr(cls, "LENGTH", getattr(cls, "MIN_LENGTH", 5))
+    channel = getattr(cls, "CHANNEL", 0x10)
+    frame = bytes(messages.Message(channel=channel, type_code=cls.TYPE_CODE,
+                                   arguments=bytes(range(1, length - 4))))
+    msg = messages.decode(frame)
+    assert type(msg) is cls
+    assert (msg.channel, msg.type_code) == (channel, cls.TYPE_CODE)
+    assert bytes(msg) == frame
+
+
+def test_registry_covers_the_protocol():
+    names = {cls.__name__ for cls in _registered()}
+    assert {"StatusUpdate", "ClientClearToSend", "ToggleItemRequest", "ConfigurationResponse",
+            "InformationResponse", "FilterCyclesMessage", "ModuleIdentificationResponse"} <= names
+    # Specializations share their parent's type code and are not registered
+    assert "FilterCyclesResponse" not in names
+    assert "SetTemperatureScaleRequest" not in names
+
+
+def test_unknown_type_falls_back_to_message():
+    frame = bytes(messages.Message(channel=0x10, type_code=0x99, arguments=b"\x01\x02"))
+    msg = messages.decode(frame)
+    assert type(msg) is messages.Message
+    assert msg.type_code == 0x99 and bytes(msg.arguments) == b"\x01\x02"
+
+
+def test_wrong_length_or_channel_falls_back_to_message():
+    # ClientClearToSend carries no arguments
+    frame = bytes(messages.Message(channel=0x10, type_code=0x06, arguments=b"\x00"))
+    assert type(messages.decode(frame)) is messages.Message
+    # StatusUpdate is only sent on the broadcast channel
+    frame = bytes(messages.Message(channel=0x10, type_code=0x13, arguments=bytes(23)))
+    assert type(messages.decode(frame)) is messages.Message
+
+
+def test_status_update_grows_with_firmware():
+    frame = bytes(messages.StatusUpdate(current_temperature=100))
+    longer = bytes(messages.Message(channel=0xFF, type_code=0x13,
+                                    arguments=bytes(messages.decode(frame).arguments) + bytes(4)))
+    msg = messages.decode(longer)
+    assert type(msg) is messages.StatusUpdate
+    assert msg.current_temperature == 100
+
+
+def test_constructed_messages_round_trip():
+    for msg in (messages.StatusUpdate(current_temperature=100, set_temperature=104, pump_2=2,
+                                      heating_mode=messages.StatusUpdate.HEATING_MODE_REST),
+                messages.ClientClearToSend(0x10),
+                messages.SetTemperatureRequest(0x10, 100),
+                messages.ToggleItemRequest(0x10, messages.ToggleItemRequest.ItemCode.PUMP_1)):
+        decoded = messages.decode(bytes(msg))
+        assert type(decoded) is type(msg)
+        assert bytes(decoded) == bytes(msg)
+    status = messages.decode(bytes(messages.StatusUpdate(
+        current_temperature=100, set_temperature=104, pump_2=2,
+        heating_mode=messages.StatusUpdate.HEATING_MODE_REST)))
+    assert (status.current_temperature, status.set_temperature) == (100, 104)
+    assert status.pump_status == (0, 2, 0, 0, 0, 0)
+    assert status.heating_mode == messages.StatusUpdate.HEATING_MODE_REST
+
+
+def test_bad_frames_raise():
+    frame = bytearray(messages.ClientClearToSend(0x10))
+    frame[-2] ^= 0xFF
+    with pytest.raises(ValueError, match="checksum"):
+        messages.decode(bytes(frame))
+    with pytest.raises(ValueError):
+        messages.decode(bytes(frame[1:]))
@@ -0,0 +1,128 @@
+""" FrameDecoder and BalboaProtocol. """
+import asyncio
+
+import pytest
+
+pytest.importorskip("pybalboa")
+
+import pybalboa.messages as messages  # noqa: E402
+from pybalboa.protocol import BalboaProtocol, FrameDecoder  # noqa: E402
+
+STATUS = bytes(messages.StatusUpdate(current_temperature=100, set_temperature=102))
+CTS = bytes(messages.Message(channel=0x10, type_code=0x06))
+
+
+def _frames(decoder):
+    return [bytes(frame) for frame in decoder]
+
+
+def test_frames_split_across_feeds():
+    decoder = FrameDecoder()
+    stream = STATUS + CTS
+    seen = []
+    for i in range(len(stream)):
+        decoder.feed(stream[i:i + 1])
+        seen.extend(_frames(decoder))
+        if i < len(STATUS) - 1:
+            assert seen == []
+    assert seen == [STATUS, CTS]
+    assert len(decoder) == 0
+    assert decoder.frames == 2 and decoder.discarded == 0
+
+
+def test_resync_after_garbage():
+    decoder = FrameDecoder()
+    decoder.feed(b"\x00\x13garbage" + STATUS[3:] + STATUS + b"\x7e\x7e" + CTS)
+    assert _frames(decoder) == [STATUS, CTS]
+    assert decoder.discarded > 0
+
+
+def test_bad_crc_is_dropped():
+    bad = bytearray(STATUS)
+    bad[-2] ^= 0xFF
+    decoder = FrameDecoder()
+    decoder.feed(bytes(bad) + CTS)
+    assert _frames(decoder) == [CTS]
+    # Only the bad frame's own bytes are lost
+    assert decoder.discarded == len(STATUS)
+
+
+def test_yielded_views_outlive_more_data():
+    decoder = FrameDecoder()
+    decoder.feed(STATUS + CTS[:3])
+    kept = list(decoder)
+    assert [bytes(frame) for frame in kept] == [STATUS]
+    decoder.feed(CTS[3:] + STATUS)
+    assert _frames(decoder) == [CTS, STATUS]
+    # The first view still points at the bytes it was cut from
+    assert bytes(kept[0]) == STATUS
+    assert messages.decode(kept[0]).current_temperature == 100
+
+
+class FakeTransport:
+
+    def __init__(self):
+        self.paused = False
+        self.pauses = 0
+        self.written = []
+        self.closed = False
+
+    def pause_reading(self):
+        self.paused = True
+        self.pauses += 1
+
+    def resume_reading(self):
+        self.paused = False
+
+    def write(self, data):
+        self.written.append(data)
+
+    def close(self):
+        self.closed = True
+
+
+def test_reading_pauses_at_max_queued_and_resumes():
+    async def main():
+        protocol = BalboaProtocol()
+        transport = FakeTransport()
+        protocol.connection_made(transport)
+        protocol.data_received(CTS * (BalboaProtocol.MAX_QUEUED - 1))
+        assert not transport.paused
+        protocol.data_received(CTS)
+        assert transport.paused
+        # Resumes once the queue is down to half
+        while transport.paused:
+            assert bytes(await protocol.read_frame()) == CTS
+        assert len(protocol._frames) < BalboaProtocol.MAX_QUEUED // 2
+        assert transport.pauses == 1
+        protocol.connection_lost(None)
+        while await protocol.read_frame() is not None:
+            pass
+    asyncio.run(main())
+
+
+def test_on_frame_sees_frames_before_they_are_queued():
+    async def main():
+        seen = []
+        protocol = BalboaProtocol(on_frame=lambda frame, received: seen.append(bytes(frame)))
+        protocol.connection_made(FakeTransport())
+        protocol.data_received(STATUS + CTS[:4])
+        assert seen == [STATUS]
+        protocol.data_received(CTS[4:])
+        assert seen == [STATUS, CTS]
+        assert bytes(await protocol.read_frame()) == STATUS
+    asyncio.run(main())
+
+
+def test_read_frame_returns_none_once_closed():
+    async def main():
+        lost = []
+        protocol = BalboaProtocol(on_connection_lost=lost.append)
+        protocol.connection_made(FakeTransport())
+        reader = asyncio.ensure_future(protocol.read_frame())
+        await asyncio.sleep(0)
+        protocol.connection_lost(None)
+        assert await reader is None
+        assert lost == [None]
+        assert protocol.closed
+    asyncio.run(main())
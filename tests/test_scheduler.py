@@ -0,0 +1,136 @@
+""" CommandScheduler ordering, deduplication and cancellation. """
+import asyncio
+
+import pytest
+
+pytest.importorskip("pybalboa")
+
+import pybalboa.messages as messages  # noqa: E402
+from pybalboa.scheduler import PRIORITY_SETTINGS, CommandScheduler  # noqa: E402
+
+ItemCode = messages.ToggleItemRequest.ItemCode
+CHANNEL = 0x10
+
+
+def toggle(item):
+    return messages.ToggleItemRequest(CHANNEL, item)
+
+
+def temperature(value):
+    return messages.SetTemperatureRequest(CHANNEL, value)
+
+
+def drain(scheduler):
+    sent = []
+    while True:
+        msg = scheduler.pop()
+        if msg is None:
+            return sent
+        sent.append(msg)
+
+
+def run(test):
+    """ Run test(scheduler) on a loop, as the scheduler's futures need one. """
+    async def main():
+        return test(CommandScheduler())
+    return asyncio.run(main())
+
+
+def test_priority_then_queue_order():
+    def test(scheduler):
+        info = messages.InformationRequest(CHANNEL)
+        prefs = messages.PreferencesRequest(CHANNEL)
+        pump, light = toggle(ItemCode.PUMP_1), toggle(ItemCode.LIGHT_1)
+        late = toggle(ItemCode.PUMP_2)
+        scheduler.push(info)
+        scheduler.push(pump)
+        scheduler.push(prefs)
+        scheduler.push(light)
+        scheduler.push(late, priority=PRIORITY_SETTINGS + 1)
+        assert len(scheduler) == 5
+        # Button presses before settings polls, each in queue order
+        assert drain(scheduler) == [pump, light, info, prefs, late]
+        assert len(scheduler) == 0
+    run(test)
+
+
+def test_future_resolves_with_wait_when_sent():
+    def test(scheduler):
+        future = scheduler.push(toggle(ItemCode.PUMP_1))
+        assert not future.done()
+        scheduler.pop()
+        assert future.result() >= 0.0
+        assert scheduler.stats()["sent"] == 1
+    run(test)
+
+
+def test_newer_temperature_replaces_older_in_place():
+    def test(scheduler):
+        first = scheduler.push(temperature(100))
+        pump = toggle(ItemCode.PUMP_1)
+        scheduler.push(pump)
+        newer = temperature(104)
+        second = scheduler.push(newer, priority=PRIORITY_SETTINGS)
+        assert first.cancelled()
+        assert len(scheduler) == 2
+        # The newer value goes out where the first was queued
+        assert drain(scheduler) == [newer, pump]
+        assert second.done() and not second.cancelled()
+        assert scheduler.stats()["replaced"] == 1
+    run(test)
+
+
+def test_second_press_of_two_state_item_cancels_both():
+    def test(scheduler):
+        first = scheduler.push(toggle(ItemCode.LIGHT_1))
+        second = scheduler.push(toggle(ItemCode.LIGHT_1))
+        assert first.cancelled() and second.cancelled()
+        assert len(scheduler) == 0
+        # A third press is a press again
+        press = toggle(ItemCode.LIGHT_1)
+        third = scheduler.push(press)
+        assert drain(scheduler) == [press]
+        assert third.done() and not third.cancelled()
+        assert scheduler.stats()["cancelled"] == 2
+    run(test)
+
+
+def test_multi_state_presses_are_all_sent():
+    def test(scheduler):
+        for i in range(3):
+            scheduler.push(toggle(ItemCode.PUMP_1))
+        assert len(drain(scheduler)) == 3
+    run(test)
+
+
+def test_toggle_sent_before_second_press_is_not_cancelled():
+    def test(scheduler):
+        first = scheduler.push(toggle(ItemCode.LIGHT_1))
+        scheduler.pop()
+        second = scheduler.push(toggle(ItemCode.LIGHT_1))
+        assert not first.cancelled() and not second.done()
+        assert len(drain(scheduler)) == 1
+    run(test)
+
+
+def test_cancel_removes_queued_message():
+    def test(scheduler):
+        pump = scheduler.push(toggle(ItemCode.PUMP_1))
+        light = toggle(ItemCode.LIGHT_2)
+        scheduler.push(light)
+        assert scheduler.cancel(pump)
+        assert pump.cancelled()
+        assert not scheduler.cancel(pump)
+        assert drain(scheduler) == [light]
+    run(test)
+
+
+def test_expired_message_is_dropped():
+    def test(scheduler):
+        stale = scheduler.push(toggle(ItemCode.PUMP_1), deadline=-1)
+        fresh = toggle(ItemCode.PUMP_2)
+        scheduler.push(fresh, deadline=60)
+        assert drain(scheduler) == [fresh]
+        assert stale.cancelled()
+        assert scheduler.stats()["expired"] == 1
+    run(test)
@@ -0,0 +1,136 @@
+""" Schema code generation and the status delta detection built on it. """
+import asyncio
+
+import pytest
+
+pybalboa = pytest.importorskip("pybalboa")
+
+from pybalboa.messages import StatusUpdate  # noqa: E402
+from pybalboa.schema import Field, Schema  # noqa: E402
+
+from fakespa import PANEL  # noqa: E402
+
+SCHEMA = StatusUpdate.SCHEMA
+
+
+def _values(field):
+    """ Every value field can hold, or a sample for whole bytes. """
+    if field.values is not None:
+        return sorted(set(field.values))
+    if field.mask is None:
+        return [0, 1, 0x7F, 0xFE]
+    return list(range((field.mask >> field.shift) + 1))
+
+
+def _encode(schema, values):
+    buf = bytearray(schema.length)
+    schema.compile().encode_into(buf, 0, values)
+    return bytes(buf)
+
+
+def _diff(a, b):
+    return int.from_bytes(a, "little") ^ int.from_bytes(b, "little")
+
+
+@pytest.mark.parametrize("field", SCHEMA.fields, ids=lambda f: f.name)
+def test_each_field_round_trips_alone(field):
+    zero = SCHEMA.compile().as_dict(bytes(SCHEMA.length))
+    for value in _values(field):
+        decoded = SCHEMA.compile().as_dict(_encode(SCHEMA, {field.name: value}))
+        assert decoded == dict(zero, **{field.name: value})
+        assert SCHEMA.getter(field.name)(_encode(SCHEMA, {field.name: value})) == value
+
+
+def test_fields_sharing_a_byte_round_trip_together():
+    # pump_1 to pump_4 fill byte 11, light_1 and light_2 share byte 14
+    values = {"pump_1": 1, "pump_2": 2, "pump_3": 3, "pump_4": 1, "light_1": 1, "light_2": 1,
+              "temperature_scale": 1, "time_mode": 0, "filter_mode": 3}
+    decoded = SCHEMA.compile().as_dict(_encode(SCHEMA, values))
+    assert {name: decoded[name] for name in values} == values
+
+
+def test_subset_decodes_in_asked_order():
+    buf = _encode(SCHEMA, {"set_temperature": 104, "hours": 7, "pump_2": 2})
+    assert SCHEMA.compile(("set_temperature", "pump_2", "hours")).decode(buf) == (104, 2, 7)
+    # Compiled schemas are cached
+    assert SCHEMA.compile(("hours",)) is SCHEMA.compile(("hours",))
+
+
+@pytest.mark.parametrize("field", SCHEMA.fields, ids=lambda f: f.name)
+def test_changed_reports_only_the_touched_field(field):
+    zero = bytes(SCHEMA.length)
+    for value in _values(field):
+        encoded = _encode(SCHEMA, {field.name: value})
+        expected = {field.name} if encoded != zero else set()
+        assert SCHEMA.compile().changed(_diff(zero, encoded)) == expected
+
+
+def test_changed_with_masked_fields_sharing_a_byte():
+    changed = SCHEMA.compile().changed
+    before = _encode(SCHEMA, {"pump_1": 1, "pump_2": 2, "pump_3": 0})
+    after = _encode(SCHEMA, {"pump_1": 1, "pump_2": 1, "pump_3": 2})
+    assert changed(_diff(before, after)) == {"pump_2", "pump_3"}
+    # Bits outside every field, here bit 0 of byte 13, are no change at all
+    assert changed(1 << (8 * 13)) == set()
+    assert changed(0) == set()
+    # A detector for a subset ignores the other fields in the same byte
+    assert SCHEMA.compile(("pump_1", "pump_3")).changed(_diff(before, after)) == {"pump_3"}
+
+
+def test_setter_and_row_setter():
+    buf = b"\x00" * 3 + _encode(SCHEMA, {"pump_1": 2, "pump_2": 1, "set_temperature": 100})
+
+    class Target:
+        pump_status = [0, 0]
+    target = Target()
+    compiled = SCHEMA.compile(("pump_1", "pump_2", "set_temperature"))
+    compiled.setter({"pump_1": "pump_status[0]", "pump_2": "pump_status[1]"})(target, buf, 3)
+    assert (target.pump_status, target.set_temperature) == ([2, 1], 100)
+    columns = {name: [0, 0] for name in compiled.names}
+    compiled.row_setter()(columns, 1, buf, 3)
+    assert columns == {"pump_1": [0, 2], "pump_2": [0, 1], "set_temperature": [0, 100]}
+
+
+def test_wide_and_scaled_fields():
+    schema = Schema(Field("flags", 0, 0xF0), Field("word", 1, fmt="H"),
+                    Field("tenths", 3, scale=0.1), Field("raw", 4, fmt="2s"))
+    buf = _encode(schema, {"flags": 0xA, "word": 0x1234, "tenths": 2.5, "raw": b"ab"})
+    assert buf == b"\xa0\x12\x34\x19ab"
+    flags, word, tenths, raw = schema.compile().decode(buf)
+    assert (flags, word, round(tenths, 3), raw) == (0xA, 0x1234, 2.5, b"ab")
+    # A change in either byte of the word is a change of the word
+    assert schema.compile().changed(1 << 16) == {"word"}
+
+
+def test_overlapping_fields_are_refused():
+    with pytest.raises(ValueError, match="Overlapping"):
+        Schema(Field("a", 0, fmt="H"), Field("b", 1)).compile()
+
+
+def _frame(**fields):
+    update = StatusUpdate(**fields)
+    return bytes(pybalboa.messages.Message(channel=0xFF, type_code=0x13,
+                                           arguments=bytes(update.arguments) + b"\x00"))
+
+
+def test_spa_decodes_only_the_fields_a_delta_touches():
+    spa = pybalboa.BalboaSpaWifi("127.0.0.1")
+    spa.parse_panel_config_resp(PANEL)
+
+    def parse(**fields):
+        asyncio.run(spa.parse_status_update(_frame(**fields)))
+        return spa.changed_fields
+    base = dict(current_temperature=100, set_temperature=102, hours=7, minutes=30)
+    parse(**base)
+    assert parse(**dict(base, pump_2=1)) == {"pump_status"}
+    assert parse(**dict(base, pump_2=1, minutes=31)) == {pybalboa.balboa.status_attrs["minutes"]}
+    seq = spa.state.seq
+    # Pump 3 is not fitted: its bits changing is no update at all
+    assert parse(**dict(base, pump_2=1, minutes=31, pump_3=2)) == {
+        pybalboa.balboa.status_attrs["minutes"]}
+    assert spa.state.seq == seq
+    assert spa.pump_status == [0, 1, 0, 0, 0, 0]
+    # A scale change re-decodes both temperatures
+    changed = parse(**dict(base, pump_2=1, minutes=31, temperature_scale=1))
+    assert {"curtemp", "settemp", "tempscale"} <= changed
+    assert (spa.curtemp, spa.settemp) == (50.0, 51.0)
@@ -0,0 +1,72 @@
+""" SpaState snapshots against the spa's live attributes. """
+import asyncio
+import copy
+import pickle
+
+import pytest
+
+pybalboa = pytest.importorskip("pybalboa")
+messages = pybalboa.messages
+
+from fakespa import PANEL  # noqa: E402
+
+
+def _frame(**fields):
+    update = messages.StatusUpdate(**fields)
+    return bytes(messages.Message(channel=0xFF, type_code=0x13,
+                                  arguments=bytes(update.arguments) + b"\x00"))
+
+
+def _spa(panel=PANEL):
+    spa = pybalboa.BalboaSpaWifi("127.0.0.1")
+    spa.parse_panel_config_resp(panel)
+    return spa
+
+
+def test_snapshot_matches_live_attributes_for_missing_equipment():
+    spa = _spa()
+    # The panel has pumps 1 and 2 and light 1; the frame claims more
+    frame = _frame(current_temperature=100, set_temperature=102, pump_1=2, pump_3=1,
+                   light_1=1, light_2=1, blower=3)
+    asyncio.run(spa.parse_status_update(frame))
+    state = spa.state
+    assert list(state.pump_status) == spa.pump_status == [2, 0, 0, 0, 0, 0]
+    assert list(state.light_status) == spa.light_status == [1, 0]
+    assert state.blower_status == spa.blower_status == 0
+    assert state.as_dict() == {attr: tuple(value) if isinstance(value, list) else value
+                               for attr, value in ((attr, getattr(spa, attr))
+                                                   for attr in state.as_dict())}
+
+
+def test_snapshot_ignores_noise_from_missing_equipment():
+    spa = _spa()
+    asyncio.run(spa.parse_status_update(_frame(current_temperature=100, pump_3=0)))
+    first = spa.state
+    asyncio.run(spa.parse_status_update(_frame(current_temperature=100, pump_3=1)))
+    # Nothing this spa has changed, so no new snapshot
+    assert spa.state is first
+
+
+def test_snapshot_is_immutable_and_shared():
+    spa = _spa()
+    asyncio.run(spa.parse_status_update(_frame(current_temperature=100, set_temperature=104)))
+    state = spa.state
+    assert state.curtemp == 100.0 and state.settemp == 104.0
+    with pytest.raises(AttributeError):
+        state.seq = 5
+    assert copy.copy(state) is state and copy.deepcopy(state) is state
+    assert pickle.loads(pickle.dumps(state)) == state
+
+
+def test_equipment_removed_by_new_config_reads_zero():
+    spa = _spa()
+    frame = _frame(current_temperature=100, pump_1=1, pump_2=2)
+    asyncio.run(spa.parse_status_update(frame))
+    assert spa.pump_status[:2] == [1, 2]
+    # Same panel without pump 2
+    spa.parse_panel_config_resp(bytes(messages.Message(
+        channel=0x0A, type_code=0x2E, arguments=bytes.fromhex("020001500000"))))
+    assert spa.pump_array[:2] == [2, 0]
+    assert spa.pump_status[:2] == [1, 0]
+    asyncio.run(spa.parse_status_update(frame))
+    assert spa.state.pump_status[:2] == (1, 0)
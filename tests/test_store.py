@@ -0,0 +1,105 @@
+""" StateStore columns written by the spas' status decoders. """
+import asyncio
+import math
+
+import pytest
+
+pybalboa = pytest.importorskip("pybalboa")
+np = pytest.importorskip("numpy")
+messages = pybalboa.messages
+
+from pybalboa.store import StateStore  # noqa: E402
+
+from fakespa import PANEL  # noqa: E402
+
+
+def _frame(**fields):
+    update = messages.StatusUpdate(**fields)
+    return bytes(messages.Message(channel=0xFF, type_code=0x13,
+                                  arguments=bytes(update.arguments) + b"\x00"))
+
+
+def _spa():
+    spa = pybalboa.BalboaSpaWifi("127.0.0.1")
+    spa.parse_panel_config_resp(PANEL)
+    return spa
+
+
+def _status(spa, **fields):
+    asyncio.run(spa.parse_status_update(_frame(**fields)))
+
+
+def test_no_reading_is_nan_not_zero():
+    store = StateStore()
+    spa = _spa()
+    row = store.attach(spa, "a")
+    assert math.isnan(store.curtemp[row])
+    assert math.isnan(store.settemp[row])
+    assert store.count(store.settemp < 90) == 0
+    _status(spa, current_temperature=99, set_temperature=102)
+    assert store.curtemp[row] == 99.0
+    assert store.settemp[row] == 102.0
+    assert store["lastupd"][row] > 0
+
+
+def test_celsius_temperatures_are_halved():
+    store = StateStore()
+    spa = _spa()
+    row = store.attach(spa, "a")
+    _status(spa, current_temperature=75, set_temperature=76, temperature_scale=1)
+    assert store.curtemp[row] == 37.5
+    assert store.settemp[row] == 38.0
+
+
+def test_attach_takes_the_status_the_spa_already_has():
+    spa = _spa()
+    _status(spa, current_temperature=98, set_temperature=104, pump_1=2)
+    store = StateStore()
+    row = store.attach(spa, "a")
+    assert store["pump_1"][row] == 2
+    assert store.settemp[row] == 104.0
+    assert store["lastupd"][row] == spa.lastupd
+
+
+def test_only_changed_fields_are_written():
+    store = StateStore()
+    spa = _spa()
+    row = store.attach(spa, "a")
+    _status(spa, current_temperature=98, pump_1=1)
+    # Scribble on a column the next frame does not change
+    store["current_temperature"][row] = 50
+    _status(spa, current_temperature=98, pump_1=2)
+    assert store["pump_1"][row] == 2
+    assert store["current_temperature"][row] == 50
+
+
+def test_removed_and_grown_rows_have_no_reading():
+    store = StateStore(capacity=2)
+    spas = [_spa() for i in range(3)]
+    for i, spa in enumerate(spas):
+        store.attach(spa, i)
+        _status(spa, current_temperature=100 + i, set_temperature=100, pump_1=1)
+    assert store.capacity == 4
+    assert list(store.curtemp[[store.rows[i] for i in range(3)]]) == [100.0, 101.0, 102.0]
+    assert math.isnan(store.settemp[3])
+    row = store.rows[1]
+    store.detach(spas[1], 1)
+    assert spas[1].state_store is None
+    assert store.add("new") == row
+    assert math.isnan(store.curtemp[row]) and math.isnan(store.settemp[row])
+    assert store["pump_1"][row] == 0
+
+
+def test_queries_only_look_at_active_rows():
+    store = StateStore()
+    for spa_id, pumps in (("a", {}), ("b", {"pump_1": 2}), ("c", {"pump_1": 1, "pump_2": 1})):
+        spa = _spa()
+        store.attach(spa, spa_id)
+        _status(spa, current_temperature=100, set_temperature=104, **pumps)
+    assert store.pumps_running() == 3
+    assert store.ids(store["pump_1"] > 0) == ["b", "c"]
+    assert store.count(store.curtemp < store.settemp - 2) == 3
+    store.remove("b")
+    assert store.pumps_running() == 2
+    assert store.ids(store["pump_1"] > 0) == ["c"]
+    assert len(store) == 2 and "b" not in store
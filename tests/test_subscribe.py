@@ -0,0 +1,86 @@
+""" BalboaSpaWifi.subscribe() callbacks. """
+import asyncio
+
+import pytest
+
+pybalboa = pytest.importorskip("pybalboa")
+messages = pybalboa.messages
+
+from fakespa import PANEL  # noqa: E402
+
+
+def _frame(**fields):
+    update = messages.StatusUpdate(**fields)
+    return bytes(messages.Message(channel=0xFF, type_code=0x13,
+                                  arguments=bytes(update.arguments) + b"\x00"))
+
+
+def _spa():
+    spa = pybalboa.BalboaSpaWifi("127.0.0.1")
+    spa.parse_panel_config_resp(PANEL)
+    return spa
+
+
+def test_slow_subscriber_does_not_hold_up_parsing():
+    async def main():
+        spa = _spa()
+        calls = []
+        release = asyncio.Event()
+
+        async def slow(changed):
+            calls.append((changed, spa.curtemp))
+            await release.wait()
+        spa.subscribe(("curtemp", "pump_status"), slow)
+        await asyncio.wait_for(spa.parse_status_update(_frame(current_temperature=100)), 0.1)
+        await asyncio.sleep(0)
+        # The callback is stuck; parsing goes on regardless
+        for temp in (101, 102, 103):
+            await asyncio.wait_for(spa.parse_status_update(_frame(current_temperature=temp)), 0.1)
+        await asyncio.wait_for(spa.parse_status_update(
+            _frame(current_temperature=103, pump_1=1)), 0.1)
+        assert len(calls) == 1
+        release.set()
+        await asyncio.sleep(0.01)
+        await spa.close()
+        return calls
+    calls = asyncio.run(main())
+    # The first frame sets everything; the updates made while the callback
+    # was busy arrive as one call, with the newest state
+    assert calls == [({"curtemp", "pump_status"}, 100.0), ({"curtemp", "pump_status"}, 103.0)]
+
+
+def test_only_subscribed_fields_wake_and_unsubscribe():
+    async def main():
+        spa = _spa()
+        calls = []
+
+        async def callback(changed):
+            calls.append(changed)
+        unsubscribe = spa.subscribe("pump_status", callback)
+        await spa.parse_status_update(_frame(current_temperature=100))
+        await asyncio.sleep(0)
+        await spa.parse_status_update(_frame(current_temperature=101))
+        await asyncio.sleep(0)
+        await spa.parse_status_update(_frame(current_temperature=101, pump_2=2))
+        await asyncio.sleep(0)
+        unsubscribe()
+        await spa.parse_status_update(_frame(current_temperature=101, pump_2=1))
+        await asyncio.sleep(0)
+        await spa.close()
+        return calls
+    # The first frame sets everything, pumps included
+    assert asyncio.run(main()) == [{"pump_status"}, {"pump_status"}]
+
+
+def test_failing_subscriber_is_logged(caplog):
+    async def main():
+        spa = _spa()
+
+        async def broken(changed):
+            raise RuntimeError("boom")
+        spa.subscribe("curtemp", broken)
+        await spa.parse_status_update(_frame(current_temperature=100))
+        await asyncio.sleep(0)
+        await spa.close()
+    asyncio.run(main())
+    assert "Subscriber callback failed" in caplog.text
@@ -0,0 +1,54 @@
+""" FleetSupervisor against simulated spas in this process. """
+import asyncio
+import os
+import signal
+
+import pytest
+
+pytest.importorskip("pybalboa")
+
+from fakespa import FakeSpa  # noqa: E402
+from pybalboa.supervisor import FleetSupervisor  # noqa: E402
+
+
+async def _until(check, timeout=20):
+    async def wait():
+        while not check():
+            await asyncio.sleep(0.05)
+    await asyncio.wait_for(wait(), timeout)
+
+
+def test_pending_apply_fails_when_worker_dies():
+    async def main():
+        # Drops every press, so the apply() below stays pending
+        fake = FakeSpa(drop=100)
+        supervisor = FleetSupervisor(workers=1)
+        supervisor.add("spa", "127.0.0.1", await fake.start())
+        async with supervisor:
+            await _until(lambda: "settemp" in supervisor.state["spa"])
+            future = supervisor.apply("spa", {"settemp": 102})
+            await _until(lambda: fake.presses)
+            os.kill(supervisor._procs[0].pid, signal.SIGKILL)
+            with pytest.raises(RuntimeError, match="worker exited"):
+                await asyncio.wait_for(future, 5)
+            assert supervisor.health["spa"] == "down"
+        fake.server.close()
+    asyncio.run(main())
+
+
+def test_close_fails_pending_apply():
+    async def main():
+        fake = FakeSpa(drop=100)
+        supervisor = FleetSupervisor(workers=1)
+        supervisor.add("spa", "127.0.0.1", await fake.start())
+        supervisor.start()
+        await _until(lambda: "settemp" in supervisor.state["spa"])
+        future = supervisor.apply("spa", {"settemp": 102})
+        await _until(lambda: fake.presses)
+        await supervisor.close()
+        # Either the stopping worker cancelled it or close() failed it
+        assert future.done()
+        with pytest.raises(RuntimeError):
+            future.result()
+        fake.server.close()
+    asyncio.run(main())
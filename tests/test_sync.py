@@ -0,0 +1,72 @@
+""" SyncSpa snapshots, driven from a plain thread. """
+import asyncio
+import time
+
+import pytest
+
+pybalboa = pytest.importorskip("pybalboa")
+
+from pybalboa.sync import LoopThread, SyncSpa  # noqa: E402
+
+from fakespa import FakeSpa  # noqa: E402
+
+
+@pytest.fixture
+def thread():
+    thread = LoopThread(name="pybalboa-test")
+    yield thread
+    thread.stop()
+
+
+def _until(check, timeout=3):
+    deadline = time.monotonic() + timeout
+    while not check():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_state_follows_config_load_without_status_change(thread):
+    # One status at connect, ignored until the panel configuration is
+    # known, and the next one long after
+    fake = FakeSpa(rate=0.1)
+    port = thread.call(fake.start())
+    spa = SyncSpa("127.0.0.1", port, thread=thread)
+    assert spa.start().result(5)
+    _until(lambda: spa.state["config_loaded"])
+    assert spa.state["pump_array"][:2] == (2, 2)
+    thread.call(spa.spa.send_config_req())
+    _until(lambda: spa.state["macaddr"] != "Unknown")
+    assert spa.state["macaddr"] == spa.spa.macaddr
+    spa.close(5)
+    thread.call(_stop(fake.server))
+
+
+def test_state_follows_the_connection(thread):
+    fake = FakeSpa()
+    port = thread.call(fake.start())
+    spa = SyncSpa("127.0.0.1", port, thread=thread)
+    spa.start().result(5)
+    assert spa.wait_ready(5)
+    assert spa.state["connected"]
+
+    # Nobody to reconnect to for now
+    thread.call(_stop(fake.server))
+    thread.call(_drop(spa.spa))
+    _until(lambda: not spa.state["connected"])
+
+    # The spa comes back sending the very same status, so only the
+    # reconnection itself can refresh the snapshot
+    server = thread.call(asyncio.start_server(fake.handle, "127.0.0.1", port))
+    _until(lambda: spa.state["connected"], timeout=10)
+    spa.close(5)
+    assert not spa.state["connected"]
+    thread.call(_stop(server))
+
+
+async def _stop(server):
+    # Stops listening, connections already made stay up
+    server.close()
+
+
+async def _drop(spa):
+    spa.protocol.close()
@@ -0,0 +1,131 @@
+""" TimerWheel and StallWatchdog. """
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("pybalboa")
+
+from pybalboa import watchdog  # noqa: E402
+from pybalboa.watchdog import StallWatchdog, TimerWheel  # noqa: E402
+
+TICK = 0.01
+
+
+def test_timers_fire_in_order_after_their_delay():
+    async def main():
+        wheel = TimerWheel(tick=TICK, slots=8)
+        start = time.monotonic()
+        fired = []
+        for delay in (0.05, 0.01, 0.03):
+            wheel.schedule(delay, lambda delay=delay: fired.append((delay, time.monotonic() - start)))
+        assert len(wheel) == 3
+        await asyncio.sleep(0.1)
+        return wheel, fired
+    wheel, fired = asyncio.run(main())
+    assert [delay for delay, at in fired] == [0.01, 0.03, 0.05]
+    for delay, at in fired:
+        # Rounded up to whole ticks, never early
+        assert at >= delay - 0.001
+    assert len(wheel) == 0
+    # Nothing pending, so the wheel stopped ticking
+    assert wheel._handle is None
+
+
+def test_delays_longer_than_the_wheel_wait_whole_turns():
+    async def main():
+        wheel = TimerWheel(tick=TICK, slots=4)
+        start = time.monotonic()
+        fired = []
+        wheel.schedule(0.015, lambda: fired.append(("short", time.monotonic() - start)))
+        wheel.schedule(0.1, lambda: fired.append(("long", time.monotonic() - start)))
+        await asyncio.sleep(0.05)
+        assert [name for name, at in fired] == ["short"]
+        await asyncio.sleep(0.1)
+        return fired
+    fired = dict(asyncio.run(main()))
+    assert fired["long"] >= 0.099
+
+
+def test_cancelled_timer_does_not_fire():
+    async def main():
+        wheel = TimerWheel(tick=TICK)
+        fired = []
+        timer = wheel.schedule(0.02, lambda: fired.append(1))
+        wheel.cancel(timer)
+        wheel.cancel(timer)
+        assert len(wheel) == 0
+        await asyncio.sleep(0.05)
+        return fired
+    assert asyncio.run(main()) == []
+
+
+def test_failing_callback_does_not_stop_the_wheel(caplog):
+    async def main():
+        wheel = TimerWheel(tick=TICK)
+        fired = []
+
+        def broken():
+            raise RuntimeError("boom")
+        wheel.schedule(0.01, broken)
+        wheel.schedule(0.01, lambda: fired.append(1))
+        wheel.schedule(0.03, lambda: fired.append(2))
+        await asyncio.sleep(0.06)
+        return fired
+    assert asyncio.run(main()) == [1, 2]
+    assert "Timer callback failed" in caplog.text
+
+
+@pytest.fixture
+def fast(monkeypatch):
+    """ A StallWatchdog on a fine wheel, with a short MIN_TIMEOUT. """
+    monkeypatch.setattr(StallWatchdog, "MIN_TIMEOUT", 0.05)
+    return lambda: StallWatchdog(TimerWheel(tick=TICK))
+
+
+def _watch(dog, events, **kwargs):
+    start = time.monotonic()
+    return dog.watch(lambda idle: events.append(("kick", time.monotonic() - start)),
+                     lambda idle: events.append(("reconnect", time.monotonic() - start)),
+                     **kwargs)
+
+
+def test_quiet_stream_is_kicked_then_reconnected_once(fast):
+    async def main():
+        events = []
+        # With the initial 1 s interval: kick after 0.1 s, reconnect after 0.3 s
+        _watch(fast(), events, kick_after=0.1, reconnect_after=0.3)
+        await asyncio.sleep(0.6)
+        return events
+    events = asyncio.run(main())
+    assert [name for name, at in events] == ["kick", "reconnect"]
+    kick, reconnect = (at for name, at in events)
+    assert 0.1 <= kick < 0.25
+    assert 0.3 <= reconnect < 0.45
+
+
+def test_fed_stream_stays_quiet_and_learns_its_rate(fast):
+    async def main():
+        events = []
+        watch = _watch(fast(), events, kick_after=0.1, reconnect_after=0.3)
+        for i in range(25):
+            await asyncio.sleep(0.01)
+            watch.feed()
+        assert events == []
+        assert watch.interval < 0.5
+        # A short hiccup after a kick resets it
+        await asyncio.sleep(0.08)
+        assert [name for name, at in events] == ["kick"]
+        watch.feed()
+        assert not watch.kicked
+        watch.stop()
+        await asyncio.sleep(0.2)
+        return events
+    assert [name for name, at in asyncio.run(main())] == ["kick"]
+
+
+def test_shared_watchdog_is_per_loop():
+    async def get():
+        assert watchdog.shared() is watchdog.shared()
+        return watchdog.shared()
+    assert asyncio.run(get()) is not asyncio.run(get())